@@ -0,0 +1,78 @@
+'''
+Benchmark the in-memory frame codecs of util.image_util on a sample race, for choosing config.frame_codec (main.py --frame_codec) per deployment.
+
+For every codec, report the encode and decode throughput, the bytes per frame (i.e. the RAM of Result.frames per frame) and the PSNR against the decoded video frames.
+
+Usage
+-----
+python benchmarks/benchmark_codecs.py --video_path [path to video file] --start 1000 --end 1200 --codecs raw png jpeg:95 jpeg:80 zlib lz4
+'''
+
+import os, sys, time, argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from util.image_util import get_codec
+from util.video_util import FrameSource
+
+
+def psnr(original, decoded):
+    mse = np.mean((original.astype(np.float32) - decoded.astype(np.float32)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def benchmark_codec(codec, frames):
+
+    '''
+    encode and decode the frames with the codec
+
+    Parameters
+    ----------
+    codec : FrameCodec
+    frames : list of numpy array
+        the decoded frames
+
+    Returns
+    -------
+    result : dict
+        encode/decode frames per second, bytes per frame and the mean PSNR in dB
+    '''
+
+    start = time.perf_counter()
+    items = [codec.encode(frame) for frame in frames]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = [codec.decode(item) for item in items]
+    decode_time = time.perf_counter() - start
+
+    nbytes = [item.nbytes if isinstance(item, np.ndarray) else len(item) for item in items]
+    return {
+        'encode_fps': len(frames) / encode_time,
+        'decode_fps': len(frames) / decode_time,
+        'bytes_per_frame': np.mean(nbytes),
+        'psnr': np.mean([psnr(f, d) for f, d in zip(frames, decoded)]),
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Frame codec benchmark')
+    parser.add_argument('--video_path', type=str, help='the path to a sample race video')
+    parser.add_argument('--start', type=int, help='the starting frame of the sample', default=0)
+    parser.add_argument('--end', type=int, help='the ending frame of the sample', default=199)
+    parser.add_argument('--codecs', nargs='+', type=str, help='the codecs to compare', default=['raw', 'png', 'jpeg:95', 'jpeg:80', 'zlib', 'lz4'])
+    args = parser.parse_args()
+
+    with FrameSource(args.video_path, args.start, args.end) as source:
+        frames = list(source)
+    print(f"{len(frames)} frames of {frames[0].shape[1]}x{frames[0].shape[0]}")
+    print(f"{'codec':<10}{'encode fps':>12}{'decode fps':>12}{'KB/frame':>12}{'PSNR dB':>10}")
+    for spec in args.codecs:
+        try:
+            codec = get_codec(spec)
+        except ImportError as e:
+            print(f"{spec:<10} skipped: {e}")
+            continue
+        result = benchmark_codec(codec, frames)
+        print(f"{spec:<10}{result['encode_fps']:>12.1f}{result['decode_fps']:>12.1f}{result['bytes_per_frame'] / 1024:>12.1f}{result['psnr']:>10.2f}")
@@ -0,0 +1,82 @@
+'''
+Check the import time of the entry point and the bookkeeping modules with python -X importtime, so the quick runs (main.py --help, the excel export, the catalogue status) keep starting fast.
+
+For every module, report the total import time and the slowest imports, and fail (exit code 1) if the import takes longer than the budget or imports one of the heavy frameworks, which have to be imported by the tasks that need them only.
+
+Usage
+-----
+python benchmarks/benchmark_import_time.py --budget 1.0 --modules main config util.result util.export --top 10
+'''
+
+import os, sys, time, argparse, subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module):
+
+    '''
+    import a module in a new interpreter with -X importtime
+
+    Parameters
+    ----------
+    module : string
+
+    Returns
+    -------
+    times : dict
+        imported module: (self time, cumulative time) in seconds, in import order
+    '''
+
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=root, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{process.stderr}")
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return times
+
+
+def command_time(args, repeat=3):
+    # the best wall time of a command, i.e. main.py --help
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=root, capture_output=True, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Import time benchmark')
+    parser.add_argument('--modules', nargs='+', type=str, help='the modules to import', default=['main', 'config', 'util.result', 'util.export', 'util.catalogue'])
+    parser.add_argument('--budget', type=float, help='the maximum import time of a module in seconds', default=1.0)
+    parser.add_argument('--forbid', nargs='+', type=str, help='the modules that must not be imported', default=['torch', 'tensorflow', 'pandas', 'pymongo', 'memory_profiler', 'detectron2'])
+    parser.add_argument('--top', type=int, help='number of the slowest imports reported per module', default=10)
+    args = parser.parse_args()
+
+    failures = []
+    for module in args.modules:
+        times = import_times(module)
+        total = times[module][1]
+        heavy = sorted(set(name.split('.')[0] for name in times) & set(args.forbid))
+        print(f"{module}: {total * 1000:.0f} ms, {len(times)} modules imported")
+        for name, (_, cumulative) in sorted(times.items(), key=lambda item: -item[1][1])[1:args.top + 1]:
+            print(f"    {cumulative * 1000:8.1f} ms  {name}")
+        if total > args.budget:
+            failures.append(f"{module} imports in {total:.2f}s, more than the budget of {args.budget}s")
+        if heavy:
+            failures.append(f"{module} imports {heavy}")
+
+    wall = command_time(['main.py', '--help'])
+    print(f"main.py --help: {wall * 1000:.0f} ms")
+    if wall > args.budget:
+        failures.append(f"main.py --help takes {wall:.2f}s, more than the budget of {args.budget}s")
+
+    for failure in failures:
+        print("FAILED:", failure)
+    sys.exit(1 if failures else 0)
@@ -1,9 +1,8 @@
 import os, json
-import torch
 
 # mode
 debug = True
-device = 'cuda' if torch.cuda.is_available() else 'cpu' # use GPU instead of cpu, cpu not recommended
+# device: 'cuda' if available, cpu not recommended. Found when first used (config.device), so importing config does not import torch, see __getattr__
 
 # task list
 class Task:
@@ -52,10 +51,92 @@ directories = {
 # files storage
 video_processer_save_path = 'vid_process.csv'
 camerachange_save_path = 'camera_change.csv'
+catalogue_save_path = 'catalogue.sqlite' # SQLite catalogue of the start/end frames, camera changes, task status and outputs of the videos, see util.catalogue
+rescan_results = False # fill the catalogue again from the csv files and the task directories (main.py --rescan), i.e. after changing the result directory by hand
 #scene_classification_save_path = 'scene_classification.csv'
 
 # video
 accepted_formats = ['.mp4', '.mpg']
+frame_prefetch = 32 # number of decoded frames buffered ahead of the consumer when streaming a video with util.video_util.FrameSource
+frame_codec = 'jpeg' # codec of the frames kept in memory (main.py --frame_codec): 'raw', 'png[:level]', 'jpeg[:quality]', 'zlib[:level]' or 'lz4[:level]', see benchmarks/benchmark_codecs.py
+decode_threads = 4 # number of threads decoding the frames of Result.frames, see Result.iter_frames and Result.decode_batch
+decode_readahead = 16 # number of frames decoded ahead of the consumer by Result.iter_frames
+decode_workers = 1 # number of processes decoding a frame set in parallel, see util.video_util.decode_parallel
+parallel_decode_min_frames = 1000 # frame sets shorter than this are decoded in a single process
+keyframe_interval = 50 # the expected number of video frames between two keyframes, the parallel decoding segments are aligned to it
+seek_decoding = True # seek to the starting frame instead of decoding the video from the beginning, falls back to reading from the beginning when seeking is not accurate
+seek_min_frames = 250 # do not seek if the starting frame is closer than this to the beginning of the video
+frame_cache_dir = None # directory of the on-disk decoded frame cache (main.py --frame_cache), None to disable
+frame_cache_quota = 200 # GB, the least recently used frame sets are removed from the frame cache above this size
+video_probe = {'cache': os.path.join(os.path.expanduser('~'), '.cache', 'horseracing', 'video_probe.sqlite')} # metadata of the video files (fps, frame count, resolution, codec, md5), shared by the result directories, see util.video_probe. None to keep them in memory only
+frame_store_capacity = 1 # number of frame sets kept in memory for the tasks of a video, the tasks running at the same time share them
+
+# Frame export (FRAMEEXTRACTOR task)
+frame_export = {
+  'mode': 'images',  # 'images' for one img%06d.jpg per frame, 'video' for one video file per camera segment (main.py --frame_export)
+  'threads': 8,  # number of threads writing the images
+  'fourcc': 'mp4v',  # codec of the video files
+  'extension': 'mp4',  # extension of the video files
+}
+
+# Export of the results (main.py --xlsx / --format), see util.export
+export = {
+  'format': 'xlsx',  # 'xlsx', or the columnar formats 'parquet', 'feather' (need pyarrow) and 'csv.gz' (main.py --format)
+  'workers': 4,  # number of processes exporting the videos (main.py --export_workers)
+  'directories': {'xlsx': 'xlsx_results', 'parquet': 'parquet_results', 'feather': 'feather_results', 'csv.gz': 'csv_results'},  # relative to the result directory
+}
+
+# Race info (track, distance, course and jockeys) from the database, see util.result.get_data_from_database
+race_info = {
+  'cache': 'race_info.sqlite',  # the race info cache, relative to the result directory, or an absolute path to share it between result directories
+  'ttl': 7 * 24 * 3600,  # seconds before a cached race info is queried again
+  'offline': False,  # do not connect to the database, use the cached race info whatever its age (main.py --offline)
+  'source': None,  # json file of race documents (mongoexport --jsonArray of newfullraceinfo) used in place of the database (main.py --race_info)
+  'timeout': 5000,  # ms to wait for the database before using the cached race info
+}
+
+# Segmentation outputs (RAILMASK, RAILPOLEMASK and SEMANTICMASK tasks), see util.mask_container
+mask_storage = {
+  'mode': 'json',  # 'json' keeps the files written by the tasks, 'container' converts them into .rlec files, 'delta' also stores the full frame masks as deltas within the camera segments (main.py --mask_storage)
+  'keyframe_interval': 30,  # maximum number of frames from a keyframe to the next one in the delta storage, i.e. the most deltas applied when reading a frame
+  'keep_json': False,  # keep the json files after converting them
+}
+
+# Multi-video scheduler (main.py --workers N --max-rss GB), used for estimating the RAM a video needs before admitting it
+scheduler = {
+  'base_rss': 6.0,  # GB, RAM taken by a worker process with the models loaded, before any frame is read
+  'frame_rss': 1.0,  # MB, RAM taken per frame of the frame set (encoded frames, masks and intermediate results)
+  'poll_interval': 2,  # seconds between two checks of the running workers
+}
+
+# Loaded models kept across the videos of a process, see util.model_registry
+model_registry = {
+  'max_rss': 8.0,  # GB, the least recently used models are dropped above this (main.py --model_budget)
+}
+
+# Service mode (main.py --serve WATCH_DIR), see util.service
+service = {
+  'poll_interval': 5,  # seconds between two scans of the watch folder
+  'settle_time': 10,  # seconds a video file has to stay unchanged before it is processed, i.e. while it is being copied
+}
+
+# Memory governor, see util.memory_governor. Under memory pressure the oldest frames of Result.frames are moved to disk and the decoding waits, instead of raising MemoryError
+memory = {
+  'spill_below': 0.3,  # fraction of the RAM available under which the frames are spilled to disk
+  'throttle_below': 0.1,  # fraction of the RAM available under which the decoding waits for memory
+  'max_rss': None,  # GB, the frames are spilled when the process takes more than this, None for no limit
+  'max_wait': 60,  # seconds the decoding waits for memory in a period of pressure, it goes on without waiting after it
+  'poll_interval': 0.5,  # seconds between two checks of the memory
+  'spill_dir': None,  # directory of the spilled frames, the temporary directory if None
+}
+
+# Profiling (main.py --profile), see util.profiler
+profiling = {
+  'enabled': False,  # record the wall time, CPU time, peak RAM and frames of every (video, task) and of the stages inside the tasks
+  'sample_interval': 0.1,  # seconds between two samples of the RAM of a process
+  'trace': 'profile_trace.json',  # Chrome trace, relative to the result directory
+  'summary': 'profile_summary.csv',  # one row per stage, relative to the result directory
+}
 
 # Start End Frame - assume race start within 40 seconds of race
 start_min	=	0  # min frame number for start frame
@@ -70,6 +151,7 @@ frame_width 	= 	1920
 frame_height 	= 	1080
 pixelstep 	= 	5
 max_framediff 	= 	1
+mask_threads 	= 	4 # number of threads assembling the masks for optical flow, see util.mask_util.iter_masks_for_homography
 segmentation_model_dir="Segmentation-v1.0.0" # directory for the segmentation model
 
 
@@ -110,8 +192,8 @@ tracking['STAWT'] = STAWTConfig()
 tracking['Kranji'] = KranjiConfig()
 # Detection
 
-# GCN clustering
-gcn_params = {
+# GCN clustering, config.gcn_params with the device, see __getattr__
+_gcn_params = {
     'feat_agg_path': 'Clustering/FeatureAggregation/feat_agg_4227.4553_weight.pth',
     'gcn_path': 'Clustering/GCN/epoch_97_weight.pth',
     'f_dim': 512,  # Feature dimension of triplet model output
@@ -120,7 +202,7 @@ gcn_params = {
     'active_connection':5,  # Number of nearest neighbors for constructing the Instance Pivot Subgraph
     'inp_size': 64,  # Frame will be resized to this size before passing into the triplet model
     'dist_metric': 'l2',  # Distance metric to use for the triplet model
-    'device': device,
+    'device': None,
     'thres': 0.5,  # Minimum matching threshold
     'batch_size': 8,
     'n_workers': 6, #os.cpu_count()-4,
@@ -193,7 +275,7 @@ def get_model_paths(task, model_type):
   return models[task]
 
 
-def get_model_info(model_dir, track, task, distance=None, course=None):
+def get_model_type(track, task):
 
   if task == "Conn":
       model_type = track
@@ -204,10 +286,31 @@ def get_model_info(model_dir, track, task, distance=None, course=None):
       model_type = "Singapore"
   else:
     model_type = track
+  return model_type
 
+
+def get_model_info(model_dir, track, task, distance=None, course=None):
+
+  model_type = get_model_type(track, task)
   model_info = get_model_paths(task, model_type)
   network, mean_path, batch = model_info["network"], model_info["mean"], model_info["batch"]
   network_path = os.path.join(model_dir, network)
   
   return network_path, mean_path, batch
 
+
+def get_device():
+  # use GPU instead of cpu, cpu not recommended
+  import torch
+  return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def __getattr__(name):
+  # the settings that need torch are set on first use, a value set before (i.e. config.device = 'cpu') is kept
+  if name == 'device':
+    globals()['device'] = get_device()
+    return globals()['device']
+  if name == 'gcn_params':
+    globals()['gcn_params'] = dict(_gcn_params, device=globals().get('device') or __getattr__('device'))
+    return globals()['gcn_params']
+  raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,13 +1,30 @@
 import time, argparse, os, config
 import gc
+import traceback
 import multiprocessing as mp
-from util.result import Result
-import torch.multiprocessing
-torch.multiprocessing.set_sharing_strategy('file_system')
+from functools import partial
+from util.result import Result, get_data_from_database
+from util.task_graph import TaskGraphExecutor
+from util.profiler import get_profiler, profile_stage, merge_profiles
+from util.service import WatchFolderService, check_job
 
-from memory_profiler import profile
+task_names = {value: name for name, value in vars(config.Task).items() if not name.startswith('_')} # the names of the tasks in the profiling trace
+
+_torch_ready = False
+
+def setup_torch():
+  # torch is imported by the first task that needs it, not when main is imported (main.py --help, the excel export or the bookkeeping runs). Every process runs it before its first task
+  global _torch_ready
+  if not _torch_ready:
+    import torch.multiprocessing
+    torch.multiprocessing.set_sharing_strategy('file_system')
+    os.environ['HORSERACING_TORCH_SHARING'] = '1' # inherited by the processes started from now on
+    _torch_ready = True
+
+# the processes started by the tasks import main again as __mp_main__ (spawn), they share tensors with the same strategy as the task
+if __name__ == '__mp_main__' and os.environ.get('HORSERACING_TORCH_SHARING'):
+  setup_torch()
 
-#@profile(stream=open('task_functions.log','a'))
 def task_functions(horseracingResult, task):
 
   '''
@@ -22,6 +39,9 @@ def task_functions(horseracingResult, task):
     the task number
   '''
 
+  if task != config.Task.FRAMEEXTRACTOR:
+    setup_torch()
+
   if task == config.Task.FRAMEEXTRACTOR:
     from util import FrameSaver
     FrameSaver.save_frame(horseracingResult)
@@ -49,34 +69,94 @@ def task_functions(horseracingResult, task):
   
   return
 
-#@profile(stream=open('launch_tasks.log','a'))
-def launch_tasks(horseracingResult, tasks):
+def run_task(horseracingResult, task):
+
+  '''
+  Run a single task on the video horseracingResult.processing_vid_name, skip it if the video does not need the task, i.e. the output exists already
+
+  Parameters
+  ----------
+  horseracingResult : object
+    horseracingResult is the class that manage the input arguments such as model_dir, result_dir, track, etc. It is also responsible for the input/output of data.
+  task : int
+    the task number
+  '''
+  horseracingResult.ontask = task # set the ontask to the current task number, 
+  vid_name = horseracingResult.processing_vid_name
+  if vid_name in horseracingResult.selected_vid_names_by_task[horseracingResult.ontask]:
+    # record the status, timing and outputs of the task in the result catalogue
+    horseracingResult.catalogue.task_started(vid_name, task)
+    try:
+      with profile_stage(task_names.get(task, str(task)), vid_name, task):
+        task_functions(horseracingResult, task)
+        if task in (config.Task.RAILMASK, config.Task.RAILPOLEMASK, config.Task.SEMANTICMASK):
+          horseracingResult.store_masks(vid_name, task)
+    except BaseException:
+      horseracingResult.catalogue.task_failed(vid_name, task, traceback.format_exc())
+      raise
+    finally:
+      get_profiler().flush(horseracingResult.result_dir)
+    if task == config.Task.SCENECLASSIFY:
+      horseracingResult.record_scene_classification(vid_name)
+    horseracingResult.catalogue.task_done(vid_name, task)
+    horseracingResult.selected_vid_names_by_task[horseracingResult.ontask].remove(vid_name)
+
+def launch_tasks(horseracingResult, tasks, task_workers=1):
   
   '''
-  Launch the task one by one from the task list
+  Launch the tasks from the task list following the task dependencies in config.dependencies. A task starts once the tasks it depends on are done
   
   Parameters
   ----------
   horseracingResult : object
     horseracingResult is the class that manage the input arguments such as model_dir, result_dir, track, etc. It is also responsible for the input/output of data.  
   tasks : list of int
-    the task list. It gives the tasks to be run in order  
+    the task list
+  task_workers : int
+    the number of tasks that can run at the same time. With 1 worker, the tasks run one by one
   
   Returns
   -------
   horseracingResult : object
     As indicated above
   '''
-  for task in tasks:
-    horseracingResult.ontask = task # set the ontask to the current task number, 
-    if horseracingResult.processing_vid_name in horseracingResult.selected_vid_names_by_task[horseracingResult.ontask]:
-      task_functions(horseracingResult, task)
-      horseracingResult.selected_vid_names_by_task[horseracingResult.ontask].remove(horseracingResult.processing_vid_name)
+  TaskGraphExecutor(run_task, task_workers).run(horseracingResult, tasks)
   # clear frames after use for passing the result object back
-  horseracingResult.frames = None
+  horseracingResult.release_frames()
   return horseracingResult
 
-#@profile(stream=open('run_horseracing.log','a'))
+def run_job(args, job):
+
+  '''
+  Run the tasks on the video of a service job, in this process so the models loaded for the previous videos are used again (see util.service and util.model_registry)
+
+  Parameters
+  ----------
+  args : object
+    the arguments of main.py, the job settings take precedence
+  job : dict
+    {"video_path": ..., "tasks": [...], "track": ..., "distance": ..., "course": ..., "jockeys": [...], "racelabel": ...}, only video_path is required, distance is required with track
+  '''
+  check_job(job)
+  tasks_to_run = list(set([t for task in job.get('tasks', args.tasks) for t in config.dependencies[int(task)]]))
+  horseracingResult = Result(args.result_dir, job['video_path'], args.model_dir, tasks_to_run, job.get('racelabel', ""))
+  if len(horseracingResult.vid_names) == 0:
+    raise ValueError(f"{job['video_path']} is not a video in an accepted format {config.accepted_formats}")
+  vid_name = horseracingResult.vid_names[0]
+  if job.get('track'):
+    horseracingResult.race_info[vid_name] = {"track": job['track'], "distance": int(job['distance']), 'course': job.get('course')}
+    if job.get('jockeys'):
+      horseracingResult.jockeys[vid_name] = [int(j) for j in job['jockeys']]
+  else:
+    horseracingResult.jockeys, horseracingResult.race_info = get_data_from_database([vid_name], os.path.join(args.result_dir, config.race_info['cache']))
+  for vid_name in sorted(horseracingResult.selected_vid_names):
+    horseracingResult.processing_vid_name = vid_name
+    horseracingResult = launch_tasks(horseracingResult, tasks_to_run, args.task_workers)
+  merge_profiles(args.result_dir)
+  if args.xlsx or args.format:
+    horseracingResult.convert_to_excel()
+  gc.collect()
+
 def run_horseracing(args):
 
   '''
@@ -104,6 +184,24 @@ def run_horseracing(args):
   tasks_to_run = list(set([t for task in tasks for t in config.dependencies[int(task)]]))
   print("Runing Tasks: ", tasks_to_run)
   
+  if args.frame_cache:
+    config.frame_cache_dir = args.frame_cache
+  config.frame_codec = args.frame_codec
+  config.frame_export['mode'] = args.frame_export
+  config.mask_storage['mode'] = args.mask_storage
+  config.rescan_results = args.rescan
+  config.race_info['offline'] = args.offline or config.race_info['offline']
+  config.race_info['source'] = args.race_info or config.race_info['source']
+  config.export['format'] = args.format or config.export['format']
+  config.export['workers'] = args.export_workers or config.export['workers']
+  config.model_registry['max_rss'] = args.model_budget or config.model_registry['max_rss']
+  config.profiling['enabled'] = args.profile or config.profiling['enabled']
+
+  if args.serve:
+    # long-running service, the videos are processed in this process and the models stay loaded between them
+    WatchFolderService(args.serve, partial(run_job, args)).run()
+    return
+
   # initiate the result function
   horseracingResult = Result(result_dir, vid_dir, model_dir, tasks_to_run, label)
   
@@ -114,21 +212,25 @@ def run_horseracing(args):
       horseracingResult.jockeys[horseracingResult.vid_names[0]] = [int(j) for j in jockeys]
   horseracingResult.selected_vid_names.sort()
   
-  #pool = mp.get_context("spawn").Pool(processes=(8)) # comment out, for parameter tuning use only
-  for vid_name in horseracingResult.selected_vid_names:
-    print("----------------------- Processing Video: ", vid_name, ' -----------------------')
-    horseracingResult.processing_vid_name = vid_name
-    horseracingResult = launch_tasks(horseracingResult, tasks_to_run)
-    #pool.apply_async(launch_tasks, args=(horseracingResult, tasks_to_run,), callback=None) # comment out, for parameter tuning use only
-    gc.collect()
-    #while len(pool._cache) >= 8: # comment out, for parameter tuning use only
-    #  time.sleep(2) # comment out, for parameter tuning use only
-  
-  #pool.close() # comment out, for parameter tuning use only
-  #pool.join() # comment out, for parameter tuning use only
+  if args.workers > 1:
+    # run several videos in parallel, one process per video, under the RAM budget
+    from util.scheduler import VideoScheduler
+    scheduler = VideoScheduler(partial(launch_tasks, task_workers=args.task_workers), args.workers, args.max_rss, args.retries)
+    failures = scheduler.run(horseracingResult, tasks_to_run)
+    print(f"Processed {len(horseracingResult.selected_vid_names) - len(failures)} videos, {len(failures)} failed: {sorted(failures)}")
+    # the workers update the start/end frames and camera changes in their own copy of the result object, read them back from the catalogue
+    horseracingResult.start_end_frames, horseracingResult.cam_changes = horseracingResult.get_scene_classification_results_from_cache(result_dir)
+  else:
+    for vid_name in horseracingResult.selected_vid_names:
+      print("----------------------- Processing Video: ", vid_name, ' -----------------------')
+      horseracingResult.processing_vid_name = vid_name
+      horseracingResult = launch_tasks(horseracingResult, tasks_to_run, args.task_workers)
+      gc.collect()
+  # the profiles of the processes, see util.profiler
+  merge_profiles(result_dir)
   
-  # output to excel in xlsx format
-  if is_excel:
+  # output to excel in xlsx format, or to the format given by --format
+  if is_excel or args.format:
     horseracingResult.convert_to_excel()
 
 if __name__ == "__main__":
@@ -157,6 +259,22 @@ if __name__ == "__main__":
   parser.add_argument('--jockeys', nargs='+', type=int, help='jockeys in the race', default=[])
   parser.add_argument('--racelabel', type=str, help='Any name specified by the user', default="")
   parser.add_argument('--xlsx', help='Output result as excel files', action='store_true')
+  parser.add_argument('--format', type=str, choices=['xlsx', 'parquet', 'feather', 'csv.gz'], help='export the results in this format, xlsx for excel files or a columnar format for analytics', default=None)
+  parser.add_argument('--export_workers', type=int, help='number of processes exporting the results', default=None)
+  parser.add_argument('--frame_codec', type=str, help='how the frames are kept in memory: raw, png[:level], jpeg[:quality], zlib[:level] or lz4[:level]', default=config.frame_codec)
+  parser.add_argument('--frame_export', type=str, choices=['images', 'video'], help='save the frames as images or as one video per camera segment', default=config.frame_export['mode'])
+  parser.add_argument('--mask_storage', type=str, choices=['json', 'container', 'delta'], help='how the segmentation masks are stored: as json, as random-access containers, or as containers with deltas between frames', default=config.mask_storage['mode'])
+  parser.add_argument('--offline', help='do not connect to the race info database, use the cached race info', action='store_true')
+  parser.add_argument('--race_info', type=str, help='json file of race documents used in place of the race info database', default=None)
+  parser.add_argument('--rescan', help='fill the result catalogue again from the files of the result directory, i.e. for outputs copied in by hand. Outputs removed by hand are found without it', action='store_true')
+  parser.add_argument('--frame_cache', type=str, help='the dir for caching the decoded frames across runs', default=None)
+  parser.add_argument('--task_workers', type=int, help='number of independent tasks of a video run at the same time', default=1)
+  parser.add_argument('--workers', type=int, help='number of videos processed in parallel', default=1)
+  parser.add_argument('--max_rss', '--max-rss', type=float, help='RAM budget in GB shared by the parallel workers, default 80%% of the total RAM', default=None)
+  parser.add_argument('--retries', type=int, help='number of times a failed video is retried when running with --workers', default=1)
+  parser.add_argument('--profile', help='record the time, CPU, RAM and frames of every task and stage into profile_trace.json (Chrome trace) and profile_summary.csv in the result directory', action='store_true')
+  parser.add_argument('--serve', type=str, help='run as a service processing the videos and json jobs dropped into this folder, the models stay loaded between the videos', default=None)
+  parser.add_argument('--model_budget', type=float, help='RAM budget in GB of the models kept loaded, the least recently used models are dropped above it', default=None)
   
   args = parser.parse_args()
   run_horseracing(args)
\ No newline at end of file
@@ -0,0 +1,218 @@
+'''
+Check util.mask_algebra against the dense operations it replaces: pycocotools.mask.encode/decode for the counts, numpy slicing for crop and embed, cv2.dilate for dilate.
+
+Usage
+-----
+python -m pytest tests
+'''
+
+import unittest
+import numpy as np
+import cv2
+import pycocotools.mask as mask_save_tool
+from util import mask_algebra
+
+
+def encode(mask):
+    return mask_save_tool.encode(np.asfortranarray(mask.astype(np.uint8)))
+
+
+def decode(rle):
+    return np.asarray(mask_save_tool.decode(rle), dtype=np.uint8)
+
+
+def from_runs(runs, size):
+    # the dense mask of shape size (height, width) of run lengths, in the column-major order of COCO RLE
+    values = np.arange(len(runs)) % 2
+    return np.repeat(values, runs).astype(np.uint8).reshape(size[1], size[0]).T
+
+
+def sample_masks(rng, size=(48, 64)):
+    # the masks of the tests: the edge cases and random masks of different densities
+    height, width = size
+    masks = {'empty': np.zeros(size, np.uint8), 'full': np.ones(size, np.uint8)}
+    border = np.zeros(size, np.uint8)
+    border[0, :] = border[-1, :] = border[:, 0] = border[:, -1] = 1
+    masks['border'] = border
+    corners = np.zeros(size, np.uint8)
+    corners[0, 0] = corners[-1, -1] = corners[0, -1] = corners[-1, 0] = 1
+    masks['corners'] = corners
+    masks['first_column'] = np.pad(np.ones((height, 1), np.uint8), ((0, 0), (0, width - 1)))
+    masks['last_pixel'] = np.zeros(size, np.uint8)
+    masks['last_pixel'][-1, -1] = 1
+    for density in [0.02, 0.5, 0.98]:
+        masks[f'noise_{density}'] = (rng.random(size) < density).astype(np.uint8)
+    blobs = np.zeros(size, np.uint8)
+    for _ in range(6):
+        y, x = rng.integers(-5, height), rng.integers(-5, width)
+        blobs[max(y, 0):y + rng.integers(1, 20), max(x, 0):x + rng.integers(1, 20)] = 1
+    masks['blobs'] = blobs
+    return masks
+
+
+class TestCounts(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def test_decode_counts(self):
+        for name, mask in sample_masks(self.rng).items():
+            rle = encode(mask)
+            runs = mask_algebra.decode_counts(rle['counts'])
+            self.assertEqual(runs.sum(), mask.size, name)
+            np.testing.assert_array_equal(from_runs(runs, mask.shape), mask, err_msg=name)
+
+    def test_encode_counts(self):
+        for name, mask in sample_masks(self.rng).items():
+            rle = encode(mask)
+            self.assertEqual(mask_algebra.encode_counts(mask_algebra.decode_counts(rle['counts'])), rle['counts'], name)
+
+    def test_large_runs(self):
+        # runs of several 5 bit chunks and negative differences between runs
+        mask = np.zeros((1080, 1920), np.uint8)
+        mask[100:900, 50:1800] = 1
+        mask[5, 3] = 1
+        mask[:, 1900:] = 1
+        rle = encode(mask)
+        runs = mask_algebra.decode_counts(rle['counts'])
+        np.testing.assert_array_equal(from_runs(runs, mask.shape), mask)
+        self.assertEqual(mask_algebra.encode_counts(runs), rle['counts'])
+
+    def test_empty_counts(self):
+        self.assertEqual(len(mask_algebra.decode_counts(b'')), 0)
+
+    def test_xor_transitions(self):
+        masks = list(sample_masks(self.rng).values())
+        for a in masks:
+            for b in masks:
+                ta = mask_algebra.transitions(mask_algebra.decode_counts(encode(a)['counts']))
+                tb = mask_algebra.transitions(mask_algebra.decode_counts(encode(b)['counts']))
+                runs = mask_algebra.from_transitions(mask_algebra.xor_transitions(ta, tb), a.size)
+                np.testing.assert_array_equal(from_runs(runs, a.shape), a ^ b)
+
+
+class TestAlgebra(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(1)
+        self.masks = sample_masks(self.rng)
+
+    def test_merge_intersect(self):
+        masks = list(self.masks.values())
+        rles = [encode(m) for m in masks]
+        np.testing.assert_array_equal(decode(mask_algebra.merge(rles)), np.logical_or.reduce(masks).astype(np.uint8))
+        np.testing.assert_array_equal(decode(mask_algebra.intersect(rles[-3:])), np.logical_and.reduce(masks[-3:]).astype(np.uint8))
+
+    def test_area_bbox(self):
+        for name, mask in self.masks.items():
+            rle = encode(mask)
+            self.assertEqual(mask_algebra.area(rle), mask.sum(), name)
+            np.testing.assert_array_equal(mask_algebra.to_bbox(rle), mask_save_tool.toBbox(rle), err_msg=name)
+
+    def test_decode(self):
+        for name, mask in self.masks.items():
+            np.testing.assert_array_equal(mask_algebra.decode(encode(mask)), mask, err_msg=name)
+
+    def test_crop(self):
+        height, width = 48, 64
+        bboxes = [[0, 0, width, height], [5, 7, 20, 11], [0, 0, 1, 1], [width - 1, height - 1, 1, 1], [0, 13, width, 9], [30, 0, 7, height], [35, 35, width - 70 + 35, height - 70 + 35]]
+        for name, mask in self.masks.items():
+            for x, y, w, h in bboxes:
+                cropped = mask_algebra.crop(encode(mask), [x, y, w, h])
+                self.assertEqual(list(cropped['size']), [h, w])
+                expected = np.zeros((h, w), np.uint8)
+                part = mask[y:y + h, x:x + w]
+                expected[:part.shape[0], :part.shape[1]] = part
+                np.testing.assert_array_equal(decode(cropped), expected, err_msg=f"{name} {x, y, w, h}")
+
+    def test_crop_outside(self):
+        # the part of the bbox outside of the mask is background
+        mask = self.masks['full']
+        cropped = decode(mask_algebra.crop(encode(mask), [-3, -2, 10, 6]))
+        expected = np.zeros((6, 10), np.uint8)
+        expected[2:, 3:] = 1
+        np.testing.assert_array_equal(cropped, expected)
+
+    def test_embed(self):
+        size = (60, 80)
+        for name, mask in self.masks.items():
+            small = mask[:20, :30]
+            for x, y in [(0, 0), (50, 40), (60, 45), (-5, -3), (79, 59), (-29, -19)]:
+                expected = np.zeros(size, np.uint8)
+                ys, xs = slice(max(y, 0), min(y + 20, size[0])), slice(max(x, 0), min(x + 30, size[1]))
+                expected[ys, xs] = small[ys.start - y:ys.stop - y, xs.start - x:xs.stop - x]
+                embedded = mask_algebra.embed(encode(small), [x, y], size)
+                np.testing.assert_array_equal(decode(embedded), expected, err_msg=f"{name} {x, y}")
+
+    def test_crop_embed(self):
+        # the border of the homography masks, see util.mask_util._homography_rle
+        height, width = 1080, 1920
+        mask = np.zeros((height, width), np.uint8)
+        mask[:, :100] = 1
+        mask[500:, 1000:] = 1
+        mask[20:40, 20:1900] = 1
+        border = 35
+        rle = mask_algebra.embed(mask_algebra.crop(encode(mask), [border, border, width - 2 * border, height - 2 * border]), [border, border], [height, width])
+        expected = np.zeros_like(mask)
+        expected[border:height - border, border:width - border] = mask[border:height - border, border:width - border]
+        np.testing.assert_array_equal(decode(rle), expected)
+
+    def test_dilate(self):
+        for name, mask in self.masks.items():
+            for kernel in [(1, 1), (2, 2), (3, 3), (4, 7), (7, 4), (5, 2), (18, 18), (80, 3)]:
+                expected = cv2.dilate(mask, np.ones(kernel[::-1], np.uint8))
+                np.testing.assert_array_equal(decode(mask_algebra.dilate(encode(mask), kernel)), expected, err_msg=f"{name} {kernel}")
+
+    def test_dilate_frame(self):
+        # a rail mask at the size of the frames, with the kernel of the homography masks
+        mask = np.zeros((1080, 1920), np.uint8)
+        cv2.line(mask, (0, 1079), (1919, 600), 1, 5)
+        cv2.circle(mask, (1910, 5), 30, 1, -1)
+        expected = cv2.dilate(mask, np.ones((18, 18), np.uint8))
+        np.testing.assert_array_equal(decode(mask_algebra.dilate(encode(mask), (18, 18))), expected)
+
+
+def dense_homography_mask(rail_mask_string, rail_pole_mask_data, seg_mask_data, frame_size=(1920, 1080)):
+    # the dense assembly of the homography mask replaced by util.mask_util._homography_rle
+    width, height = frame_size
+    kernel = np.ones((18, 18), np.uint8)
+    mask = np.zeros((height, width), bool)
+    m = decode({'size': [height, width], 'counts': rail_mask_string.encode()})
+    mask |= cv2.dilate(m, kernel).astype(bool)
+    for data in rail_pole_mask_data:
+        x, y, w, h = data['bbox']
+        m = decode({'size': [h, w], 'counts': data['rle_string'].encode()})
+        mask[y:y + h, x:x + w] |= cv2.dilate(m, kernel).astype(bool)[:height - y, :width - x]
+    for data in seg_mask_data:
+        if data['object_id'] in [0, 3]:
+            m = decode({'size': [height, width], 'counts': data['rle_string'].encode()}).astype(bool)
+            mask[35:height - 35, 35:width - 35] |= m[35:height - 35, 35:width - 35]
+    return mask
+
+
+class TestHomographyMask(unittest.TestCase):
+
+    def test_homography_mask(self):
+        from util.mask_util import _homography_mask
+        rng = np.random.default_rng(2)
+        height, width = 1080, 1920
+        rail = np.zeros((height, width), np.uint8)
+        cv2.line(rail, (0, 900), (1919, 700), 1, 4)
+        rail[:3, :] = 1 # touches the border
+        poles = []
+        for x, y, w, h in [(100, 200, 30, 300), (0, 0, 25, 40), (1900, 1050, 20, 30), (960, 500, 1, 1)]:
+            pole = (rng.random((h, w)) < 0.3).astype(np.uint8)
+            poles.append({'bbox': [x, y, w, h], 'rle_string': encode(pole)['counts'].decode()})
+        segs = []
+        for object_id in range(5):
+            seg = np.zeros((height, width), np.uint8)
+            seg[rng.integers(0, height):, rng.integers(0, width):] = 1
+            seg[:50, :50] = object_id % 2
+            segs.append({'object_id': object_id, 'rle_string': encode(seg)['counts'].decode()})
+        rail_string = encode(rail)['counts'].decode()
+        for pole_data, seg_data in [(poles, segs), ([], []), (poles[:1], segs[:1])]:
+            np.testing.assert_array_equal(_homography_mask(rail_string, pole_data, seg_data), dense_homography_mask(rail_string, pole_data, seg_data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+'''
+Round trip of the segmentation outputs through the .rlec container (util.mask_container): every frame read from the container is the same as in the json content,
+with the full frame masks stored as keyframes and xor deltas within the camera segments, and for the files of version 1 (without deltas).
+
+Usage
+-----
+python -m pytest tests
+'''
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pycocotools.mask as mask_save_tool
+from util import mask_container
+from util.mask_container import write_container, MaskContainer, open_rle, get_frame_objects
+
+size = (30, 40) # height, width of the masks
+segments = [(0, 9), (10, 24), (30, 39)] # the frames 25 to 29 are outside of the camera segments
+frames = [frame for frame in range(40) if frame != 17] # a frame without output
+
+
+def rle_string(mask):
+    return mask_save_tool.encode(np.asfortranarray(mask.astype(np.uint8)))['counts'].decode()
+
+
+def band(top, height, jitter=None):
+    # a band of rows, the rail masks move a little from a frame to the next
+    mask = np.zeros(size, np.uint8)
+    mask[top:top + height] = 1
+    if jitter is not None:
+        mask[jitter] ^= 1
+    return mask
+
+
+def make_data(seed=0):
+    # the json content of a rail mask (a string per frame) and of a semantic mask (a list of objects per frame)
+    rng = np.random.default_rng(seed)
+    rail, semantic = {'start_frame': frames[0], 'finish_frame': frames[-1]}, {'start_frame': frames[0], 'finish_frame': frames[-1]}
+    for frame in frames:
+        # identical masks for a few frames in a row (empty deltas), then a move
+        rail['frame_%d' % frame] = rle_string(band(5 + frame // 4, 6))
+
+        objects = []
+        if frame == 8:
+            mask = np.zeros(size, np.uint8) # an empty mask
+        elif frame == 9:
+            mask = np.ones(size, np.uint8) # a full mask
+        else:
+            mask = band(10 + frame % 3, 8, (rng.integers(0, size[0]), rng.integers(0, size[1])))
+        objects.append({'object_id': 0, 'rle_string': rle_string(mask)})
+        if 5 <= frame < 20 or frame >= 28: # an object that disappears and appears again
+            objects.append({'object_id': 1, 'rle_string': rle_string(band(frame % 5, 3))})
+        objects.append({'object_id': 2, 'rle_string': rle_string(band(20, 4)), 'score': 0.5}) # the same mask in every frame, with an extra key
+        if frame % 2 == 0: # a mask inside of a bbox, never stored as a delta
+            objects.append({'object_id': 3, 'bbox': [3, 4, 10, 6], 'mask_size': [6, 10], 'rle_string': rle_string(rng.random((6, 10)) < 0.5)})
+        if frame == 12: # two records of the same object in a frame
+            objects.append({'object_id': 0, 'rle_string': rle_string(band(0, 2))})
+        semantic['frame_%d' % frame] = objects
+    return {'target_frame_size': [size[1], size[0]], 'data': rail}, {'object_name_list': ['background', 'rail'], 'data': semantic}
+
+
+def downgrade(path, out_path):
+    # rewrite a container without deltas as a file of version 1, whose records have no base field
+    with open(path, 'rb') as f:
+        content = f.read()
+    magic, version, header_length = mask_container._header.unpack_from(content)
+    header = json.loads(content[mask_container._header.size:mask_container._header.size + header_length])
+    offset = mask_container._header.size + header_length
+    arrays = []
+    for dtype, count in [(np.int64, header['frames']), (np.uint8, header['frames']), (np.int32, header['objects']),
+                         (np.uint64, header['objects'] * (header['frames'] + 1)), (mask_container._record_dtypes[version], header['records'])]:
+        array = np.frombuffer(content, dtype=dtype, count=count, offset=offset)
+        offset += array.nbytes + (-array.nbytes % 8)
+        arrays.append(array)
+    records = np.zeros(len(arrays[-1]), dtype=mask_container._record_dtypes[1])
+    for name in records.dtype.names:
+        records[name] = arrays[-1][name]
+    with open(out_path, 'wb') as f:
+        f.write(mask_container._header.pack(magic, 1, header_length))
+        f.write(content[mask_container._header.size:mask_container._header.size + header_length])
+        for array in arrays[:-1] + [records]:
+            f.write(array.tobytes())
+            f.write(b'\0' * (-array.nbytes % 8))
+        f.write(content[offset:])
+
+
+class TestMaskContainer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rail, self.semantic = make_data()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, rle_data, name, segments=None, keyframe_interval=4):
+        path = os.path.join(self.tmp_dir, name + mask_container.EXTENSION)
+        write_container(rle_data, path, segments, keyframe_interval)
+        return MaskContainer(path)
+
+    def assertSameContent(self, container, rle_data, order=None):
+        data = rle_data['data']
+        self.assertEqual({key: value for key, value in container.items() if key != 'data'}, {key: value for key, value in rle_data.items() if key != 'data'})
+        self.assertEqual(sorted(container['data']), sorted(data))
+        for frame in order if order is not None else frames:
+            key = 'frame_%d' % frame
+            self.assertIn(key, container['data'])
+            self.assertEqual(container['data'][key], data[key], key)
+        self.assertNotIn('frame_17', container['data'])
+        self.assertEqual(container['data']['start_frame'], data['start_frame'])
+
+    def chain_lengths(self, container):
+        # the number of deltas applied to read every record
+        records = container._records
+        lengths = []
+        for r in range(len(records)):
+            length = 0
+            while records[r]['flags'] & mask_container._IS_DELTA:
+                r = int(records[r]['base'])
+                length += 1
+            lengths.append(length)
+        return np.array(lengths)
+
+    def test_round_trip(self):
+        for rle_data, name in [(self.rail, 'rail'), (self.semantic, 'semantic')]:
+            container = self.write(rle_data, name)
+            self.assertFalse(np.any(container._records['flags'] & mask_container._IS_DELTA))
+            self.assertSameContent(container, rle_data)
+            container.close()
+
+    def test_delta_round_trip(self):
+        for rle_data, name in [(self.rail, 'rail'), (self.semantic, 'semantic')]:
+            for keyframe_interval in [1, 2, 4, 30]:
+                container = self.write(rle_data, name, segments, keyframe_interval)
+                lengths = self.chain_lengths(container)
+                if keyframe_interval > 1:
+                    self.assertGreater(lengths.max(), 0, f"{name} stores no delta")
+                self.assertLessEqual(lengths.max(), keyframe_interval - 1)
+                # in order, backward and at random, the cache of the decoded deltas must not change the masks
+                self.assertSameContent(container, rle_data)
+                self.assertSameContent(container, rle_data, frames[::-1])
+                self.assertSameContent(container, rle_data, np.random.default_rng(keyframe_interval).permutation(frames).tolist())
+                container.close()
+
+    def test_segment_boundaries(self):
+        # a keyframe at the start of every segment, no delta outside of the segments or across the missing frame
+        container = self.write(self.rail, 'rail', segments, 30)
+        deltas = {int(container.frame_numbers[f]): bool(container._records[f]['flags'] & mask_container._IS_DELTA) for f in range(len(container.frame_numbers))}
+        for first, last in segments:
+            self.assertFalse(deltas[first])
+        for frame in [18] + list(range(25, 30)):
+            self.assertFalse(deltas[frame], frame)
+        self.assertTrue(any(deltas[frame] for frame in range(1, 10)))
+        container.close()
+
+    def test_objects(self):
+        container = self.write(self.semantic, 'semantic', segments, 4)
+        data = self.semantic['data']
+        for frame in frames:
+            for object_id in range(5):
+                expected = [obj for obj in data['frame_%d' % frame] if obj['object_id'] == object_id]
+                self.assertEqual(get_frame_objects(container['data'], frame, object_id), expected, (frame, object_id))
+        container.close()
+
+    def test_version_1(self):
+        for rle_data, name in [(self.rail, 'rail'), (self.semantic, 'semantic')]:
+            self.write(rle_data, name).close()
+            path = os.path.join(self.tmp_dir, name + mask_container.EXTENSION)
+            downgrade(path, path + '.v1')
+            with open(path + '.v1', 'rb') as f:
+                self.assertEqual(mask_container._header.unpack_from(f.read(mask_container._header.size))[1], 1)
+            container = MaskContainer(path + '.v1')
+            self.assertSameContent(container, rle_data)
+            container.close()
+
+    def test_open_rle(self):
+        json_path = os.path.join(self.tmp_dir, 'semantic.json')
+        with open(json_path, 'w') as f:
+            json.dump(self.semantic, f)
+        self.assertEqual(open_rle(json_path), self.semantic)
+        mask_container.convert_rle_json(json_path, segments=segments, keyframe_interval=4)
+        container = open_rle(json_path)
+        self.assertIsInstance(container, MaskContainer)
+        self.assertSameContent(container, self.semantic)
+        container.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
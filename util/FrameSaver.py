@@ -1,7 +1,61 @@
 import os
 import cv2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from util.image_util import decode_img
+import config
+from util.image_util import JpegCodec, decode_img
+from util.profiler import profile_stage
+
+def _write_bytes(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def _write_frame(path, frame):
+    # the frames kept as JPEG in memory are written as they are, without decoding and encoding them again
+    if isinstance(frame, bytes) and frame[:len(JpegCodec.magic)] == JpegCodec.magic:
+        _write_bytes(path, frame)
+    else:
+        cv2.imwrite(path, decode_img(frame))
+
+def _save_images(frames, frame_out_dir, start_frame):
+    # write the frames with a bounded number of frames waiting for the writing threads, so the memory stays bounded while streaming
+    threads = config.frame_export['threads']
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="frame_saver") as pool:
+        for frame_idx, frame in enumerate(frames, start_frame):
+            pending.append(pool.submit(_write_frame, os.path.join(frame_out_dir, 'img%06d.jpg') % frame_idx, frame))
+            if len(pending) >= 2 * threads:
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+
+def _save_videos(horseracingResult, frames, frame_out_dir, start_frame):
+    # write one video file per camera segment, named by the first and the last frame of the segment. The frames during the camera changes are skipped
+    vid_name = horseracingResult.processing_vid_name
+    fps = horseracingResult.get_fps(vid_name)
+    fourcc = cv2.VideoWriter_fourcc(*config.frame_export['fourcc'])
+    segments = horseracingResult.get_camera_segments(vid_name)
+    segment, writer = 0, None
+    try:
+        for frame_idx, frame in enumerate(frames, start_frame):
+            while segment < len(segments) and frame_idx > segments[segment][1]:
+                if writer is not None:
+                    writer.release()
+                    writer = None
+                segment += 1
+            if segment == len(segments):
+                break
+            if frame_idx < segments[segment][0]:
+                continue
+            frame = decode_img(frame)
+            if writer is None:
+                path = os.path.join(frame_out_dir, 'segment_%06d_%06d.%s' % (*segments[segment], config.frame_export['extension']))
+                writer = cv2.VideoWriter(path, fourcc, fps, (frame.shape[1], frame.shape[0]))
+            writer.write(frame)
+    finally:
+        if writer is not None:
+            writer.release()
 
 def save_frame(horseracingResult):
     result_dir = horseracingResult.result_dir
@@ -12,9 +66,22 @@ def save_frame(horseracingResult):
       os.makedirs(frame_out_dir)
 
     start_frame, end_frame = horseracingResult.start_end_frames[vid_name]
-    horseracingResult.load_frames(vid_name, start_frame, end_frame)
-    
-    for i, frame in enumerate(horseracingResult.frames):
-        frame_idx = i + start_frame
-        frame = decode_img(frame)
-        cv2.imwrite(os.path.join(frame_out_dir, 'img%06d.jpg') % frame_idx, frame)
+
+    # use the frames in memory if another task loaded them already, otherwise stream the frames instead of loading the whole race into memory
+    streaming = not horseracingResult.has_frames(vid_name, start_frame, end_frame)
+    if streaming:
+      frames = horseracingResult.stream_frames(vid_name, start_frame, end_frame)
+    else:
+      horseracingResult.load_frames(vid_name, start_frame, end_frame)
+      frames = horseracingResult.frames
+
+    try:
+      # the frames are decoded while they are written when streaming
+      with profile_stage('write', frames=end_frame - start_frame + 1):
+        if config.frame_export['mode'] == 'video':
+          _save_videos(horseracingResult, frames, frame_out_dir, start_frame)
+        else:
+          _save_images(frames, frame_out_dir, start_frame)
+    finally:
+      if streaming: # stop decoding the stream, the frames in memory are shared with the other tasks
+        frames.close()
@@ -0,0 +1,326 @@
+import os
+import csv
+import time
+import sqlite3
+import threading
+import config
+from util.video_probe import file_md5
+
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS videos (
+    vid_name TEXT PRIMARY KEY,
+    start_frame INTEGER,
+    end_frame INTEGER,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS camera_changes (
+    vid_name TEXT,
+    idx INTEGER,
+    start_frame INTEGER,
+    end_frame INTEGER,
+    PRIMARY KEY (vid_name, idx)
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    vid_name TEXT,
+    task INTEGER,
+    status TEXT,
+    started REAL,
+    finished REAL,
+    duration REAL,
+    pid INTEGER,
+    error TEXT,
+    PRIMARY KEY (vid_name, task)
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    vid_name TEXT,
+    task INTEGER,
+    path TEXT,
+    size INTEGER,
+    checksum TEXT,
+    PRIMARY KEY (vid_name, task, path)
+);
+CREATE INDEX IF NOT EXISTS tasks_by_status ON tasks (task, status);
+'''
+
+RUNNING, DONE, FAILED = 'running', 'done', 'failed'
+
+
+def read_scene_classification_csv(result_dir, vid_names=None):
+
+    '''
+    read the start/end frames and the camera changes from vid_process.csv and camera_change.csv, as written by the scene classification
+
+    Parameters
+    ----------
+    result_dir : string
+        the directory of the output
+    vid_names : list of string
+        read only these videos, all the videos if None
+
+    Returns
+    -------
+    start_end_frames : dict
+        video name: [start frame, end frame]
+    cam_changes : dict
+        video name: [[start, end], ...] of the camera changes
+    '''
+
+    start_end_frames, cam_changes = {}, {}
+    path = os.path.join(result_dir, config.video_processer_save_path)
+    if os.path.exists(path):
+        with open(path, "r") as video_preprocess_file:
+            for sef in list(csv.reader(video_preprocess_file, delimiter=","))[1:]:
+                if vid_names is None or sef[0] in vid_names:
+                    start_end_frames[sef[0]] = [int(sef[-2]), int(sef[-1])]
+    path = os.path.join(result_dir, config.camerachange_save_path)
+    if os.path.exists(path):
+        with open(path, "r") as cam_change_file:
+            for did, data in enumerate(csv.reader(cam_change_file, delimiter=",")):
+                if did > 0 and (vid_names is None or data[0] in vid_names):
+                    cam_changes[data[0]] = [[int(data[i]),int(data[i+1])] for i in range(1,len(data),2)]
+    return start_end_frames, cam_changes
+
+
+def task_directories(result_dir, task):
+    # the directories holding one output per video for a task, the tracking task is done once the final result exists (see Result.select_vid_names before the catalogue)
+    directories = []
+    for directory in [os.path.join(result_dir, d) for d in config.directories[task].values()]:
+        if directory.split(os.sep)[-1] != config.directories[config.Task.TRACKING]['ROOT']:
+            if directory.split(os.sep)[-2] == 'Track_Cap' and directory.split(os.sep)[-1] != 'final_result':
+                continue
+            directories.append(directory)
+    return directories
+
+
+def video_of_output(name):
+    ''' the video name of an output file, i.e. [video name]&[label].json '''
+    return name.split(".")[0].split("&")[0]
+
+
+class ResultCatalogue:
+
+    '''
+    Catalogue of the results in a SQLite file of the result directory: the start/end frames and camera changes of the videos, the status and timings of the tasks per video and their output files.
+    The file is opened in WAL mode so the parallel workers (util.scheduler) and the task threads (util.task_graph) read and write it at the same time, every write is a transaction.
+
+    Which videos are done for a task is a query instead of listing the task directories. The catalogue is filled from vid_process.csv, camera_change.csv and the task directories the first time it is opened, or again with rescan
+
+    Parameters
+    ----------
+    result_dir : string
+        the directory of the output
+    rescan : bool
+        fill the catalogue again from the files, see rescan
+    timeout : float
+        seconds to wait for a write lock held by another process
+    '''
+
+    def __init__(self, result_dir, rescan=False, timeout=60):
+        self.result_dir = result_dir
+        self.path = os.path.join(result_dir, config.catalogue_save_path)
+        self.timeout = timeout
+        self._local = threading.local() # one connection per thread
+        self._connect().executescript(_schema) # executescript commits by itself
+        if rescan or self._meta('scanned') is None:
+            self.rescan()
+
+    def __getstate__(self):
+        # the connections are not sent to other processes, a copy opens its own
+        return {'result_dir': self.result_dir, 'path': self.path, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    class _Transaction:
+        def __init__(self, conn):
+            self.conn = conn
+
+        def __enter__(self):
+            self.conn.execute('BEGIN IMMEDIATE') # take the write lock at the start, so two writers never deadlock on a lock upgrade
+            return self.conn
+
+        def __exit__(self, exc_type, exc, tb):
+            self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+    def _transaction(self):
+        return self._Transaction(self._connect())
+
+    def _meta(self, key):
+        row = self._connect().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def rescan(self, tasks=None):
+
+        '''
+        fill the catalogue from the csv files of the scene classification and the files in the task directories, i.e. for a result directory created before the catalogue
+
+        Parameters
+        ----------
+        tasks : list of int
+            the tasks to scan, all the tasks of config.directories if None
+        '''
+
+        start_end_frames, cam_changes = read_scene_classification_csv(self.result_dir)
+        for vid_name in set(start_end_frames) | set(cam_changes):
+            self.set_scene_classification(vid_name, start_end_frames.get(vid_name), cam_changes.get(vid_name))
+
+        for task in tasks or [task for task in config.directories if config.directories[task]]:
+            directories = [d for d in task_directories(self.result_dir, task) if os.path.isdir(d)]
+            if not directories:
+                continue
+            files = {d: os.listdir(d) for d in directories}
+            # a video is done when every directory of the task has an output for it
+            done = set.intersection(*[set(video_of_output(name) for name in names) for names in files.values()])
+            missing = self.done_videos(task) - done # the outputs were removed
+            now = time.time()
+            with self._transaction() as conn:
+                for vid_name in missing:
+                    conn.execute('DELETE FROM tasks WHERE vid_name = ? AND task = ?', (vid_name, task))
+                    conn.execute('DELETE FROM outputs WHERE vid_name = ? AND task = ?', (vid_name, task))
+                for vid_name in done:
+                    conn.execute('INSERT OR IGNORE INTO tasks (vid_name, task, status, finished) VALUES (?, ?, ?, ?)', (vid_name, task, DONE, now))
+                    conn.execute('UPDATE tasks SET status = ? WHERE vid_name = ? AND task = ?', (DONE, vid_name, task))
+                conn.executemany('INSERT OR IGNORE INTO outputs (vid_name, task, path) VALUES (?, ?, ?)',
+                                 [(video_of_output(name), task, os.path.join(d, name)) for d, names in files.items() for name in names if video_of_output(name) in done])
+
+        with self._transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('scanned', str(time.time())))
+
+    def scene_classification(self):
+
+        '''
+        Returns
+        -------
+        start_end_frames : dict
+            video name: [start frame, end frame]
+        cam_changes : dict
+            video name: [[start, end], ...] of the camera changes
+        '''
+
+        conn = self._connect()
+        start_end_frames = {vid_name: [start, end] for vid_name, start, end in conn.execute('SELECT vid_name, start_frame, end_frame FROM videos WHERE start_frame IS NOT NULL')}
+        cam_changes = {}
+        for vid_name, start, end in conn.execute('SELECT vid_name, start_frame, end_frame FROM camera_changes ORDER BY vid_name, idx'):
+            cam_changes.setdefault(vid_name, [])
+            if start is not None:
+                cam_changes[vid_name].append([start, end])
+        return start_end_frames, cam_changes
+
+    def set_scene_classification(self, vid_name, start_end_frames=None, cam_changes=None):
+
+        '''
+        store the start/end frames and the camera changes of a video
+
+        Parameters
+        ----------
+        vid_name : string
+        start_end_frames : list of int
+            [start frame, end frame], not changed if None
+        cam_changes : list of list of int
+            [[start, end], ...], not changed if None. An empty list records a video without camera change
+        '''
+
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO videos (vid_name) VALUES (?)', (vid_name,))
+            if start_end_frames is not None:
+                conn.execute('UPDATE videos SET start_frame = ?, end_frame = ?, updated = ? WHERE vid_name = ?', (int(start_end_frames[0]), int(start_end_frames[1]), time.time(), vid_name))
+            if cam_changes is not None:
+                conn.execute('DELETE FROM camera_changes WHERE vid_name = ?', (vid_name,))
+                # a row without frames marks the camera changes as known for a video without camera change
+                rows = [(vid_name, idx, int(start), int(end)) for idx, (start, end) in enumerate(cam_changes)] or [(vid_name, -1, None, None)]
+                conn.executemany('INSERT INTO camera_changes (vid_name, idx, start_frame, end_frame) VALUES (?, ?, ?, ?)', rows)
+
+    def done_videos(self, task, vid_names=None):
+
+        '''
+        the set of videos with the task done
+
+        Parameters
+        ----------
+        task : int
+        vid_names : list of string
+            check that the recorded outputs of these videos still exist, the videos whose outputs were removed (i.e. by hand) are not done anymore.
+            No file is checked if None
+
+        Returns
+        -------
+        videos : set of string
+        '''
+
+        conn = self._connect()
+        done = set(row[0] for row in conn.execute('SELECT vid_name FROM tasks WHERE task = ? AND status = ?', (task, DONE)))
+        if vid_names is None:
+            return done
+        checked = done & set(vid_names)
+        outputs = {}
+        for vid_name, path in conn.execute('SELECT o.vid_name, o.path FROM outputs o JOIN tasks t ON o.vid_name = t.vid_name AND o.task = t.task WHERE o.task = ? AND t.status = ?', (task, DONE)):
+            if vid_name in checked:
+                outputs.setdefault(vid_name, []).append(path)
+        removed = sorted(vid_name for vid_name, paths in outputs.items() if not all(os.path.exists(path) for path in paths))
+        if removed:
+            print(f"The outputs of task {task} were removed for {removed}, the task runs again")
+            with self._transaction() as conn:
+                for vid_name in removed:
+                    conn.execute('DELETE FROM tasks WHERE vid_name = ? AND task = ?', (vid_name, task))
+                    conn.execute('DELETE FROM outputs WHERE vid_name = ? AND task = ?', (vid_name, task))
+        return done - set(removed)
+
+    def task_started(self, vid_name, task):
+        with self._transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO tasks (vid_name, task, status, started, pid) VALUES (?, ?, ?, ?, ?)', (vid_name, task, RUNNING, time.time(), os.getpid()))
+
+    def task_failed(self, vid_name, task, error):
+        with self._transaction() as conn:
+            conn.execute('UPDATE tasks SET status = ?, finished = ?, duration = ? - started, error = ? WHERE vid_name = ? AND task = ?', (FAILED, time.time(), time.time(), error, vid_name, task))
+
+    def task_done(self, vid_name, task, checksum=True):
+
+        '''
+        mark a task as done for a video and record its outputs, i.e. the files of the video in the task directories
+
+        Parameters
+        ----------
+        vid_name : string
+        task : int
+        checksum : bool
+            compute the md5 of the output files
+        '''
+
+        outputs = []
+        for directory in task_directories(self.result_dir, task):
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if video_of_output(name) == vid_name:
+                    path = os.path.join(directory, name)
+                    is_file = os.path.isfile(path)
+                    outputs.append((vid_name, task, path, os.path.getsize(path) if is_file else None, file_md5(path) if is_file and checksum else None))
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO tasks (vid_name, task, started) VALUES (?, ?, ?)', (vid_name, task, now))
+            conn.execute('UPDATE tasks SET status = ?, finished = ?, duration = ? - started, error = NULL WHERE vid_name = ? AND task = ?', (DONE, now, now, vid_name, task))
+            conn.execute('DELETE FROM outputs WHERE vid_name = ? AND task = ?', (vid_name, task))
+            conn.executemany('INSERT INTO outputs (vid_name, task, path, size, checksum) VALUES (?, ?, ?, ?, ?)', outputs)
+
+    def outputs(self, vid_name, task):
+        ''' the (path, size, checksum) of the outputs of a task for a video '''
+        return self._connect().execute('SELECT path, size, checksum FROM outputs WHERE vid_name = ? AND task = ? ORDER BY path', (vid_name, task)).fetchall()
+
+    def timings(self):
+        ''' the (video name, task, status, duration in seconds) of all the tasks '''
+        return self._connect().execute('SELECT vid_name, task, status, duration FROM tasks ORDER BY vid_name, task').fetchall()
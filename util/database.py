@@ -1,4 +1,7 @@
-from pymongo import MongoClient
+import json
+import time
+import sqlite3
+import threading
 
 mongo_connection_params = {
     'username': 'root',
@@ -7,11 +10,157 @@ mongo_connection_params = {
     'port': 27017
 }
 
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(connection_params=mongo_connection_params, timeout=None):
+    '''
+    get the MongoClient of a database, one client (i.e. one connection pool) per connection string is kept for the whole process
+
+    Parameters
+    ----------
+    connection_params : dict
+        username, password, host and port
+    timeout : int
+        ms to wait for the server before raising pymongo.errors.ServerSelectionTimeoutError, the pymongo default if None
+    '''
+    connection_string = f"mongodb://{connection_params['username']}:{connection_params['password']}@{connection_params['host']}:{connection_params['port']}"
+    from pymongo import MongoClient # imported when the database is used, not for the runs using the cached race info
+    with _clients_lock:
+        if connection_string not in _clients:
+            _clients[connection_string] = MongoClient(connection_string, serverSelectionTimeoutMS=timeout) if timeout else MongoClient(connection_string)
+        return _clients[connection_string]
+
 class HorseRacingDB:
-    def __init__(self, connection_params=mongo_connection_params):
-        username = mongo_connection_params['username']
-        password = mongo_connection_params['password']
-        host = mongo_connection_params['host']
-        port = mongo_connection_params['port']
-        connection_string = f"mongodb://{username}:{password}@{host}:{port}"
-        self.conn = MongoClient(connection_string)
+    def __init__(self, connection_params=mongo_connection_params, timeout=None):
+        self.conn = get_client(connection_params, timeout)
+
+def race_keys(vid_names):
+    ''' separate the video names into framesetid (4 digits) and racelabel. They are queried differently '''
+    framesetidlist = [int(vid_name) for vid_name in vid_names if len(vid_name) == 4]
+    racelabellist = [vid_name for vid_name in vid_names if len(vid_name) != 4]
+    return framesetidlist, racelabellist
+
+def parse_race_document(obj):
+    '''
+    get the race info and the jockeys from a document of the newfullraceinfo collection
+
+    Returns
+    -------
+    info : dict
+        {'track': track, 'distance': distance, 'course': course}
+    jockeys : list of int
+        the jockey numbers of the jockeys that took part in the race and successfully finish, None if the document has no jockeys
+    '''
+    info = {"track": obj['trackabbr'], "distance": obj['length'], "course": obj['railorcoursetype']}
+    jockeys = [ int(ji['jockeynumber']) for ji in obj['jockeys'] if ji['place'] is not None] if 'jockeys' in obj.keys() else None
+    return info, jockeys
+
+def match_race_documents(docs, vid_names):
+    '''
+    match the race documents to the video names, by framesetid for the 4 digit names and by racelabel for the others
+
+    Returns
+    -------
+    races : dict
+        video name: (info, jockeys), see parse_race_document
+    '''
+    framesetidlist, racelabellist = race_keys(vid_names)
+    framesetids, racelabels = set(framesetidlist), set(racelabellist)
+    races = {}
+    for obj in docs:
+        if obj.get('framesetid') in framesetids:
+            races[str(obj["framesetid"]).zfill(4)] = parse_race_document(obj)
+        if obj.get('racelabel') in racelabels:
+            races[obj["racelabel"]] = parse_race_document(obj)
+    return races
+
+def find_races(vid_names, timeout=None):
+    '''
+    query the race info of the videos from the database, in a single query for both the framesetid and the racelabel
+
+    Returns
+    -------
+    races : dict
+        video name: (info, jockeys), see parse_race_document
+    '''
+    framesetidlist, racelabellist = race_keys(vid_names)
+    collection = HorseRacingDB(timeout=timeout).conn.gtinfo['newfullraceinfo']
+    query = {'$or': [{'framesetid': { "$in": framesetidlist } }, {'racelabel': { "$in": racelabellist } }]}
+    projection = ['framesetid', 'racelabel', 'trackabbr', 'length', 'railorcoursetype', 'jockeys.jockeynumber', 'jockeys.place']
+    return match_race_documents(collection.find(query, projection), vid_names)
+
+def load_race_documents(path):
+    ''' read the race documents from a json file, i.e. exported by mongoexport --jsonArray from the newfullraceinfo collection, as a local stand-in of the database '''
+    with open(path, 'r') as f:
+        docs = json.load(f)
+    return docs if isinstance(docs, list) else list(docs.values())
+
+class RaceInfoCache:
+
+    '''
+    Persistent cache of the race info of the videos in a SQLite file, so the race info is queried from the database once per video.
+    Only the race info found in the database is cached, the videos not found are queried again by the next run
+
+    Parameters
+    ----------
+    path : string
+        the SQLite file, created if not exist. It can be shared by several result directories and processes
+    ttl : float
+        seconds before a cached race info is stale
+    '''
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS race_info (vid_name TEXT PRIMARY KEY, info TEXT, jockeys TEXT, fetched REAL)')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def get(self, vid_names, stale=False):
+        '''
+        get the cached race info of the videos
+
+        Parameters
+        ----------
+        vid_names : list of string
+        stale : bool
+            also return the race info older than the ttl
+
+        Returns
+        -------
+        races : dict
+            video name: (info, jockeys), info is None for the videos cached as not found by the previous versions
+        '''
+        vid_names = list(vid_names)
+        oldest = 0 if stale else time.time() - self.ttl
+        races = {}
+        conn = self._connect()
+        try:
+            for i in range(0, len(vid_names), 500): # below the limit of the parameters of a query
+                chunk = vid_names[i:i + 500]
+                rows = conn.execute(f"SELECT vid_name, info, jockeys FROM race_info WHERE fetched >= ? AND vid_name IN ({','.join('?' * len(chunk))})", [oldest] + chunk)
+                for vid_name, info, jockeys in rows:
+                    races[vid_name] = (json.loads(info), json.loads(jockeys))
+        finally:
+            conn.close()
+        return races
+
+    def put(self, races):
+        ''' store the race info of the videos, video name: (info, jockeys) '''
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO race_info (vid_name, info, jockeys, fetched) VALUES (?, ?, ?, ?)',
+                                 [(vid_name, json.dumps(info), json.dumps(jockeys), now) for vid_name, (info, jockeys) in races.items()])
+        finally:
+            conn.close()
@@ -0,0 +1,229 @@
+'''
+Export of the results of the videos (Result.convert_to_excel, main.py --xlsx / --format): the race and video config and the jockey caps of the tracking result, one file per video or per table.
+The tables are built as arrays from the final_result csv, the videos are exported by a pool of processes.
+
+'xlsx' is written row by row by xlsxwriter in constant memory mode, 'parquet', 'feather' and 'csv.gz' write one file per table ([video name]&race and [video name]&caps) with typed columns,
+the missing caps are null instead of "" so the files are read back without parsing.
+'''
+
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import config
+
+
+def _drop_empty_cells(cells):
+    # remove the empty cells of a row of comma separated values
+    while ",," in cells:
+        cells = cells.replace(",,", ",")
+    return cells.strip(",")
+
+def read_final_result(path):
+    '''
+    read the trajectories of a tracking result (final_result csv) into arrays. The numbers of all the rows are parsed at once by numpy.
+    Every row is a frame: the frame path, two columns and the boxes as groups of 5 values [id, y, x, h, w]
+
+    Parameters
+    ----------
+    path : string
+        path to the csv file without extension
+
+    Returns
+    -------
+    result : dict
+        'frames': frame number of every row (from img%06d.jpg), 'counts': number of boxes of every row,
+        'row', 'frame', 'id', 'cx', 'cy', 'w', 'h': one value per box, 'row' is the index of the row of the box
+    '''
+    with open(path + ".csv", "r") as f:
+        rows = [line.split(",", 3) for line in f.read().split("\n")[3:] if line.strip() != ""]
+    frames = np.array([row[0].rpartition("/img")[2].partition(".")[0] for row in rows], dtype=np.int64)
+    cells = [_drop_empty_cells(row[3]) if len(row) > 3 else "" for row in rows]
+    # the values of a row are grouped by 5, the incomplete group at the end is skipped
+    counts = np.array([(c.count(",") + 1 if c else 0) for c in cells], dtype=np.int64)
+    values = np.fromstring(",".join(c for c in cells if c), dtype=np.int64, sep=",") if counts.sum() else np.zeros(0, np.int64)
+    complete = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) < counts.repeat(counts) // 5 * 5
+    boxes = values[complete].reshape(-1, 5)
+    counts = counts // 5
+    row = np.repeat(np.arange(len(counts)), counts)
+    return {
+        'frames': frames, 'counts': counts, 'row': row, 'frame': frames[row], 'id': boxes[:, 0],
+        'cx': (boxes[:, 4] / 2 + boxes[:, 2]).astype(np.int64), 'cy': (boxes[:, 3] / 2 + boxes[:, 1]).astype(np.int64),
+        'w': boxes[:, 4], 'h': boxes[:, 3],
+    }
+
+def caps_columns(scn_max):
+    ''' the columns of the jockey caps table '''
+    return ['FrameNo', 'detectedJockeys'] + [k for j in [['cx'+str(i), 'cy'+str(i)] for i in range(scn_max)] for k in j]
+
+def caps_arrays(tracks, scn_max, start):
+
+    '''
+    the jockey caps of every frame as arrays, a row per frame: frame number, number of detected jockeys and cx, cy of every jockey id
+
+    Parameters
+    ----------
+    tracks : dict
+        see read_final_result
+    scn_max : int
+        the number of jockey ids, the boxes with a larger id are skipped
+    start : int
+        the frame number of the first row
+
+    Returns
+    -------
+    data : numpy array
+        int64 array of shape (frames, 2 + 2 * scn_max)
+    missing : numpy array
+        bool array of the same shape, True where the jockey is not detected
+    '''
+
+    frames = len(tracks['counts'])
+    data = np.zeros((frames, 2 + 2 * scn_max), dtype=np.int64)
+    missing = np.ones(data.shape, dtype=bool)
+    data[:, 0] = np.arange(frames) + start
+    data[:, 1] = tracks['counts']
+    missing[:, :2] = False
+    keep = tracks['id'] <= scn_max
+    slot = (tracks['id'][keep] - 1) % scn_max # the id 0 goes to the last jockey, like the index -1 of a list
+    for column, value in [(2 + 2 * slot, tracks['cx'][keep]), (3 + 2 * slot, tracks['cy'][keep])]:
+        data[tracks['row'][keep], column] = value
+        missing[tracks['row'][keep], column] = False
+    return data, missing
+
+def caps_table(tracks, scn_max, start):
+    ''' the jockey caps as an object array of python ints, "" if the jockey is not detected, see caps_arrays '''
+    data, missing = caps_arrays(tracks, scn_max, start)
+    data = data.astype(object)
+    data[missing] = ""
+    return data
+
+def race_config_table(track, distance, start, end, cam_changes):
+
+    '''
+    the race and video config of a video as a single row: track, distance, start and end frames and the frames of the subraces between the camera changes
+
+    Parameters
+    ----------
+    track : string
+    distance : int
+    start : int
+        start frame of the race
+    end : int
+        end frame of the race
+    cam_changes : list of list of int
+        [[start, end], ...] of the camera changes
+
+    Returns
+    -------
+    columns : list of string
+    row : list
+    '''
+
+    row = [track, "", str(distance), "", start, end]
+    columns = ['track', 'raceNum', 'raceDist', 'raceTime', 'startFrame', 'endFrame']
+    subrace_data = [start] + np.array(cam_changes).flatten().tolist() + [end]
+    row += [str(sd) for sd in subrace_data]
+    for i in range(int(len(subrace_data)/2)):
+        columns += ['subrace' + str(len(cam_changes)-i+1) + '_start', 'subrace' + str(len(cam_changes)-i+1) + '_end']
+    row.append("")
+    columns.append("end")
+    return columns, row
+
+def _write_xlsx(path, sheets):
+    # constant memory mode keeps a single row in memory, the rows have to be written in order
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    header = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}) # the header of pandas.DataFrame.to_excel
+    try:
+        for name, columns, rows in sheets:
+            worksheet = workbook.add_worksheet(name)
+            worksheet.write_row(0, 0, columns, header)
+            for r, row in enumerate(rows, 1):
+                worksheet.write_row(r, 0, row)
+    finally:
+        workbook.close()
+
+def _write_table(path, df, fmt):
+    if fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    elif fmt == 'feather':
+        df.to_feather(path)
+    else:
+        df.to_csv(path, index=False, compression='gzip')
+
+formats = {'xlsx': '.xlsx', 'parquet': '.parquet', 'feather': '.feather', 'csv.gz': '.csv.gz'}
+
+def export_video(job, out_dir, fmt='xlsx'):
+
+    '''
+    export the results of a video
+
+    Parameters
+    ----------
+    job : dict
+        'vid_name', 'config': (columns, row) of race_config_table, 'tracks': path to the final_result csv without extension or None if the video is not tracked,
+        'scn_max' and 'start': see caps_arrays
+    out_dir : string
+        the directory of the exported files
+    fmt : string
+        'xlsx', 'parquet', 'feather' or 'csv.gz'
+
+    Returns
+    -------
+    paths : list of string
+        the written files
+    '''
+
+    columns, row = job['config']
+    tracks = read_final_result(job['tracks']) if job['tracks'] is not None else None
+    if fmt == 'xlsx':
+        sheets = [('Race & Video Config', columns, [row])]
+        if tracks is not None:
+            sheets.append(('Jockey Caps', caps_columns(job['scn_max']), caps_table(tracks, job['scn_max'], job['start']).tolist()))
+        paths = [os.path.join(out_dir, job['vid_name'] + formats[fmt])]
+        _write_xlsx(paths[0], sheets)
+    else:
+        import pandas as pd # only for the columnar formats
+        tables = [('race', pd.DataFrame([row], columns=columns))]
+        if tracks is not None:
+            data, missing = caps_arrays(tracks, job['scn_max'], job['start'])
+            tables.append(('caps', pd.DataFrame({c: pd.arrays.IntegerArray(data[:, i], missing[:, i]) for i, c in enumerate(caps_columns(job['scn_max']))})))
+        paths = []
+        for name, df in tables:
+            paths.append(os.path.join(out_dir, job['vid_name'] + '&' + name + formats[fmt]))
+            _write_table(paths[-1], df, fmt)
+    print("Finish writing", job['vid_name'])
+    return paths
+
+def export_videos(jobs, out_dir, fmt=None, workers=None):
+
+    '''
+    export the results of several videos in parallel, see export_video
+
+    Parameters
+    ----------
+    jobs : list of dict
+        see export_video
+    out_dir : string
+        the directory of the exported files, created if it does not exist
+    fmt : string
+        the format, config.export['format'] if None
+    workers : int
+        the number of processes, config.export['workers'] if None. The videos are exported in this process if 1
+
+    Returns
+    -------
+    paths : list of string
+        the written files
+    '''
+
+    fmt = fmt or config.export['format']
+    workers = min(workers or config.export['workers'], len(jobs))
+    if fmt not in formats:
+        raise ValueError(f"Unknown export format {fmt}, available formats: {sorted(formats)}")
+    os.makedirs(out_dir, exist_ok=True)
+    if workers <= 1:
+        return [path for job in jobs for path in export_video(job, out_dir, fmt)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as pool:
+        return [path for paths in pool.map(export_video, jobs, [out_dir] * len(jobs), [fmt] * len(jobs)) for path in paths]
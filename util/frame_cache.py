@@ -0,0 +1,130 @@
+import os
+import threading
+import numpy as np
+import config
+from util.video_util import FrameSource
+from util.video_probe import get_probe
+
+
+class FrameCache:
+
+    '''
+    Persistent cache of decoded frame sets on disk. A frame set is stored as a raw uint8 .npy file of shape (frames, height, width, 3) keyed by (video md5, start, end, frame_step, size),
+    and is memory-mapped when read, so a warm re-run starts working on the frames without decoding the video. The least recently used frame sets are removed when the cache exceeds the quota.
+
+    Parameters
+    ----------
+    cache_dir : string
+        the directory of the cache, created if not exist. It can be shared by several processes
+    quota : float
+        the maximum size of the cache in GB
+    '''
+
+    def __init__(self, cache_dir, quota=config.frame_cache_quota):
+        self.cache_dir = cache_dir
+        self.quota = quota
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        return {'cache_dir': self.cache_dir, 'quota': self.quota}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def video_md5(self, vid_path):
+
+        '''
+        get the md5 of a video, the md5 is computed once per file and remembered by (path, size, mtime) by util.video_probe
+
+        Parameters
+        ----------
+        vid_path : string
+
+        Returns
+        -------
+        md5 : string
+        '''
+
+        return get_probe().md5(vid_path)
+
+    def entry_path(self, md5, start, end, frame_step, size):
+        ''' path of the .npy file of a frame set '''
+        return os.path.join(self.cache_dir, f"{md5}_{start}_{end}_{frame_step}_{size[0]}x{size[1]}.npy")
+
+    def load(self, vid_path, start, end, size=(config.frame_width, config.frame_height)):
+
+        '''
+        get a frame set from the cache, decode the video into the cache on a miss
+
+        Parameters
+        ----------
+        vid_path : string
+            path to the video file
+        start : int
+            the starting frame
+        end : int
+            the ending frame
+        size : tuple of int
+            (width, height) of the frames
+
+        Returns
+        -------
+        frames : numpy memmap
+            uint8 array of shape (frames, height, width, 3). The array is copy-on-write, changes are not written back to the cache
+        '''
+
+        path = self.entry_path(self.video_md5(vid_path), start, end, get_probe().probe(vid_path).frame_step, size)
+
+        if os.path.exists(path):
+            os.utime(path) # mark as recently used
+            print("Loading Video from frame cache")
+            return np.load(path, mmap_mode='c')
+
+        print("Loading Video into frame cache")
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        source = FrameSource(vid_path, start, end, size=size)
+        try:
+            frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(source), size[1], size[0], 3))
+            count = 0
+            with source:
+                for count, frame in enumerate(source, 1):
+                    frames[count - 1] = frame
+            if count < len(frames): # the video ends before the ending frame
+                truncated = np.lib.format.open_memmap(tmp_path + '.part', mode='w+', dtype=np.uint8, shape=(count,) + frames.shape[1:])
+                truncated[:] = frames[:count]
+                truncated.flush()
+                del truncated
+                os.replace(tmp_path + '.part', tmp_path)
+            else:
+                frames.flush()
+            del frames
+            os.replace(tmp_path, path) # atomic, another process never sees a partial frame set
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.evict(keep=path)
+        return np.load(path, mmap_mode='c')
+
+    def evict(self, keep=None):
+        ''' remove the least recently used frame sets until the cache fits in the quota, the frame set at the path keep is never removed '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError: # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.quota * 1024**3:
+                break
+            if os.path.join(self.cache_dir, name) == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
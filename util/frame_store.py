@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+
+class FrameStore:
+
+    '''
+    Thread-safe store of the loaded frame sets, shared by the tasks that run at the same time on a video. A frame set is keyed by (vid_path, start, end, size) and is loaded only once,
+    the tasks asking for a frame set that is being loaded wait for it instead of decoding the video again.
+
+    Parameters
+    ----------
+    capacity : int
+        the maximum number of frame sets of the same size kept in the store, the least recently used frame set of that size is dropped first. A dropped frame set stays in memory until the tasks using it release it
+    '''
+
+    def __init__(self, capacity=1):
+        self.capacity = capacity
+        self._init_state()
+
+    def _init_state(self):
+        self._frames = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the frames are not sent to other processes, a copy of the store starts empty
+        return {'capacity': self.capacity}
+
+    def __setstate__(self, state):
+        self.capacity = state['capacity']
+        self._init_state()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._frames
+
+    def peek(self, key):
+        ''' get a frame set if it is in the store, None otherwise '''
+        with self._lock:
+            return self._frames.get(key)
+
+    def get(self, key, loader):
+
+        '''
+        get a frame set, load it if it is not in the store
+
+        Parameters
+        ----------
+        key : tuple
+            (vid_path, start, end, size)
+        loader : function
+            called without argument to load the frame set if it is not in the store
+
+        Returns
+        -------
+        frames : list
+        '''
+
+        while True:
+            with self._lock:
+                if key in self._frames:
+                    self._frames.move_to_end(key)
+                    return self._frames[key]
+                event = self._loading.get(key)
+                if event is None:
+                    event = self._loading[key] = threading.Event()
+                    break
+            # another task is loading the same frame set, wait for it. If it failed, try to load it here
+            event.wait()
+
+        try:
+            # make room before loading, so the dropped frame set can be freed while the new one is loading
+            with self._lock:
+                same_size = [k for k in self._frames if k[3:] == key[3:]] # in least recently used order
+                for k in same_size[:max(0, len(same_size) - self.capacity + 1)]:
+                    del self._frames[k]
+            frames = loader()
+            with self._lock:
+                self._frames[key] = frames
+            return frames
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+    def clear(self):
+        ''' drop all the frame sets, i.e. when moving on to the next video '''
+        with self._lock:
+            self._frames.clear()
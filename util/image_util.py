@@ -1,11 +1,249 @@
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
+import config
 
-def encode_img(img:np.array):
-    img_str = cv2.imencode('.jpg', img)[1].tostring()
-    return img_str
+
+class FrameCodec:
+
+    '''
+    Base class of the in-memory frame codecs, i.e. how the frames are kept in Result.frames. A codec turns a decoded frame (uint8 array of shape (height, width, 3)) into an item and back.
+    The encoded items start with a magic number so util.image_util.decode_img can decode them without knowing the codec.
+    '''
+
+    name = None
+
+    def encode(self, img:np.array):
+        raise NotImplementedError
+
+    def decode(self, item):
+        raise NotImplementedError
+
+
+class RawCodec(FrameCodec):
+    ''' keep the decoded frame as it is, no CPU cost but the most memory '''
+
+    name = 'raw'
+
+    def encode(self, img:np.array):
+        return img
+
+    def decode(self, item):
+        return item
+
+
+class JpegCodec(FrameCodec):
+    ''' lossy JPEG at the given quality (0-100) '''
+
+    name = 'jpeg'
+    magic = b'\xff\xd8'
+
+    def __init__(self, quality=95):
+        self.quality = int(quality)
+
+    def encode(self, img:np.array):
+        return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1].tobytes()
+
+    def decode(self, item):
+        return cv2.imdecode(np.frombuffer(item, np.uint8), cv2.IMREAD_COLOR)
+
+
+class PngCodec(JpegCodec):
+    ''' lossless PNG at the given compression level (0-9) '''
+
+    name = 'png'
+    magic = b'\x89PNG'
+
+    def __init__(self, level=1):
+        self.level = int(level)
+
+    def encode(self, img:np.array):
+        return cv2.imencode('.png', img, [cv2.IMWRITE_PNG_COMPRESSION, self.level])[1].tobytes()
+
+
+class ZlibCodec(FrameCodec):
+    ''' lossless, the raw bytes of the frame compressed by zlib at the given level (1-9), level 1 is the fastest '''
+
+    name = 'zlib'
+    magic = b'HRZ1'
+    _header = struct.Struct('<4sHHH') # magic, height, width, channels
+
+    def __init__(self, level=1):
+        self.level = int(level)
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+    def encode(self, img:np.array):
+        img = np.ascontiguousarray(img)
+        return self._header.pack(self.magic, *img.shape) + self.compress(img.data)
+
+    def decode(self, item):
+        _, height, width, channels = self._header.unpack_from(item)
+        data = bytearray(self.decompress(memoryview(item)[self._header.size:])) # writable like the frames decoded by cv2
+        return np.frombuffer(data, np.uint8).reshape(height, width, channels)
+
+
+class Lz4Codec(ZlibCodec):
+    ''' lossless, the raw bytes of the frame compressed by lz4, faster than zlib but compresses less. Needs the lz4 package '''
+
+    name = 'lz4'
+    magic = b'HRL1'
+
+    def __init__(self, level=0):
+        import lz4.frame
+        self.lz4 = lz4.frame
+        self.level = int(level)
+
+    def compress(self, data):
+        return self.lz4.compress(data, compression_level=self.level)
+
+    def decompress(self, data):
+        return self.lz4.decompress(data)
+
+
+codecs = {codec.name: codec for codec in [RawCodec, JpegCodec, PngCodec, ZlibCodec, Lz4Codec]}
+_codec_instances = {}
+
+
+def get_codec(spec=None):
+
+    '''
+    get a frame codec from its name and optional parameter, i.e. 'raw', 'png', 'png:3', 'jpeg', 'jpeg:90', 'zlib', 'zlib:6', 'lz4'
+
+    Parameters
+    ----------
+    spec : string
+        the codec, config.frame_codec if None
+
+    Returns
+    -------
+    codec : FrameCodec
+    '''
+
+    spec = spec or config.frame_codec
+    if spec not in _codec_instances:
+        name, _, param = spec.partition(':')
+        if name not in codecs:
+            raise ValueError(f"Unknown frame codec {name}, available codecs: {sorted(codecs)}")
+        _codec_instances[spec] = codecs[name](param) if param else codecs[name]()
+    return _codec_instances[spec]
+
+
+def encode_img(img:np.array, codec=None):
+    return get_codec(codec).encode(img)
 
 def decode_img(img_str:str):
-    img = np.fromstring(img_str, np.uint8)
+    # the codec is found from the encoded item, so the frames encoded by any codec can be decoded
+    if isinstance(img_str, np.ndarray) and img_str.ndim == 3: # the frame is decoded already, i.e. the raw codec or read from the frame cache
+        return img_str
+    if isinstance(img_str, np.ndarray):
+        img_str = img_str.tobytes()
+    for codec in codecs.values():
+        if getattr(codec, 'magic', None) is not None and img_str[:len(codec.magic)] == codec.magic:
+            return get_codec(codec.name).decode(img_str)
+    img = np.frombuffer(img_str, np.uint8)
     img = cv2.imdecode(img, cv2.IMREAD_COLOR)
-    return img
\ No newline at end of file
+    return img
+
+_reduced_flags = {8: cv2.IMREAD_REDUCED_COLOR_8, 4: cv2.IMREAD_REDUCED_COLOR_4, 2: cv2.IMREAD_REDUCED_COLOR_2}
+
+def decode_img_resized(img_str, size, frame_size=(config.frame_width, config.frame_height)):
+    '''
+    decode a frame at a smaller size. JPEG frames are decoded at 1/2, 1/4 or 1/8 of the size by the JPEG decoder itself, which is much faster than a full decode followed by a resize
+
+    Parameters
+    ----------
+    img_str : bytes or numpy array
+        the encoded frame, see decode_img
+    size : tuple of int
+        (width, height) of the decoded frame
+    frame_size : tuple of int
+        (width, height) of the encoded frame
+
+    Returns
+    -------
+    img : numpy array
+        uint8 array of shape (height, width, 3)
+    '''
+    img = None
+    if isinstance(img_str, bytes) and img_str[:len(JpegCodec.magic)] == JpegCodec.magic:
+        for factor, flag in _reduced_flags.items(): # the largest reduction that is still larger than the size
+            if frame_size[0] // factor >= size[0] and frame_size[1] // factor >= size[1]:
+                img = cv2.imdecode(np.frombuffer(img_str, np.uint8), flag)
+                break
+    if img is None:
+        img = decode_img(img_str)
+    if (img.shape[1], img.shape[0]) != tuple(size):
+        img = cv2.resize(img, tuple(size), interpolation=cv2.INTER_AREA)
+    return img
+
+
+_decode_pools = {}
+_decode_pools_lock = threading.Lock()
+
+
+def get_decode_pool(threads=None):
+
+    '''
+    get the thread pool for decoding frames, one pool per number of threads is kept for the whole process. cv2 releases the GIL while decoding, so the threads decode on several cores
+
+    Parameters
+    ----------
+    threads : int
+        the number of threads, config.decode_threads if None
+
+    Returns
+    -------
+    pool : ThreadPoolExecutor
+    '''
+
+    threads = threads or config.decode_threads
+    with _decode_pools_lock:
+        if threads not in _decode_pools:
+            _decode_pools[threads] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="decode")
+        return _decode_pools[threads]
+
+
+def decode_batch(items, threads=None, out=None, size=None):
+
+    '''
+    decode a list of frames into a single array in parallel
+
+    Parameters
+    ----------
+    items : list
+        the encoded frames
+    threads : int
+        the number of decoding threads, config.decode_threads if None
+    out : numpy array
+        the array of shape (N, height, width, 3) to decode into, allocated from the first frame if None
+    size : tuple of int
+        (width, height) of the decoded frames, see decode_img_resized. The frames are decoded at their own size if None
+
+    Returns
+    -------
+    frames : numpy array
+        uint8 array of shape (N, height, width, 3)
+    '''
+
+    decode = decode_img if size is None else lambda item: decode_img_resized(item, size)
+    if len(items) == 0:
+        size = size or (config.frame_width, config.frame_height)
+        return np.empty((0, size[1], size[0], 3), np.uint8) if out is None else out
+    first = decode(items[0])
+    if out is None:
+        out = np.empty((len(items),) + first.shape, dtype=first.dtype)
+    out[0] = first
+
+    def _decode_into(i):
+        out[i] = decode(items[i])
+
+    list(get_decode_pool(threads).map(_decode_into, range(1, len(items))))
+    return out
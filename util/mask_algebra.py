@@ -0,0 +1,276 @@
+'''
+Mask algebra on COCO RLE, so the masks of the segmentation outputs can be merged, intersected, cropped and dilated without decoding them into dense (1080, 1920) arrays.
+The dense mask is only decoded by the final consumer, see util.mask_util.get_masks_for_homograhy.
+
+An RLE is a dict {'size': [height, width], 'counts': compressed counts (bytes)} as used by pycocotools.mask, the pixels are counted in column-major order.
+merge, intersect, area and to_bbox are the pycocotools.mask calls, crop, embed and dilate work on the runs of the RLE:
+the foreground runs are split into one interval of rows per column, which are shifted and clipped as intervals and encoded back.
+'''
+
+import numpy as np
+import pycocotools.mask as mask_save_tool
+
+
+def to_rle(rle_string, size):
+
+    '''
+    build an RLE from the rle string of the segmentation outputs
+
+    Parameters
+    ----------
+    rle_string : string or bytes
+        compressed counts
+    size : list of int
+        [height, width] of the mask
+
+    Returns
+    -------
+    rle : dict
+    '''
+
+    if isinstance(rle_string, str):
+        rle_string = rle_string.encode()
+    return {'size': [int(size[0]), int(size[1])], 'counts': rle_string}
+
+
+def decode_counts(counts):
+
+    '''
+    decode compressed counts into the run lengths, alternating background and foreground, starting with background
+
+    Parameters
+    ----------
+    counts : bytes or string
+
+    Returns
+    -------
+    runs : numpy array
+        int64 run lengths
+    '''
+
+    if isinstance(counts, str):
+        counts = counts.encode()
+    c = np.frombuffer(counts, dtype=np.uint8).astype(np.int64) - 48
+    if len(c) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # every value is a little endian sequence of 5 bit chunks, the 0x20 bit tells that the value continues
+    last = (c & 0x20) == 0
+    first = np.concatenate([[True], last[:-1]])
+    starts = np.flatnonzero(first)
+    k = np.arange(len(c)) - np.repeat(starts, np.diff(np.append(starts, len(c))))
+    x = np.add.reduceat((c & 0x1f) << (5 * k), starts)
+    # the 0x10 bit of the last chunk is the sign
+    negative = (c[last] & 0x10) != 0
+    x[negative] -= np.int64(1) << (5 * (k[last][negative] + 1))
+    # the runs after the third one are stored as the difference to the run two before
+    runs = x.copy()
+    runs[1::2] = np.cumsum(x[1::2])
+    runs[2::2] = np.cumsum(x[2::2])
+    return runs
+
+
+def encode_counts(runs):
+
+    '''
+    encode run lengths into compressed counts, the inverse of decode_counts. It does not need the size of the mask, i.e. for the run lengths of a delta mask
+
+    Parameters
+    ----------
+    runs : list of int
+
+    Returns
+    -------
+    counts : bytes
+    '''
+
+    # pycocotools does not check the size against the runs, a single row of all the pixels is used
+    runs = np.asarray(runs, dtype=np.int64)
+    return encode_runs(runs, [1, int(runs.sum())])['counts']
+
+
+def transitions(runs):
+    ''' the pixel indices where the mask switches between background and foreground, 0 is included if the mask starts with foreground '''
+    return np.cumsum(runs)[:-1]
+
+
+def from_transitions(transitions, total):
+    ''' the run lengths of a mask of total pixels from its transitions '''
+    return np.diff(np.concatenate([[0], transitions, [total]]))
+
+
+def xor_transitions(a, b):
+    ''' the transitions of the xor of two masks from their transitions, a pixel index is a transition of the xor if it is a transition of exactly one of the masks '''
+    return np.setxor1d(a, b, assume_unique=True)
+
+
+def encode_runs(runs, size):
+
+    '''
+    encode run lengths into an RLE, see decode_counts
+
+    Parameters
+    ----------
+    runs : list of int
+    size : list of int
+        [height, width] of the mask
+
+    Returns
+    -------
+    rle : dict
+    '''
+
+    return mask_save_tool.frPyObjects({'size': [int(size[0]), int(size[1])], 'counts': np.asarray(runs, dtype=np.int64).tolist()}, int(size[0]), int(size[1]))
+
+
+def merge(rles):
+    ''' union of RLEs of the same size '''
+    return mask_save_tool.merge(list(rles), intersect=False)
+
+
+def intersect(rles):
+    ''' intersection of RLEs of the same size '''
+    return mask_save_tool.merge(list(rles), intersect=True)
+
+
+def area(rles):
+    ''' number of foreground pixels of an RLE or of each RLE of a list '''
+    return mask_save_tool.area(rles)
+
+
+def to_bbox(rles):
+    ''' [x, y, w, h] of an RLE or of each RLE of a list '''
+    return mask_save_tool.toBbox(rles)
+
+
+def decode(rle):
+    ''' decode an RLE into a dense uint8 mask of shape (height, width) '''
+    return mask_save_tool.decode(rle)
+
+
+def _intervals(rle):
+    # the foreground runs as [start, end) intervals of the column-major pixel index
+    runs = decode_counts(rle['counts'])
+    ends = np.cumsum(runs)
+    starts = ends - runs
+    starts, ends = starts[1::2], ends[1::2]
+    keep = ends > starts
+    return starts[keep], ends[keep]
+
+
+def _merge_intervals(starts, ends):
+    # union of intervals, the overlapping and touching intervals are joined
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] > reach[:-1]
+    last = np.append(np.flatnonzero(first)[1:] - 1, len(starts) - 1)
+    return starts[first], reach[last]
+
+
+def _from_intervals(starts, ends, size):
+    # encode sorted and disjoint intervals into an RLE
+    starts, ends = _merge_intervals(starts, ends)
+    bounds = np.empty(2 * len(starts), dtype=np.int64)
+    bounds[0::2], bounds[1::2] = starts, ends
+    runs = np.diff(np.concatenate([[0], bounds, [size[0] * size[1]]]))
+    if len(runs) > 1 and runs[-1] == 0:
+        runs = runs[:-1]
+    return encode_runs(runs, size)
+
+
+def _columns(rle):
+    # split the foreground runs into one interval of rows [r0, r1) per column
+    height = rle['size'][0]
+    starts, ends = _intervals(rle)
+    first, last = starts // height, (ends - 1) // height
+    pieces = last - first + 1
+    index = np.repeat(np.arange(len(starts)), pieces)
+    columns = first[index] + np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    r0 = np.maximum(starts[index], columns * height) - columns * height
+    r1 = np.minimum(ends[index], (columns + 1) * height) - columns * height
+    return columns, r0, r1
+
+
+def _from_columns(columns, r0, r1, size):
+    # encode intervals of rows per column, the intervals outside of the mask are clipped
+    height, width = size
+    r0, r1 = np.clip(r0, 0, height), np.clip(r1, 0, height)
+    keep = (columns >= 0) & (columns < width) & (r1 > r0)
+    columns, r0, r1 = columns[keep], r0[keep], r1[keep]
+    return _from_intervals(columns * height + r0, columns * height + r1, size)
+
+
+def crop(rle, bbox):
+
+    '''
+    crop an RLE to a bbox
+
+    Parameters
+    ----------
+    rle : dict
+    bbox : list of int
+        [x, y, w, h] in the mask
+
+    Returns
+    -------
+    rle : dict
+        of size [h, w]
+    '''
+
+    x, y, w, h = [int(v) for v in bbox]
+    columns, r0, r1 = _columns(rle)
+    return _from_columns(columns - x, r0 - y, r1 - y, [h, w])
+
+
+def embed(rle, offset, size):
+
+    '''
+    place an RLE into a larger mask, the inverse of crop. The part outside of the larger mask is clipped
+
+    Parameters
+    ----------
+    rle : dict
+    offset : list of int
+        [x, y] of the top left corner of rle in the larger mask
+    size : list of int
+        [height, width] of the larger mask
+
+    Returns
+    -------
+    rle : dict
+        of size size
+    '''
+
+    x, y = int(offset[0]), int(offset[1])
+    columns, r0, r1 = _columns(rle)
+    return _from_columns(columns + x, r0 + y, r1 + y, size)
+
+
+def dilate(rle, kernel_size):
+
+    '''
+    dilate an RLE by a rectangular kernel with the anchor at the center, the same as cv2.dilate(mask, np.ones((height, width), np.uint8)).
+    Other structuring elements are approximated by their bounding rectangle
+
+    Parameters
+    ----------
+    rle : dict
+    kernel_size : tuple of int
+        (width, height) of the kernel
+
+    Returns
+    -------
+    rle : dict
+    '''
+
+    kernel_width, kernel_height = kernel_size
+    # the anchor of cv2 is at kernel_size // 2, a pixel at row r is spread to the rows [r - (kernel_height - 1 - kernel_height // 2), r + kernel_height // 2]
+    up, down = kernel_height - 1 - kernel_height // 2, kernel_height // 2
+    left, right = kernel_width - 1 - kernel_width // 2, kernel_width // 2
+    columns, r0, r1 = _columns(rle)
+    r0, r1 = r0 - up, r1 + down
+    shifts = np.arange(-left, right + 1)
+    return _from_columns((columns[None, :] + shifts[:, None]).ravel(), np.tile(r0, len(shifts)), np.tile(r1, len(shifts)), rle['size'])
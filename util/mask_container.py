@@ -0,0 +1,436 @@
+'''
+Binary container for the segmentation outputs (Rail_Masks, Rail_Pole_Masks and Semantic_Masks), a random-access replacement of the RLE json files.
+
+The json files hold every frame of the race in a single document, {..., 'data': {'start_frame': s, 'finish_frame': f, 'frame_%d': [{'object_id', 'bbox', 'mask_size', 'rle_string', ...}, ...] or 'rle string'}},
+so reading a few frames means parsing the whole file. The container stores the same content as:
+
+    magic | header length | json header | frame numbers | frame kinds | object ids | record offsets | records | rle strings
+
+The records are grouped by object id (one column per object id) and sorted by frame, and the record offsets give, for each object id and frame, the range of its records.
+The file is memory-mapped, so reading n frames only touches the index and the rle strings of those frames.
+
+With the camera segments of the race (Result.get_camera_segments), the full frame masks (the rail masks and the semantic masks) are stored as a keyframe followed by deltas:
+the rle of a delta record is the xor of the mask with the mask of the same object at the previous frame (util.mask_algebra.xor_transitions), which is small because the masks change little within a camera segment.
+A keyframe is stored at the start of every camera segment and every keyframe_interval frames, so reading a frame applies at most keyframe_interval - 1 deltas, and reading the frames in order applies one delta per frame.
+
+Convert the json files with
+python -m util.mask_container [json files]
+which writes [name].rlec next to each file, or python -m util.mask_container --segments start,end start,end ... [json files] for the delta storage. util.mask_util reads the .rlec file instead of the json file when it exists, see open_rle.
+'''
+
+import os
+import re
+import sys
+import json
+import mmap
+import struct
+from collections.abc import Mapping
+import threading
+import numpy as np
+from util import mask_algebra
+
+MAGIC = b'HRMC'
+EXTENSION = '.rlec'
+_header = struct.Struct('<4sIQ') # magic, version, header length
+_version = 2
+_frame_key = re.compile(r'^frame_(-?\d+)$')
+
+# record fields, the flags tell which keys the record has
+_HAS_OBJECT_ID, _HAS_BBOX, _HAS_MASK_SIZE, _HAS_EXTRA, _IS_DELTA = 1, 2, 4, 8, 16
+_record_fields = [
+    ('position', '<u4'),    # position of the record in its frame
+    ('object_id', '<i4'),
+    ('bbox', '<i4', (4,)),  # x, y, w, h
+    ('mask_size', '<i4', (2,)),
+    ('flags', '<u1'),
+    ('rle_offset', '<u8'), ('rle_length', '<u4'),
+    ('extra_offset', '<u8'), ('extra_length', '<u4'), # json of the other keys of the record
+]
+_record_dtypes = {
+    1: np.dtype(_record_fields),
+    2: np.dtype(_record_fields + [('base', '<i8')]), # the record a delta record applies to, -1 for the other records
+}
+_record_dtype = _record_dtypes[_version]
+_STRING_FRAME = 1 # the frame is a single rle string instead of a list of records
+_NO_OBJECT_ID = -2**31 # the column of the records without object id and of the string frames
+_known_keys = ('object_id', 'bbox', 'mask_size', 'rle_string')
+
+
+def container_path(json_path):
+    ''' path of the container converted from a json file '''
+    return os.path.splitext(json_path)[0] + EXTENSION
+
+
+def is_container(path):
+    ''' check the magic number of a file '''
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _segment_index(segments):
+    # map a frame number to the index of its camera segment, None outside of the segments
+    def segment_of(frame):
+        for i, (first, last) in enumerate(segments):
+            if first <= frame <= last:
+                return i
+        return None
+    return segment_of
+
+
+def write_container(rle_data, path, segments=None, keyframe_interval=30):
+
+    '''
+    write the content of a segmentation output into a container file
+
+    Parameters
+    ----------
+    rle_data : dict
+        the content of the json file
+    path : string
+        path of the container file
+    segments : list of tuple of int
+        the camera segments (first frame, last frame), the full frame masks are stored as deltas to the previous frame within a segment. No delta is stored if None
+    keyframe_interval : int
+        the maximum number of frames from a keyframe to the next one
+    '''
+
+    data = rle_data['data']
+    frames = sorted(int(_frame_key.match(key).group(1)) for key in data if _frame_key.match(key))
+    columns = {}  # object id: list of (frame index, record)
+    kinds = np.zeros(len(frames), dtype=np.uint8)
+    for frame_index, frame in enumerate(frames):
+        objects = data['frame_%d' % frame]
+        if isinstance(objects, str):
+            kinds[frame_index] = _STRING_FRAME
+            objects = [{'rle_string': objects}]
+        for position, obj in enumerate(objects):
+            columns.setdefault(obj.get('object_id', _NO_OBJECT_ID), []).append((frame_index, position, obj))
+
+    object_ids = np.array(sorted(columns), dtype=np.int32)
+    offsets = np.zeros((len(object_ids), len(frames) + 1), dtype=np.uint64)
+    records = np.zeros(sum(len(c) for c in columns.values()), dtype=_record_dtype)
+    records['base'] = -1
+    segment_of = _segment_index(segments or [])
+    blob = bytearray()
+    r = 0
+    for o, object_id in enumerate(object_ids):
+        counts = np.zeros(len(frames), dtype=np.uint64)
+        for frame_index, _, _ in columns[int(object_id)]:
+            counts[frame_index] += 1
+        previous = None # (frame, record index, transitions, pixels, deltas since the keyframe) of the previous full frame mask of the object
+        for frame_index, position, obj in columns[int(object_id)]:
+            record = records[r]
+            record['position'] = position
+            record['object_id'] = object_id
+            flags = _HAS_OBJECT_ID if 'object_id' in obj else 0
+            if 'bbox' in obj:
+                record['bbox'] = obj['bbox']
+                flags |= _HAS_BBOX
+            if 'mask_size' in obj:
+                record['mask_size'] = obj['mask_size']
+                flags |= _HAS_MASK_SIZE
+            rle = obj['rle_string'].encode()
+            current = None
+            if segments is not None and 'bbox' not in obj and counts[frame_index] == 1: # a full frame mask, the only one of the object in the frame
+                runs = mask_algebra.decode_counts(rle)
+                transitions = mask_algebra.transitions(runs)
+                if np.all(np.diff(transitions) > 0) and mask_algebra.encode_counts(runs) == rle: # the rle is rebuilt exactly from the transitions
+                    current = (frames[frame_index], r, transitions, int(runs.sum()), 0)
+            if current is not None and previous is not None and previous[0] == current[0] - 1 and previous[3] == current[3] \
+               and previous[4] < keyframe_interval - 1 and segment_of(current[0]) is not None and segment_of(current[0]) == segment_of(previous[0]):
+                delta = mask_algebra.encode_counts(np.diff(mask_algebra.xor_transitions(previous[2], current[2]), prepend=0))
+                if len(delta) < len(rle):
+                    rle = delta
+                    record['base'] = previous[1]
+                    flags |= _IS_DELTA
+                    current = current[:4] + (previous[4] + 1,)
+            previous = current
+            record['rle_offset'], record['rle_length'] = len(blob), len(rle)
+            blob += rle
+            extra = {key: value for key, value in obj.items() if key not in _known_keys}
+            if extra:
+                extra = json.dumps(extra).encode()
+                record['extra_offset'], record['extra_length'] = len(blob), len(extra)
+                blob += extra
+                flags |= _HAS_EXTRA
+            record['flags'] = flags
+            r += 1
+        offsets[o, 1:] = np.cumsum(counts)
+        if o > 0:
+            offsets[o] += offsets[o - 1, -1]
+
+    header = {
+        'meta': {key: value for key, value in rle_data.items() if key != 'data'},
+        'data_meta': {key: value for key, value in data.items() if not _frame_key.match(key)},
+        'frames': len(frames), 'objects': len(object_ids), 'records': len(records),
+    }
+    header = json.dumps(header).encode()
+    header += b' ' * (-(_header.size + len(header)) % 8) # align the arrays
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_header.pack(MAGIC, _version, len(header)))
+        f.write(header)
+        for array in [np.array(frames, dtype=np.int64), kinds, object_ids, offsets, records]:
+            f.write(array.tobytes())
+            f.write(b'\0' * (-array.nbytes % 8))
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def convert_rle_json(json_path, out_path=None, segments=None, keyframe_interval=30):
+
+    '''
+    convert a segmentation output json file into a container file
+
+    Parameters
+    ----------
+    json_path : string
+    out_path : string
+        path of the container file, container_path(json_path) if None
+    segments : list of tuple of int
+        the camera segments, see write_container
+    keyframe_interval : int
+        see write_container
+
+    Returns
+    -------
+    out_path : string
+    '''
+
+    out_path = out_path or container_path(json_path)
+    with open(json_path, 'r') as f:
+        write_container(json.load(f), out_path, segments, keyframe_interval)
+    return out_path
+
+
+class MaskContainer(Mapping):
+
+    '''
+    Read-only view of a container file with the same layout as the json content, i.e. container['object_name_list'] or container['data']['frame_%d' % frame_number].
+    The frames are read on access from the memory-mapped file
+
+    Parameters
+    ----------
+    path : string
+        path of the container file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_length = _header.unpack_from(self._mmap)
+        if magic != MAGIC or version not in _record_dtypes:
+            raise ValueError(f"{path} is not a mask container of version {sorted(_record_dtypes)}")
+        header = json.loads(bytes(self._mmap[_header.size:_header.size + header_length]))
+        self._meta = header['meta']
+        offset = _header.size + header_length
+
+        def _array(dtype, count):
+            nonlocal offset
+            array = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes + (-array.nbytes % 8)
+            return array
+
+        n_frames, n_objects = header['frames'], header['objects']
+        self.frame_numbers = _array(np.int64, n_frames)
+        self._kinds = _array(np.uint8, n_frames)
+        self.object_ids = _array(np.int32, n_objects)
+        self._offsets = _array(np.uint64, n_objects * (n_frames + 1)).reshape(n_objects, n_frames + 1)
+        self._records = _array(_record_dtypes[version], header['records'])
+        self._blob = offset
+        self._frame_index = {int(frame): i for i, frame in enumerate(self.frame_numbers)}
+        self._column = {int(object_id): o for o, object_id in enumerate(self.object_ids)}
+        self.data = FrameData(self, header['data_meta'])
+        self._decoded = {} # record index: (transitions, pixels) of the last decoded delta records, so the next frame applies a single delta
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        if key == 'data':
+            return self.data
+        return self._meta[key]
+
+    def __iter__(self):
+        return iter(list(self._meta) + ['data'])
+
+    def __len__(self):
+        return len(self._meta) + 1
+
+    def _string(self, offset, length):
+        start = self._blob + int(offset)
+        return self._mmap[start:start + int(length)].decode()
+
+    def _transitions(self, r):
+        # the transitions of the mask of a delta record, from the nearest keyframe or decoded record
+        chain = []
+        while r not in self._decoded and self._records[r]['flags'] & _IS_DELTA:
+            chain.append(r)
+            r = int(self._records[r]['base'])
+        if r in self._decoded:
+            transitions, pixels = self._decoded[r]
+        else:
+            runs = mask_algebra.decode_counts(self._string(self._records[r]['rle_offset'], self._records[r]['rle_length']))
+            transitions, pixels = mask_algebra.transitions(runs), int(runs.sum())
+        for d in reversed(chain):
+            delta = np.cumsum(mask_algebra.decode_counts(self._string(self._records[d]['rle_offset'], self._records[d]['rle_length'])))
+            transitions = mask_algebra.xor_transitions(transitions, delta)
+        if chain:
+            if len(self._decoded) > 4 * len(self.object_ids):
+                self._decoded.clear()
+            self._decoded[chain[0]] = (transitions, pixels)
+        return transitions, pixels
+
+    def _rle_string(self, r):
+        record = self._records[r]
+        if not record['flags'] & _IS_DELTA:
+            return self._string(record['rle_offset'], record['rle_length'])
+        with self._lock:
+            transitions, pixels = self._transitions(r)
+        return mask_algebra.encode_counts(mask_algebra.from_transitions(transitions, pixels)).decode()
+
+    def _to_dict(self, r):
+        record = self._records[r]
+        flags = int(record['flags'])
+        obj = {}
+        if flags & _HAS_OBJECT_ID:
+            obj['object_id'] = int(record['object_id'])
+        if flags & _HAS_BBOX:
+            obj['bbox'] = record['bbox'].tolist()
+        if flags & _HAS_MASK_SIZE:
+            obj['mask_size'] = record['mask_size'].tolist()
+        obj['rle_string'] = self._rle_string(r)
+        if flags & _HAS_EXTRA:
+            obj.update(json.loads(self._string(record['extra_offset'], record['extra_length'])))
+        return obj
+
+    def frame_objects(self, frame_number, object_id=None):
+
+        '''
+        get the records of a frame, reading only the column of object_id if given
+
+        Parameters
+        ----------
+        frame_number : int
+        object_id : int
+            the object id, all the objects if None
+
+        Returns
+        -------
+        objects : list of dict or string
+            the same as the json content of the frame, a single rle string for the frames stored as a string
+        '''
+
+        f = self._frame_index[frame_number]
+        if self._kinds[f] == _STRING_FRAME:
+            object_id = _NO_OBJECT_ID
+        columns = range(len(self.object_ids)) if object_id is None else [self._column[object_id]] if object_id in self._column else []
+        indices = [np.arange(int(self._offsets[o, f]), int(self._offsets[o, f + 1])) for o in columns]
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        indices = indices[np.argsort(self._records['position'][indices], kind='stable')]
+        if self._kinds[f] == _STRING_FRAME:
+            return self._rle_string(int(indices[0]))
+        return [self._to_dict(int(r)) for r in indices]
+
+    def close(self):
+        ''' unmap the file, the frames and the arrays read from the container must not be used afterwards '''
+        # the index arrays are views of the mapping, it can only be closed once they are dropped
+        self.frame_numbers = self._kinds = self.object_ids = self._offsets = self._records = None
+        self._decoded.clear()
+        try:
+            self._mmap.close()
+        except BufferError: # an array of the index is still referenced, the mapping goes away with it
+            pass
+
+
+class FrameData(Mapping):
+
+    ''' the 'data' part of a container, frames are read when accessed as 'frame_%d' '''
+
+    def __init__(self, container, data_meta):
+        self._container = container
+        self._meta = data_meta
+
+    def __getitem__(self, key):
+        match = _frame_key.match(key) if isinstance(key, str) else None
+        if match and int(match.group(1)) in self._container._frame_index:
+            return self._container.frame_objects(int(match.group(1)))
+        return self._meta[key]
+
+    def __contains__(self, key):
+        match = _frame_key.match(key) if isinstance(key, str) else None
+        if match:
+            return int(match.group(1)) in self._container._frame_index
+        return key in self._meta
+
+    def __iter__(self):
+        yield from self._meta
+        for frame in self._container.frame_numbers:
+            yield 'frame_%d' % frame
+
+    def __len__(self):
+        return len(self._meta) + len(self._container.frame_numbers)
+
+    def frame_objects(self, frame_number, object_id=None):
+        ''' see MaskContainer.frame_objects '''
+        return self._container.frame_objects(frame_number, object_id)
+
+
+def open_rle(path):
+
+    '''
+    open a segmentation output, reading the container converted from the json file if it exists
+
+    Parameters
+    ----------
+    path : string
+        path of the json file or of the container file
+
+    Returns
+    -------
+    rle_data : dict or MaskContainer
+        the content of the file, a MaskContainer has the same layout as the json content
+    '''
+
+    if os.path.exists(path) and is_container(path):
+        return MaskContainer(path)
+    if os.path.exists(container_path(path)) and (not os.path.exists(path) or os.path.getmtime(container_path(path)) >= os.path.getmtime(path)):
+        return MaskContainer(container_path(path))
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def get_frame_objects(data, frame_number, object_id=None):
+
+    '''
+    get the records of a frame from the 'data' part of a json file or of a container
+
+    Parameters
+    ----------
+    data : dict or FrameData
+    frame_number : int
+    object_id : int
+        keep only the records of this object id, all the records if None
+
+    Returns
+    -------
+    objects : list of dict or string
+    '''
+
+    if isinstance(data, FrameData):
+        return data.frame_objects(frame_number, object_id)
+    objects = data['frame_%s' % frame_number]
+    if object_id is None or isinstance(objects, str):
+        return objects
+    return [obj for obj in objects if obj['object_id'] == object_id]
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    segments = None
+    if args and args[0] == '--segments':
+        args = args[1:]
+        segments = []
+        while args and ',' in args[0]:
+            segments.append(tuple(int(v) for v in args.pop(0).split(',')))
+    for json_path in args:
+        print(json_path, '-->', convert_rle_json(json_path, segments=segments))
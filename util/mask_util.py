@@ -1,9 +1,13 @@
 import os
-import json
 import cv2
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import config
 
 import pycocotools.mask as mask_save_tool
+from util.mask_container import open_rle, get_frame_objects
+from util import mask_algebra
 
 def encode_masks(masks:np.array):
     enc_masks = np.asfortranarray((masks.astype(np.uint8)))
@@ -14,8 +18,8 @@ def encode_masks(masks:np.array):
 def decode_masks(enc_masks:list):
     return mask_save_tool.decode(enc_masks)
 
-# RLE_String=rleEncodedString,mask_size=[96,96],obj_bbox=[x,y,w,h],frame_size=target frame_size
-def to_mask(rle_string,mask_size,obj_bbox,frame_size):
+def _bbox_mask(rle_string, mask_size, obj_bbox):
+    # decode the rle of an object and resize it to its bbox, (h, w) uint8 mask of 0 or 255
     # Build a dict to be able to use the pycocotools 
     rle_dict = {}
     rle_dict['counts'] = rle_string
@@ -29,20 +33,101 @@ def to_mask(rle_string,mask_size,obj_bbox,frame_size):
     tmp_mask = tmp_mask*255
 
     # bbox size_mask
-    tmp_mask = cv2.resize(tmp_mask,(obj_bbox[2],obj_bbox[3]))
+    return cv2.resize(tmp_mask,(obj_bbox[2],obj_bbox[3]))
+
+def paste_mask(canvas, rle_string, mask_size, obj_bbox):
+    '''
+    Union the mask of an object into a frame mask in place, only the bbox region of the canvas is touched. The part of the bbox outside of the canvas is clipped
 
+    Parameters
+    ----------
+    canvas : numpy array
+        uint8 frame mask of shape (height, width)
+    rle_string : string
+        the rle of the object mask
+    mask_size : list of int
+        the size of the rle mask, i.e. [96, 96]
+    obj_bbox : list of int
+        [x, y, w, h] of the object in the frame
+    '''
+    tmp_mask = _bbox_mask(rle_string, mask_size, obj_bbox)
+    x, y, w, h = obj_bbox
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, canvas.shape[1]), min(y + h, canvas.shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return canvas
+    roi = canvas[y0:y1, x0:x1]
+    np.maximum(roi, tmp_mask[y0 - y:y1 - y, x0 - x:x1 - x], out=roi)
+    return canvas
+
+# RLE_String=rleEncodedString,mask_size=[96,96],obj_bbox=[x,y,w,h],frame_size=target frame_size
+def to_mask(rle_string,mask_size,obj_bbox,frame_size):
     ### Put bbox size_mask at target frame(not added)
-    mask = np.zeros((frame_size[1], frame_size[0]), dtype=tmp_mask.dtype)
-    mask[obj_bbox[1]:obj_bbox[1]+obj_bbox[3],obj_bbox[0]:obj_bbox[0]+obj_bbox[2]] = tmp_mask
+    mask = np.zeros((frame_size[1], frame_size[0]), dtype=np.uint8)
+    return paste_mask(mask, rle_string, mask_size, obj_bbox)
+
+def composite_masks(objects, frame_size, out=None):
+    '''
+    Assemble the mask of a frame from the object records of the segmentation output, the same as np.maximum over to_mask of every object but with work proportional to the object areas
+
+    Parameters
+    ----------
+    objects : list of dict
+        the records of the frame, with 'rle_string', 'mask_size' and 'bbox'
+    frame_size : list of int
+        [width, height] of the frame
+    out : numpy array
+        uint8 array of shape (height, width) to assemble into, it is cleared first. Allocated if None
+
+    Returns
+    -------
+    mask : numpy array
+        uint8 mask of shape (height, width), 255 on the objects
+    '''
+    if out is None:
+        out = np.zeros((frame_size[1], frame_size[0]), dtype=np.uint8)
+    else:
+        out[:] = 0
+    for data in objects:
+        paste_mask(out, data['rle_string'], data['mask_size'], data['bbox'])
+    return out
+
+def composite_frames(data, frame_numbers, frame_size, object_id=None, threads=None):
+    '''
+    Assemble the masks of a range of frames, the frames are assembled in a thread pool into a single array
+
+    Parameters
+    ----------
+    data : dict or util.mask_container.FrameData
+        the 'data' part of a segmentation output, see util.mask_container.open_rle
+    frame_numbers : iterable of int
+    frame_size : list of int
+        [width, height] of the frames
+    object_id : int
+        keep only the objects of this id, all the objects if None
+    threads : int
+        the number of threads, config.mask_threads if None
 
-    return mask
+    Returns
+    -------
+    masks : numpy array
+        uint8 masks of shape (frames, height, width), 255 on the objects
+    '''
+    frame_numbers = list(frame_numbers)
+    masks = np.empty((len(frame_numbers), frame_size[1], frame_size[0]), dtype=np.uint8)
+
+    def _composite(i):
+        composite_masks(get_frame_objects(data, frame_numbers[i], object_id), frame_size, out=masks[i])
+
+    with ThreadPoolExecutor(max_workers=threads or config.mask_threads, thread_name_prefix="mask") as pool:
+        list(pool.map(_composite, range(len(frame_numbers))))
+    return masks
 
 def _get_masks(rle_path_, start_frame_, finish_frame_, object_name):
     target_object = { 'name': object_name, 'id': None }
 
-    # Read rail rle json data
-    with open(rle_path_, 'r') as f:
-        rle_data = json.load(f)
+    # Read rail rle json data, or the container converted from it (util.mask_container), the frames are read when accessed
+    rle_data = open_rle(rle_path_)
 
     # Check object name and get object id
     assert(target_object['name'] in rle_data['object_name_list'])
@@ -55,20 +140,10 @@ def _get_masks(rle_path_, start_frame_, finish_frame_, object_name):
     frame_size = rle_data['target_frame_size']
     assert(start_frame <= start_frame_ and finish_frame_ <= finish_frame)
 
-    masks = []
-    for frame_number in range(start_frame_, finish_frame_ + 1):
-        data_cur_frame = rle_data['data']['frame_%s' % frame_number]
-        rail_data_cur_frame = [data for data in data_cur_frame if data['object_id'] == target_object['id']]
-        mask = np.zeros((frame_size[1], frame_size[0]), dtype=np.uint8)
-        for data in rail_data_cur_frame:
-            mask_size = data['mask_size']
-            obj_bbox = data['bbox']
-            rle_string = data['rle_string']
-            mask_ = to_mask(rle_string, mask_size, obj_bbox, frame_size)
-            mask = np.maximum(mask, mask_)
-        masks.append(mask)
+    # the objects of a frame are composited into one mask, see composite_masks
+    masks = composite_frames(rle_data['data'], range(start_frame_, finish_frame_ + 1), frame_size, target_object['id'])
 
-    return masks
+    return list(masks)
 
 def get_rail_masks(rle_path, start_frame, finish_frame):
     return _get_masks(rle_path, start_frame, finish_frame, 'Rail')
@@ -76,58 +151,163 @@ def get_rail_masks(rle_path, start_frame, finish_frame):
 def get_rail_pole_masks(rle_path, start_frame, finish_frame):
     return _get_masks(rle_path, start_frame, finish_frame, 'RailPole')
 
-def get_masks_for_homograhy(rail_mask_path, rail_pole_mask_path, semantic_mask_path, start_frame, end_frame):
+class PackedMasks:
+
     '''
-    Read the rail masks and the segmentation masks into memory and assemble them into a single mask per frame for optical flow estimation
+    A stack of binary masks stored bit-packed with np.packbits, 8 times smaller than a bool array. Indexing returns the dense bool masks, i.e. masks[i], masks[i:j], masks[i, y0:y1, x0:x1] or masks[:, y, x],
+    only the masks selected by the first index are unpacked. Use np.asarray(masks) for the other methods of a bool array of shape (frames, height, width)
+
+    Parameters
+    ----------
+    frames : int
+        the number of masks
+    height : int
+    width : int
     '''
-    
-    rail_data = json.load(open(rail_mask_path, "r"))
+
+    dtype = np.dtype(bool)
+    ndim = 3
+
+    def __init__(self, frames, height, width):
+        self.shape = (frames, height, width)
+        self.packed = np.zeros((frames, (height * width + 7) // 8), dtype=np.uint8)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def _unpack(self, packed):
+        masks = np.unpackbits(packed, axis=-1, count=self.shape[1] * self.shape[2]).view(bool)
+        return masks.reshape(packed.shape[:-1] + self.shape[1:])
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            return self._unpack(self.packed[index])
+        if not index or index[0] is Ellipsis:
+            return np.asarray(self)[index]
+        masks = self._unpack(self.packed[index[0]])
+        # the rest of the index applies to the unpacked masks, after their frame axis unless a single mask was selected
+        return masks[index[1:]] if masks.ndim == 2 else masks[(slice(None),) + index[1:]]
+
+    def __setitem__(self, index, masks):
+        masks = np.asarray(masks, dtype=bool)
+        self.packed[index] = np.packbits(masks.reshape(masks.shape[:-2] + (-1,)), axis=-1)
+
+    def __iter__(self):
+        for packed in self.packed:
+            yield self._unpack(packed)
+
+    def __array__(self, dtype=None):
+        masks = self._unpack(self.packed)
+        return masks if dtype is None else masks.astype(dtype)
+
+
+_homography_kernel = (18, 18) # the size of the dilation kernel of the rail and rail pole masks
+_homography_border = 35 # the border of the frame where the segmentation masks are ignored
+
+def _homography_rle(rail_mask_string, rail_pole_mask_data, seg_mask_data, frame_size=(1920, 1080)):
+    # assemble the mask of a frame from the rail, the rail pole and the segmentation masks as an RLE, without decoding the masks (see util.mask_algebra)
+    width, height = frame_size
+    size = [height, width]
+
+    # load rail mask
+    rles = [mask_algebra.dilate(mask_algebra.to_rle(rail_mask_string, size), _homography_kernel)]
+
+    # load rail pole mask, dilated inside of its bbox
+    for i in range(len(rail_pole_mask_data)):
+      loc = rail_pole_mask_data[i]["bbox"]
+      m = mask_algebra.dilate(mask_algebra.to_rle(rail_pole_mask_data[i]["rle_string"], [loc[3], loc[2]]), _homography_kernel)
+      rles.append(mask_algebra.embed(m, loc[:2], size))
+
+    # load seg mask keep background, foreground, rail and pole
+    border = _homography_border
+    for i in range(len(seg_mask_data)):
+      object_id = seg_mask_data[i]["object_id"]
+      if object_id in [0, 3]:
+        m = mask_algebra.crop(mask_algebra.to_rle(seg_mask_data[i]["rle_string"], size), [border, border, width - 2 * border, height - 2 * border])
+        rles.append(mask_algebra.embed(m, [border, border], size))
+
+    return mask_algebra.merge(rles)
+
+def _homography_mask(rail_mask_string, rail_pole_mask_data, seg_mask_data, frame_size=(1920, 1080)):
+    # the dense bool mask of _homography_rle
+    rle = _homography_rle(rail_mask_string, rail_pole_mask_data, seg_mask_data, frame_size)
+    return mask_algebra.decode(rle).astype(bool, order='C')
+
+def iter_masks_for_homography(rail_mask_path, rail_pole_mask_path, semantic_mask_path, start_frame, end_frame, threads=None, rle=False):
+    '''
+    Read the rail masks and the segmentation masks and assemble them into a single mask per frame for optical flow estimation, one frame at a time.
+    The masks of the next frames are assembled ahead in a thread pool
+
+    Parameters
+    ----------
+    rail_mask_path : string
+    rail_pole_mask_path : string
+    semantic_mask_path : string
+    start_frame : int
+    end_frame : int
+    threads : int
+        the number of threads assembling the masks, config.mask_threads if None
+    rle : bool
+        if True, yield the masks as COCO RLE without decoding them, i.e. for mask statistics with util.mask_algebra
+
+    Returns
+    -------
+    masks : generator
+        (frame index relative to start_frame, bool mask of shape (1080, 1920) or RLE), for the frames that have a rail mask
+    '''
+
+    rail_data = open_rle(rail_mask_path)
     rail_data = rail_data['data']
 
-    pole_data = json.load(open(rail_pole_mask_path, "r"))
+    pole_data = open_rle(rail_pole_mask_path)
     pole_data = pole_data['data']
-    
-    seg_data = json.load(open(semantic_mask_path, "r"))
+
+    seg_data = open_rle(semantic_mask_path)
     seg_data = seg_data['data']
-    
-    masks = np.zeros((end_frame-start_frame+1, 1080, 1920), dtype=np.bool)
-    
-    print("Loading Segmenation Result. Takes a approximately a minute")
-    
-    for key in rail_data.keys():
-      if key in ['start_frame', 'finish_frame']:
-        continue
-      frame = int(key.split("_")[-1]) - start_frame
-      mask = np.zeros((1080, 1920), np.bool)
-      kernel = np.ones((18,18),np.uint8)
-      
-      # load rail mask
-      rail_mask_string = rail_data[key]
-      encoded_mask = str.encode(rail_mask_string)
-      m = np.asarray(mask_save_tool.decode({'size':[1080, 1920], 'counts': encoded_mask}), np.uint8)
-      m = cv2.dilate(m,kernel)
-      mask = np.logical_or(mask, m.astype(np.bool))
-
-      # load rail pole mask
-      rail_pole_mask_data = pole_data[key]
-      for i in range(len(rail_pole_mask_data)):
-        loc = rail_pole_mask_data[i]["bbox"]
-        
-        encoded_mask = str.encode(rail_pole_mask_data[i]["rle_string"])
-        m = np.asarray(mask_save_tool.decode({'size':[loc[3], loc[2]], 'counts': encoded_mask}), np.uint8)
-        m = cv2.dilate(m,kernel)
-        mask[loc[1]:loc[1]+loc[3],loc[0]:loc[0]+loc[2]] = np.logical_or(mask[loc[1]:loc[1]+loc[3],loc[0]:loc[0]+loc[2]], m.astype(np.bool))
-      
-      # load seg mask keep background, foreground, rail and pole
-      seg_mask_data = seg_data[key]
-      for i in range(len(seg_mask_data)):
-        object_id = seg_mask_data[i]["object_id"]   
-        if object_id in [0, 3]:
-          encoded_mask = str.encode(seg_mask_data[i]["rle_string"])
-          decoded_mask = np.asarray(mask_save_tool.decode({'size':[1080, 1920], 'counts': encoded_mask}), np.uint8).astype(np.bool)
-          mask[35:1080-35,35:1920-35] = np.logical_or(mask[35:1080-35,35:1920-35], decoded_mask[35:1080-35,35:1920-35])
-
-      masks[frame,:,:] = mask
-
-    return masks    
 
+    keys = ['frame_%d' % frame_number for frame_number in range(start_frame, end_frame + 1) if 'frame_%d' % frame_number in rail_data]
+    threads = threads or config.mask_threads
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="mask") as pool:
+        pending = deque()
+        for key in keys:
+            pending.append((int(key.split("_")[-1]) - start_frame, pool.submit(_homography_rle if rle else _homography_mask, rail_data[key], pole_data[key], seg_data[key])))
+            if len(pending) >= 2 * threads:
+                frame, future = pending.popleft()
+                yield frame, future.result()
+        while pending:
+            frame, future = pending.popleft()
+            yield frame, future.result()
+
+def get_masks_for_homograhy(rail_mask_path, rail_pole_mask_path, semantic_mask_path, start_frame, end_frame, packed=False):
+    '''
+    Read the rail masks and the segmentation masks into memory and assemble them into a single mask per frame for optical flow estimation
+
+    Parameters
+    ----------
+    rail_mask_path : string
+    rail_pole_mask_path : string
+    semantic_mask_path : string
+    start_frame : int
+    end_frame : int
+    packed : bool
+        if True, return the masks bit-packed as PackedMasks (8 times smaller) instead of a bool array
+
+    Returns
+    -------
+    masks : PackedMasks or numpy array
+        masks of shape (end_frame - start_frame + 1, 1080, 1920), indexing PackedMasks returns the dense bool masks
+    '''
+
+    frames = end_frame - start_frame + 1
+    masks = PackedMasks(frames, 1080, 1920) if packed else np.zeros((frames, 1080, 1920), dtype=bool)
+
+    print("Loading Segmenation Result")
+
+    for frame, mask in iter_masks_for_homography(rail_mask_path, rail_pole_mask_path, semantic_mask_path, start_frame, end_frame):
+      masks[frame] = mask
+
+    return masks
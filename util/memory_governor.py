@@ -0,0 +1,249 @@
+import os
+import time
+import weakref
+import tempfile
+import threading
+from collections.abc import Sequence
+import numpy as np
+import psutil
+import config
+
+
+class SpillableFrames(Sequence):
+
+    '''
+    List of encoded frames (Result.frames) whose oldest frames can be moved to a segment file on disk under memory pressure. The spilled frames are still indexed like the frames in memory,
+    they are read back from the file when accessed, so the tasks work on the frame set without knowing which frames were spilled. The file is removed when the frame set is dropped.
+
+    Parameters
+    ----------
+    frames : list
+        the encoded frames (bytes) or the decoded frames (numpy arrays) of the raw codec
+    spill_dir : string
+        the directory of the segment file, config.memory['spill_dir'] or the temporary directory if None
+    '''
+
+    def __init__(self, frames=None, spill_dir=None):
+        self._frames = list(frames) if frames is not None else []
+        self._spilled = {} # index: (offset, length, shape of a numpy frame or None)
+        self._spill_dir = spill_dir or config.memory['spill_dir'] or tempfile.gettempdir()
+        self._file = None
+        self._finalizer = None # closes the segment file when the frame set is dropped
+        self._size = 0 # bytes written to the segment file
+        self._next = 0 # the frames before this index are spilled, the oldest frames are spilled first
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # a copy sent to another process takes all the frames in memory
+        return {'frames': list(self), 'spill_dir': self._spill_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._frames)))]
+        item = self._frames[index]
+        if item is not None:
+            return item
+        index = index % len(self._frames)
+        offset, length, shape = self._spilled[index]
+        data = self._read(offset, length)
+        return data if shape is None else np.frombuffer(bytearray(data), np.uint8).reshape(shape)
+
+    def append(self, item):
+        with self._lock:
+            self._frames.append(item)
+
+    @property
+    def spilled(self):
+        ''' the number of frames on disk '''
+        return len(self._spilled)
+
+    @property
+    def spilled_bytes(self):
+        return self._size
+
+    def _read(self, offset, length):
+        if hasattr(os, 'pread'):
+            return os.pread(self._file.fileno(), length, offset)
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+    def spill(self, nbytes):
+
+        '''
+        move the oldest frames in memory to the segment file
+
+        Parameters
+        ----------
+        nbytes : int
+            the number of bytes to free
+
+        Returns
+        -------
+        freed : int
+            the bytes of the frames moved to disk, less than nbytes if all the frames are on disk or if the segment file is closed already
+        '''
+
+        freed = 0
+        with self._lock:
+            if self._finalizer is not None and not self._finalizer.alive: # the offsets of the spilled frames point into the closed file
+                return 0
+            if self._file is None:
+                os.makedirs(self._spill_dir, exist_ok=True)
+                # the file is unlinked at once on posix, the space is given back when the frame set is dropped, even if the process is killed
+                self._file = tempfile.TemporaryFile(prefix='frames_', suffix='.seg', dir=self._spill_dir)
+                self._finalizer = weakref.finalize(self, self._file.close)
+            chunks = []
+            while freed < nbytes and self._next < len(self._frames):
+                item = self._frames[self._next]
+                shape = item.shape if isinstance(item, np.ndarray) else None
+                data = np.ascontiguousarray(item).tobytes() if shape is not None else item
+                self._spilled[self._next] = (self._size, len(data), shape)
+                chunks.append(data)
+                self._size += len(data)
+                freed += len(data)
+                self._next += 1
+            if chunks:
+                self._file.seek(0, os.SEEK_END)
+                self._file.write(b''.join(chunks))
+                self._file.flush()
+                for index in range(self._next - len(chunks), self._next):
+                    self._frames[index] = None
+        return freed
+
+
+class MemoryGovernor:
+
+    '''
+    Watch the memory of the machine and the RSS of the process in a background thread and relieve the pressure instead of failing: below config.memory['spill_below'] of the RAM available or above config.memory['max_rss'],
+    the oldest frames of the registered frame sets are spilled to disk (see SpillableFrames),
+    below config.memory['throttle_below'] the producers calling throttle, i.e. load_vid, wait until the memory is available again. The decoding goes on more slowly but does not raise MemoryError.
+
+    Parameters
+    ----------
+    spill_below : float
+        the fraction of the RAM available under which the frames are spilled, config.memory['spill_below'] if None
+    throttle_below : float
+        the fraction of the RAM available under which the producers wait, config.memory['throttle_below'] if None
+    max_rss : float
+        the RSS of the process in GB above which the frames are spilled, config.memory['max_rss'] if None, no limit if both are None
+    interval : float
+        seconds between two checks of the memory, config.memory['poll_interval'] if None
+    '''
+
+    def __init__(self, spill_below=None, throttle_below=None, max_rss=None, interval=None):
+        self.spill_below = spill_below if spill_below is not None else config.memory['spill_below']
+        self.max_rss = max_rss if max_rss is not None else config.memory['max_rss']
+        self.process = psutil.Process()
+        self.throttle_below = throttle_below if throttle_below is not None else config.memory['throttle_below']
+        self.interval = interval if interval is not None else config.memory['poll_interval']
+        self._frame_sets = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._relieved = threading.Event() # set while the memory is above throttle_below
+        self._relieved.set()
+        self._waiting = False # a producer is waiting, the message is printed once per period of pressure
+        self._gave_up = False # a wait timed out, the producers go on without waiting until the memory comes back
+        self._thread = None
+        self.stats = {'spilled_bytes': 0, 'throttled_time': 0.}
+
+    def available(self):
+        ''' the fraction of the RAM available '''
+        memory = psutil.virtual_memory()
+        return memory.available / memory.total
+
+    def register(self, frames):
+        ''' watch a frame set, its frames are spilled under memory pressure '''
+        with self._lock:
+            self._frame_sets.add(frames)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name="memory_governor", daemon=True)
+                self._thread.start()
+        return frames
+
+    def relieve(self):
+
+        '''
+        check the memory once, spill and throttle as needed
+
+        Returns
+        -------
+        available : float
+            the fraction of the RAM available
+        '''
+
+        memory = psutil.virtual_memory()
+        available = memory.available / memory.total
+        # free a little more than needed, so the frames are not spilled a few at a time
+        nbytes = int((self.spill_below - available + 0.02) * memory.total) if available < self.spill_below else 0
+        if self.max_rss is not None:
+            nbytes = max(nbytes, int(self.process.memory_info().rss - self.max_rss * 1024**3 * 0.95))
+        if nbytes > 0:
+            freed = 0
+            with self._lock:
+                frame_sets = list(self._frame_sets)
+            for frames in frame_sets:
+                if freed >= nbytes:
+                    break
+                freed += frames.spill(nbytes - freed)
+            if freed:
+                self.stats['spilled_bytes'] += freed
+                print(f"Memory available {available * 100:.0f}%, spilled {freed / 1024**2:.0f} MB of frames to disk")
+                available = psutil.virtual_memory().available / memory.total
+        if available < self.throttle_below:
+            self._relieved.clear()
+        else:
+            if not self._relieved.is_set() and (self._waiting or self._gave_up):
+                print(f"Memory available {available * 100:.0f}%, decoding goes on")
+            self._waiting = self._gave_up = False
+            self._relieved.set()
+        return available
+
+    def _watch(self):
+        while True:
+            self.relieve()
+            time.sleep(self.interval)
+
+    def throttle(self, timeout=None):
+
+        '''
+        wait while the memory is under throttle_below, called by the producers of frames between two frames. It returns at once when the memory is available
+
+        The timeout is shared by all the calls of a period of pressure: once a wait timed out, i.e. when the memory is taken by other processes and does not come back,
+        the producers go on without waiting until the memory is above throttle_below again, so a long frame set is not slowed down by the timeout on every frame
+
+        Parameters
+        ----------
+        timeout : float
+            the maximum seconds to wait, config.memory['max_wait'] if None
+        '''
+
+        if self._relieved.is_set() or self._gave_up:
+            return
+        start = time.time()
+        if not self._waiting:
+            self._waiting = True
+            print(f"Memory available {self.available() * 100:.0f}%, waiting for memory")
+        if not self._relieved.wait(timeout if timeout is not None else config.memory['max_wait']):
+            if not self._gave_up:
+                self._gave_up = True
+                print(f"Memory available {self.available() * 100:.0f}% after waiting, going on without waiting until the memory is available")
+        self.stats['throttled_time'] += time.time() - start
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_governor():
+    ''' the memory governor of the process '''
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = MemoryGovernor()
+        return _governor
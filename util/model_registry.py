@@ -0,0 +1,212 @@
+import gc
+import sys
+import time
+import threading
+from collections import OrderedDict
+import psutil
+import config
+
+
+def model_size(model):
+
+    '''
+    estimate the RAM taken by a loaded model from its parameters and buffers, i.e. a torch.nn.Module, or a tuple/list/dict of them (encoder and decoder)
+
+    Parameters
+    ----------
+    model : object
+
+    Returns
+    -------
+    size : float
+        size in GB, None if the model has no parameters to count (i.e. a tensorflow graph)
+    '''
+
+    if isinstance(model, dict):
+        model = list(model.values())
+    if isinstance(model, (list, tuple)):
+        sizes = [model_size(m) for m in model]
+        return None if any(s is None for s in sizes) else sum(sizes)
+    if hasattr(model, 'parameters') and hasattr(model, 'buffers'):
+        tensors = list(model.parameters()) + list(model.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors) / 1024**3
+    return None
+
+
+class ModelRegistry:
+
+    '''
+    Thread-safe registry of the loaded models, kept across the videos of a process so the networks are built and their weights read only once. A model is keyed by (task, model_type) of config.get_model_info,
+    i.e. ('Detection', 'HongKong'), ('Conn', 'HVT'). The least recently used models are dropped when the models take more RAM than the budget, the tasks asking for a model that is being loaded wait for it.
+
+    Parameters
+    ----------
+    max_rss : float
+        the RAM budget of the models in GB, config.model_registry['max_rss'] if None. The last loaded model is kept even if it alone is larger than the budget
+    '''
+
+    def __init__(self, max_rss=None):
+        self.max_rss = max_rss if max_rss is not None else config.model_registry['max_rss']
+        self._models = OrderedDict() # key: (model, size in GB)
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'loads': 0, 'evictions': 0, 'load_time': 0.}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._models
+
+    def __len__(self):
+        return len(self._models)
+
+    @property
+    def rss(self):
+        ''' the RAM taken by the loaded models in GB '''
+        with self._lock:
+            return sum(size for _, size in self._models.values())
+
+    def get(self, key, loader, size=None):
+
+        '''
+        get a model, load it if it is not in the registry
+
+        Parameters
+        ----------
+        key : tuple
+            (task, model_type)
+        loader : function
+            called without argument to build the model and load its weights if it is not in the registry
+        size : float
+            the RAM taken by the model in GB. If None, it is counted from the parameters of the model (see model_size) or measured as the RAM taken by the loader
+
+        Returns
+        -------
+        model : object
+            what the loader returns
+        '''
+
+        while True:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return self._models[key][0]
+                event = self._loading.get(key)
+                if event is None:
+                    event = self._loading[key] = threading.Event()
+                    break
+            # another task is loading the same model, wait for it. If it failed, try to load it here
+            event.wait()
+
+        try:
+            start, rss = time.time(), psutil.Process().memory_info().rss
+            model = loader()
+            if size is None:
+                size = model_size(model)
+            if size is None:
+                size = max(0, psutil.Process().memory_info().rss - rss) / 1024**3
+            with self._lock:
+                self._models[key] = (model, size)
+                self.stats['loads'] += 1
+                self.stats['load_time'] += time.time() - start
+                evicted = self._evict()
+            print(f"Loaded model {key} ({size:.2f} GB) in {time.time() - start:.1f}s")
+            if evicted:
+                self._release()
+            return model
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+    def load(self, model_dir, track, task, loader, distance=None, course=None):
+
+        '''
+        get the model of a task for a track, see config.get_model_info
+
+        Parameters
+        ----------
+        model_dir : string
+            the directory of the trained models
+        track : string
+            i.e. HVT, STT, Kranji
+        task : string
+            the model task of config.get_model_paths, i.e. 'Detection', 'ReID', 'DDFlow'
+        loader : function
+            called as loader(network_path, mean_path, batch) to build the model if it is not in the registry
+
+        Returns
+        -------
+        model : object
+        '''
+
+        network_path, mean_path, batch = config.get_model_info(model_dir, track, task, distance, course)
+        return self.get((task, config.get_model_type(track, task)), lambda: loader(network_path, mean_path, batch))
+
+    def _evict(self):
+        # drop the least recently used models above the budget, called with the lock held
+        evicted = []
+        while len(self._models) > 1 and sum(size for _, size in self._models.values()) > self.max_rss:
+            key, _ = self._models.popitem(last=False)
+            evicted.append(key)
+            self.stats['evictions'] += 1
+        if evicted:
+            print(f"Evicted models {evicted}")
+        return evicted
+
+    def _release(self):
+        # free the memory of the dropped models, the GPU memory is kept by the torch allocator until emptied
+        gc.collect()
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def evict(self, key):
+        ''' drop a model, i.e. after updating its weights on disk '''
+        with self._lock:
+            self._models.pop(key, None)
+        self._release()
+
+    def clear(self):
+        ''' drop all the models '''
+        with self._lock:
+            self._models.clear()
+        self._release()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    ''' the model registry of the process, the models stay loaded across the videos processed by the process (main.py, a worker of util.scheduler or the service of util.service) '''
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+        return _registry
+
+
+def load_model(horseracingResult, task, loader, vid_name=None):
+
+    '''
+    get the model of a task for the track of a video from the registry of the process, the way the tasks load their models
+
+    Parameters
+    ----------
+    horseracingResult : object
+        the result object, for the model directory and the race info
+    task : string
+        the model task of config.get_model_paths
+    loader : function
+        called as loader(network_path, mean_path, batch) to build the model if it is not loaded
+    vid_name : string
+        the video, horseracingResult.processing_vid_name if None
+
+    Returns
+    -------
+    model : object
+    '''
+
+    race_info = horseracingResult.race_info[vid_name or horseracingResult.processing_vid_name]
+    return get_registry().load(horseracingResult.model_dir, race_info['track'], task, loader, race_info.get('distance'), race_info.get('course'))
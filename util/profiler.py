@@ -0,0 +1,253 @@
+'''
+Instrumentation of the tasks (main.py --profile): the wall time, CPU time, peak RAM and frames processed of every (video, task) and of the named stages inside the tasks (decode, inference, postprocess, write).
+
+A stage is recorded by the context manager profile_stage, the stages of a thread nest and take the video and the task of the enclosing stage:
+
+    with profile_stage('inference', frames=len(batch)) as stage:
+        ...
+        stage.frames += extra_frames
+
+The records are written by flush to files of the process in the result directory, so the worker processes of util.scheduler do not write to the same files, and merge_profiles appends them to the Chrome trace
+(chrome://tracing or https://ui.perfetto.dev) and to the summary csv once the workers are done. The files left by an interrupted run are merged by the next run.
+When the profiling is off, profile_stage returns a shared no-op object, so the hooks can stay in the code.
+The CPU time is the CPU time of the process, it includes the tasks running at the same time on other threads. The peak RAM is the largest RSS of the process sampled while the stage runs.
+'''
+
+import os
+import csv
+import glob
+import json
+import time
+import threading
+import psutil
+import config
+
+
+class _NullStage:
+    # the stage when the profiling is off, the attributes set by the hooks are dropped
+    frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+class Stage:
+
+    '''
+    a stage being recorded, see Profiler.stage
+
+    Attributes
+    ----------
+    frames : int
+        the frames processed in the stage, can be updated while the stage runs
+    '''
+
+    def __init__(self, profiler, name, vid_name, task, frames):
+        self.profiler = profiler
+        self.name = name
+        self.vid_name = vid_name
+        self.task = task
+        self.frames = frames or 0
+
+    def __enter__(self):
+        self.profiler._open(self)
+        self.cpu = time.process_time()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.wall = time.time() - self.start
+        self.cpu = time.process_time() - self.cpu
+        self.failed = exc_type is not None
+        self.profiler._close(self)
+        return False
+
+
+class Profiler:
+
+    '''
+    Records the stages of the process, see the module docstring
+
+    Parameters
+    ----------
+    enabled : bool
+        record the stages, config.profiling['enabled'] if None
+    sample_interval : float
+        seconds between two samples of the RAM of the process, config.profiling['sample_interval'] if None
+    '''
+
+    def __init__(self, enabled=None, sample_interval=None):
+        self.enabled = enabled if enabled is not None else config.profiling['enabled']
+        self.sample_interval = sample_interval if sample_interval is not None else config.profiling['sample_interval']
+        self.process = psutil.Process()
+        self.pid = os.getpid()
+        self._local = threading.local() # the stack of open stages of a thread
+        self._open_stages = set()
+        self._records = []
+        self._samples = [] # (time, rss)
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def stage(self, name, vid_name=None, task=None, frames=None):
+
+        '''
+        record a stage
+
+        Parameters
+        ----------
+        name : string
+            i.e. 'decode', 'inference', 'postprocess', 'write', or the name of a task
+        vid_name : string
+            the video, taken from the enclosing stage of the thread if None
+        task : int
+            the task, taken from the enclosing stage of the thread if None
+        frames : int
+            the frames processed in the stage, see Stage.frames
+
+        Returns
+        -------
+        stage : context manager
+        '''
+
+        if not self.enabled:
+            return _null_stage
+        parent = self._stack()[-1] if self._stack() else None
+        if parent is not None:
+            vid_name = vid_name if vid_name is not None else parent.vid_name
+            task = task if task is not None else parent.task
+        return Stage(self, name, vid_name, task, frames)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _open(self, stage):
+        stage.tid = threading.get_ident()
+        stage.depth = len(self._stack())
+        stage.peak = self.process.memory_info().rss
+        self._stack().append(stage)
+        with self._lock:
+            self._open_stages.add(stage)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+                self._sampler.start()
+
+    def _close(self, stage):
+        rss = self.process.memory_info().rss
+        self._stack().remove(stage)
+        with self._lock:
+            self._open_stages.discard(stage)
+            stage.peak = max(stage.peak, rss)
+            self._records.append(stage)
+
+    def _sample(self):
+        # the peak RAM of the open stages, and the RAM counter of the trace
+        while True:
+            time.sleep(self.sample_interval)
+            rss = self.process.memory_info().rss
+            with self._lock:
+                for stage in self._open_stages:
+                    stage.peak = max(stage.peak, rss)
+                if self._open_stages:
+                    self._samples.append((time.time(), rss))
+
+    def flush(self, result_dir):
+
+        '''
+        write the finished stages to the trace and summary files of the process in the result directory, see merge_profiles
+
+        Parameters
+        ----------
+        result_dir : string
+            the directory of the output
+        '''
+
+        if not self.enabled:
+            return
+        with self._lock:
+            records, self._records = self._records, []
+            samples, self._samples = self._samples, []
+        if not records and not samples:
+            return
+
+        # the JSON array format of the Chrome trace does not need the closing bracket, so the events of the processes are appended to the same trace
+        events = [{
+            'name': stage.name, 'cat': 'task' if stage.depth == 0 else 'stage', 'ph': 'X', 'pid': self.pid, 'tid': stage.tid,
+            'ts': int(stage.start * 1e6), 'dur': int(stage.wall * 1e6),
+            'args': {'video': stage.vid_name, 'task': stage.task, 'cpu_s': round(stage.cpu, 3), 'peak_rss_mb': round(stage.peak / 1024**2, 1), 'frames': stage.frames, 'failed': stage.failed},
+        } for stage in records]
+        events += [{'name': 'rss', 'ph': 'C', 'pid': self.pid, 'ts': int(t * 1e6), 'args': {'rss_mb': round(rss / 1024**2, 1)}} for t, rss in samples]
+        with open(_process_path(result_dir, config.profiling['trace'], self.pid), 'a') as f:
+            f.write(''.join(json.dumps(event) + ',\n' for event in events))
+
+        with open(_process_path(result_dir, config.profiling['summary'], self.pid), 'a', newline='') as f:
+            writer = csv.writer(f)
+            for stage in records:
+                fps = stage.frames / stage.wall if stage.frames and stage.wall > 0 else ''
+                writer.writerow([stage.vid_name, stage.task, stage.name, stage.depth, self.pid, round(stage.start, 3), round(stage.wall, 4), round(stage.cpu, 4),
+                                 round(stage.peak / 1024**2, 1), stage.frames, round(fps, 2) if fps else '', int(stage.failed)])
+
+
+_summary_header = ['video', 'task', 'stage', 'depth', 'pid', 'start', 'wall_s', 'cpu_s', 'peak_rss_mb', 'frames', 'fps', 'failed']
+
+
+def _process_path(result_dir, name, pid):
+    # the file of a process, i.e. profile_trace.1234.json for profile_trace.json
+    root, ext = os.path.splitext(os.path.join(result_dir, name))
+    return f"{root}.{pid}{ext}"
+
+
+def merge_profiles(result_dir):
+
+    '''
+    append the files written by the processes (see Profiler.flush) to the Chrome trace and to the summary csv of the result directory (config.profiling['trace'] and config.profiling['summary']) and remove them.
+    Called by the main process once the worker processes are done
+
+    Parameters
+    ----------
+    result_dir : string
+        the directory of the output
+    '''
+
+    for name, header in [(config.profiling['trace'], '[\n'), (config.profiling['summary'], ','.join(_summary_header) + '\r\n')]:
+        path = os.path.join(result_dir, name)
+        root, ext = os.path.splitext(path)
+        parts = [part for part in glob.glob(glob.escape(root) + '.*' + ext) if part[len(root) + 1:-len(ext) or None].isdigit()]
+        if not parts:
+            continue
+        with open(path, 'a', newline='') as f:
+            if f.tell() == 0:
+                f.write(header)
+            for part in sorted(parts, key=os.path.getmtime):
+                with open(part, 'r', newline='') as p:
+                    f.write(p.read())
+                os.remove(part)
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_profiler():
+    ''' the profiler of the process, created from config.profiling on first use, i.e. after the worker processes of util.scheduler took the settings of the main process '''
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            _profiler = Profiler()
+        return _profiler
+
+
+def profile_stage(name, vid_name=None, task=None, frames=None):
+    ''' record a stage with the profiler of the process, see Profiler.stage '''
+    return get_profiler().stage(name, vid_name, task, frames)
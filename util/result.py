@@ -1,10 +1,19 @@
-import os, csv, copy, config
-import pandas as pd
+import os, copy, config
+
 import numpy as np
-from util.database import HorseRacingDB
-from util.video_util import load_vid, find_fps
+from util.database import RaceInfoCache, find_races, match_race_documents, load_race_documents
+from util.video_util import load_vid, load_vid_parallel, find_fps, FrameSource
+from util.video_probe import probe_video, get_probe
+from util.frame_store import FrameStore
+from util.shared_frames import SharedFrameStore
+from util.frame_cache import FrameCache
+from util.catalogue import ResultCatalogue, read_scene_classification_csv
+from util.export import read_final_result, race_config_table, export_videos
 from ast import literal_eval
 import gc
+from collections import deque
+from util.image_util import decode_img, decode_batch, get_decode_pool
+from util.profiler import profile_stage
 
 
 def get_directories(result_dir, tasks):
@@ -15,13 +24,16 @@ def create_dir(directory_list):
         if not os.path.exists(directory):
             os.mkdir(directory)
 
-def get_data_from_database(vid_names):
+def get_data_from_database(vid_names, cache_path=None):
     '''
-    connect to the mongoDB to obtain the jockeys and race info such as course, distance and track
+    get the jockeys and race info such as course, distance and track, from the race info cache and the mongoDB for the videos not in the cache.
+    In offline mode (config.race_info['offline']), the database is not used, the race info comes from the cache whatever its age and the local source file
     
     Parameters
     ----------
     vid_names : string
+    cache_path : string
+        the race info cache, see util.database.RaceInfoCache. No cache if None
     
     Returns
     -------
@@ -32,61 +44,49 @@ def get_data_from_database(vid_names):
         key : Video name
         item: a dictionary {'track': track, 'distance': distance, 'course': course}
     '''
+    settings = config.race_info
+    cache = RaceInfoCache(cache_path, settings['ttl']) if cache_path else None
+    races = cache.get(vid_names, stale=settings['offline']) if cache else {}
+    # the videos without race info in the cache are looked up again, i.e. a race entered in the database after a previous run
+    misses = [vid_name for vid_name in vid_names if races.get(vid_name, (None, None))[0] is None]
+
+    if misses:
+        found = None
+        if settings['source']:
+            # the local stand-in of the database can be partial, its race info is not cached
+            found = match_race_documents(load_race_documents(settings['source']), misses)
+        elif not settings['offline']:
+            # a single query for all the videos not in the cache
+            from pymongo.errors import PyMongoError
+            try:
+                found = find_races(misses, settings['timeout'])
+            except PyMongoError as e:
+                print(f"Race info database not available ({e}), using the cached race info")
+            else:
+                # only the videos found are cached, the others are queried again by the next run
+                if cache and found:
+                    cache.put(found)
+        if found is None and cache:
+            found = cache.get(misses, stale=True)
+        races.update(found or {})
+
+    missing = sorted(vid_name for vid_name in vid_names if races.get(vid_name, (None, None))[0] is None)
+    if missing:
+        print(f"No race info for {len(missing)} videos: {missing}")
+
     jockeys, race_info = {}, {}
-    # separate the video names into framesetid and racelabel. They will be processed differently
-    framesetidlist = [int(vid_name) for vid_name in vid_names if len(vid_name) == 4]
-    racelabellist = [vid_name for vid_name in vid_names if len(vid_name) != 4]
-    db = HorseRacingDB()
-    collection = db.conn.gtinfo['newfullraceinfo']
-
-    # for framesetid
-    race_objs = collection.find({'framesetid': { "$in": framesetidlist } })
-    for obj in race_objs:
-        track, distance, course = obj['trackabbr'], obj['length'], obj['railorcoursetype']
-        race_info[str(obj["framesetid"]).zfill(4)] = {"track": track, "distance": distance, "course": course}
-        if 'jockeys' in obj.keys():
-            jockey_info = obj['jockeys']
-            jockeys[str(obj['framesetid']).zfill(4)] = [ int(ji['jockeynumber']) for ji in jockey_info if ji['place'] is not None]
-
-    # for racelabel
-    race_objs = collection.find({'racelabel': { "$in": racelabellist } })
-    for obj in race_objs:
-        track, distance, course = obj['trackabbr'], obj['length'], obj['railorcoursetype']
-        race_info[obj["racelabel"]] = {"track": track, "distance": distance, "course": course}   
-        if 'jockeys' in obj.keys():
-            jockey_info = obj['jockeys']
-            jockeys[obj['racelabel']] = [ int(ji['jockeynumber']) for ji in jockey_info if ji['place'] is not None]
-    
+    for vid_name, (info, jockey_list) in races.items():
+        if info is not None:
+            race_info[vid_name] = info
+        if jockey_list is not None:
+            jockeys[vid_name] = jockey_list
     return jockeys, race_info
 
 def import_subsequences_results(path):
-    # import trajectories from result
-    f = open(path + ".csv", "r")
-    csv_reader = csv.reader(f, delimiter=",")
-    detected_boxes = []
-    stf = 0
-    edf = 0
-    sf_flag = 0
-    count = 0
-    id_set = set()
-    for row in csv_reader:
-        if count < 3:
-            count += 1
-            continue
-        if sf_flag == 0:
-            stf = int(row[0].split("/img")[-1].split(".")[0])
-            sf_flag = 1 
-        edf = int(row[0].split("/img")[-1].split(".")[0])
-        boxes = [ int(r) for r in row[3:] if r != ""]
-        bxs = []
-        for c in range(int(len(boxes) / 5)):
-            idd = int(boxes[c*5])
-            bxs.append([int((boxes[c*5+4])/2+boxes[c*5+2]),int((boxes[c*5+3])/2+boxes[c*5+1]), idd])
-            if idd not in id_set:
-                id_set.add(idd)
-        detected_boxes.append(bxs)
-
-    return detected_boxes
+    # import trajectories from result, as a list per frame of [cx, cy, id], see read_final_result
+    result = read_final_result(path)
+    boxes = np.stack([result['cx'], result['cy'], result['id']], axis=1)
+    return [b.tolist() for b in np.split(boxes, np.cumsum(result['counts'])[:-1])] if len(result['counts']) else []
 
 class Result:
 
@@ -123,6 +123,9 @@ class Result:
  
         # generate the directories for storing the results
         self.make_result_dir(result_dir, tasks)
+
+        # the catalogue of the processed videos and tasks in the result directory
+        self.catalogue = ResultCatalogue(result_dir, config.rescan_results)
         
         # get the list of video names, checking whether the vid_dir is a directory or path, and check whether the extension is valid
         self.vid_names = [ vid_name[:-4] for vid_name in os.listdir(vid_dir) if vid_name[-4:] in config.accepted_formats] if os.path.isdir(self.vid_dir) else [self.label] if self.label != "" else [vid_name[:-4] for vid_name in [self.vid_dir.split(os.sep)[-1]] if vid_name[-4:] in config.accepted_formats]
@@ -141,12 +144,17 @@ class Result:
         self.selected_vid_names_by_task = {task: self.select_vid_names(result_dir, self.vid_names, task) for task in tasks}
         print("***Task arrangements: ", self.selected_vid_names_by_task)
         # find race info and number of jockeys from database
-        self.jockeys, self.race_info = data = get_data_from_database(self.selected_vid_names) if os.path.isdir(self.vid_dir) else ({}, {})
+        self.jockeys, self.race_info = data = get_data_from_database(self.selected_vid_names, os.path.join(result_dir, config.race_info['cache'])) if os.path.isdir(self.vid_dir) else ({}, {})
         
         # frame data, this is used for checking whether to load frames. (If frames are loaded already, no need to load again)
         self.frames = None 
         self.frames_of_video = None
         self.frames_of_task = None
+        self.frame_store = FrameStore(config.frame_store_capacity) # the frame sets shared by the tasks running on the same video
+        self.shared_frames = SharedFrameStore(config.decode_workers) # the frame sets in shared memory, for the tasks that pass frames to other processes
+        self.frame_codec = config.frame_codec # how the frames are kept in memory, see util.image_util.get_codec
+        self.decode_workers = config.decode_workers # number of processes decoding a frame set
+        self.frame_cache = FrameCache(config.frame_cache_dir, config.frame_cache_quota) if config.frame_cache_dir else None # the decoded frames kept on disk across runs
         
     # def read_scene_classification_results(self):
     #     file_path = self.result_dir + '/' + config.scene_classification_save_path
@@ -180,24 +188,62 @@ class Result:
         if not os.path.exists(os.path.join(result_dir, config.video_processer_save_path)):
             with open(os.path.join(result_dir, config.video_processer_save_path), "w") as video_preprocess_file:
                 video_preprocess_file.write("raceLabel,track,course,raceDist,md5,fps,coursePred,raceNumPred,raceDistPred,raceTimePred,startFrmNum,finishFrmNum\n")
-        with open(os.path.join(result_dir, config.video_processer_save_path), "r") as video_preprocess_file:
-            start_end_frames = list(csv.reader(video_preprocess_file, delimiter=","))[1:]
-            start_end_frames = {sef[0]: [int(sef[-2]), int(sef[-1])] for sef in start_end_frames}
 
         ### Camera changes
         if not os.path.exists(os.path.join(result_dir, config.camerachange_save_path)):
             with open(os.path.join(result_dir, config.camerachange_save_path), "w") as cam_change_file:
                 cam_change_file.write("raceLabel,cc0_start,cc0_end,cc1_start,cc1_end,cc2_start,cc2_end,cc3_start,cc3_end,...\n")
-        with open(os.path.join(result_dir, config.camerachange_save_path), "r") as cam_change_file:
-            cam_change_data = list(csv.reader(cam_change_file, delimiter=","))
-            #print(cam_change_data)
-            cam_changes = {data[0]: [[int(data[i]),int(data[i+1])] for i in range(1,len(data),2)] for did, data in enumerate(cam_change_data) if did > 0}
-        return start_end_frames,cam_changes
+
+        # the results are read from the catalogue, the csv files are read into the catalogue once per video by record_scene_classification
+        return self.catalogue.scene_classification()
+
+    def record_scene_classification(self, vid_name):
+
+        '''
+        store the start/end frames and the camera changes of a video in the catalogue after the scene classification, taken from the result object or from the csv files
+
+        Parameters
+        ----------
+        vid_name : string
+            video name (with out extension)
+        '''
+
+        start_end_frames, cam_changes = self.start_end_frames.get(vid_name), self.cam_changes.get(vid_name)
+        if start_end_frames is None or cam_changes is None:
+            saved_start_end_frames, saved_cam_changes = read_scene_classification_csv(self.result_dir, [vid_name])
+            start_end_frames = start_end_frames if start_end_frames is not None else saved_start_end_frames.get(vid_name)
+            cam_changes = cam_changes if cam_changes is not None else saved_cam_changes.get(vid_name)
+        self.catalogue.set_scene_classification(vid_name, start_end_frames, cam_changes)
+        if start_end_frames is not None:
+            self.start_end_frames[vid_name] = start_end_frames
+        if cam_changes is not None:
+            self.cam_changes[vid_name] = cam_changes
+
+    def get_vid_path(self, vid_name):
+
+        '''
+        find the path to the video file, checking the accepted video extensions
+
+        Parameters
+        ----------
+        vid_name : string
+            video name (with out extension)
+
+        Returns
+        -------
+        vid_path : string
+        '''
+
+        for form in config.accepted_formats: # check the video extension
+            vid_path = os.path.join(self.vid_dir, vid_name + form) if os.path.isdir(self.vid_dir) else self.vid_dir
+            if os.path.exists(vid_path):
+                return vid_path
+        raise RuntimeError("Video Not Found Error")
 
     def load_frames(self, vid_name, start, end):
     
         '''
-        load video frames, call load_vid from util.video_util
+        load video frames, call load_vid from util.video_util. This keeps the whole frame set in self.frames for the callers that index into a list, use stream_frames if the frames are only visited once in order
         
         Parameters
         ----------
@@ -209,19 +255,216 @@ class Result:
             the ending frame of the frame set for loading
         '''
         
-        for form in config.accepted_formats: # check the video extension
-            vid_path = os.path.join(self.vid_dir, vid_name + form) if os.path.isdir(self.vid_dir) else self.vid_dir
-            if os.path.exists(vid_path):
-                # do not reload frames if the whole video can be reused
-                #if self.frames is None or self.frames_of_video != self.processing_vid_name or self.frames_of_task == config.Task.VIDEOPROCESSOR:
-                if self.frames is None or self.frames_of_video != self.processing_vid_name or self.frames_of_task == config.Task.SCENECLASSIFY:
-                    del self.frames # free memory below loading new frames
-                    gc.collect()
-                    self.frames = load_vid(vid_path, start, end) 
-                self.frames_of_video = self.processing_vid_name
-                self.frames_of_task = self.ontask
-                return
-        raise RuntimeError("Video Not Found Error")
+        vid_path = self.get_vid_path(vid_name)
+        # do not reload frames if the frame set is in the frame store, i.e. loaded by a previous task or by a task running at the same time
+        self.frames = None # free memory below loading new frames
+        gc.collect()
+        with profile_stage('decode', frames=end - start + 1):
+            self.frames = self.frame_store.get((vid_path, start, end, self.get_frame_size()), lambda: self._load_vid(vid_path, start, end))
+        self.frames_of_video = self.processing_vid_name
+        self.frames_of_task = self.ontask
+
+    def has_frames(self, vid_name, start, end):
+        ''' check whether a frame set is loaded already, i.e. by another task of the video '''
+        return (self.get_vid_path(vid_name), start, end, self.get_frame_size()) in self.frame_store
+
+    def get_frame_size(self, scale=1):
+
+        '''
+        get the frame size at a scale
+
+        Parameters
+        ----------
+        scale : float or tuple of int
+            the scale relative to the full frame size (config.frame_width, config.frame_height), i.e. 1, 0.5, 0.25, or the frame size (width, height)
+
+        Returns
+        -------
+        size : tuple of int
+            (width, height)
+        '''
+
+        if isinstance(scale, (tuple, list)):
+            return tuple(int(s) for s in scale)
+        return (int(round(config.frame_width * scale)), int(round(config.frame_height * scale)))
+
+    def load_scaled_frames(self, vid_name, start, end, scale):
+
+        '''
+        load video frames decoded at a smaller size, i.e. for the tasks with a small model input. Each size is produced once per video and kept in the frame store along with the full size frames.
+        If the full size frames are loaded already, they are decoded at the reduced size, otherwise the video is decoded at the reduced size. At scale 1, the full size frames are loaded (see load_frames)
+        and decoded on every call, they are not kept decoded in the frame store
+
+        Parameters
+        ----------
+        vid_name : string
+            video name (with out extension)
+        start : int
+            the starting frame of the frame set for loading
+        end : int
+            the ending frame of the frame set for loading
+        scale : float or tuple of int
+            see get_frame_size
+
+        Returns
+        -------
+        frames : numpy array
+            uint8 array of shape (frames, height, width, 3)
+        '''
+
+        size = self.get_frame_size(scale)
+        if size == self.get_frame_size():
+            self.load_frames(vid_name, start, end)
+            with profile_stage('decode', frames=len(self.frames)):
+                return decode_batch(self.frames)
+        vid_path = self.get_vid_path(vid_name)
+        with profile_stage('decode', frames=end - start + 1):
+            return self.frame_store.get((vid_path, start, end, size), lambda: self._load_scaled_vid(vid_path, start, end, size))
+
+    def _load_scaled_vid(self, vid_path, start, end, size):
+        full_frames = self.frame_store.peek((vid_path, start, end, self.get_frame_size()))
+        if full_frames is not None:
+            return decode_batch(full_frames, size=size)
+        if self.frame_cache is not None:
+            return self.frame_cache.load(vid_path, start, end, size)
+        with FrameSource(vid_path, start, end, size=size) as source:
+            frames = np.empty((len(source), size[1], size[0], 3), dtype=np.uint8)
+            count = 0
+            for count, frame in enumerate(source, 1):
+                frames[count - 1] = frame
+        return frames[:count]
+
+    def _load_vid(self, vid_path, start, end):
+        # with the frame cache, the frames are decoded arrays memory-mapped from disk instead of encoded images, util.image_util.decode_img returns them as they are
+        if self.frame_cache is not None:
+            return self.frame_cache.load(vid_path, start, end)
+        if self.decode_workers > 1 and end - start + 1 >= config.parallel_decode_min_frames:
+            return load_vid_parallel(vid_path, start, end, self.frame_codec, self.decode_workers)
+        return load_vid(vid_path, start, end, self.frame_codec)
+
+    def iter_frames(self, threads=None, readahead=None):
+
+        '''
+        iterate over the loaded frames (self.frames) decoded, in order. The frames ahead of the consumer are decoded in a thread pool
+
+        Parameters
+        ----------
+        threads : int
+            the number of decoding threads, config.decode_threads if None
+        readahead : int
+            the maximum number of frames decoded ahead of the consumer, config.decode_readahead if None
+
+        Returns
+        -------
+        frames : generator
+            the decoded frames, numpy arrays of shape (1080, 1920, 3)
+        '''
+
+        frames, readahead = self.frames, readahead or config.decode_readahead
+        pool = get_decode_pool(threads)
+        pending = deque()
+        try:
+            for item in frames:
+                pending.append(pool.submit(decode_img, item))
+                if len(pending) >= readahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending: # the consumer stopped early
+                future.cancel()
+
+    def decode_batch(self, indices, threads=None):
+
+        '''
+        decode a batch of the loaded frames (self.frames) into a single array, i.e. for the input of a model
+
+        Parameters
+        ----------
+        indices : list of int
+            the indices of the frames in self.frames
+        threads : int
+            the number of decoding threads, config.decode_threads if None
+
+        Returns
+        -------
+        frames : numpy array
+            uint8 array of shape (len(indices), 1080, 1920, 3)
+        '''
+
+        return decode_batch([self.frames[i] for i in indices], threads)
+
+    def release_frames(self):
+        ''' drop the loaded frames, i.e. after all the tasks of a video are done '''
+        self.frames = None
+        self.frame_store.clear()
+        self.shared_frames.clear()
+
+    def task_view(self, task):
+
+        '''
+        make a shallow copy of the result object for running a task at the same time as other tasks. The copy has its own ontask and frames, and shares everything else, including the frame store
+
+        Parameters
+        ----------
+        task : int
+            the task number
+
+        Returns
+        -------
+        view : Result
+        '''
+
+        view = copy.copy(self)
+        view.ontask = task
+        view.frames = None
+        return view
+
+    def share_frames(self, vid_name, start, end, size=(config.frame_width, config.frame_height)):
+
+        '''
+        decode video frames into shared memory, once per video, frame set and size. The returned handle can be passed to other processes, which attach to the frames without copying them
+
+        Parameters
+        ----------
+        vid_name : string
+            video name (with out extension)
+        start : int
+            the starting frame of the frame set for loading
+        end : int
+            the ending frame of the frame set for loading
+        size : tuple of int
+            (width, height) of the frames
+
+        Returns
+        -------
+        handle : SharedFrames
+            call handle.attach() for a numpy array or handle.as_tensor() for a torch tensor of shape (frames, height, width, 3)
+        '''
+
+        return self.shared_frames.get(self.get_vid_path(vid_name), start, end, size)
+
+    def stream_frames(self, vid_name, start, end):
+
+        '''
+        stream video frames one by one, the decoded frames are not kept in memory
+
+        Parameters
+        ----------
+        vid_name : string
+            video name (with out extension)
+        start : int
+            the starting frame of the frame set for loading
+        end : int
+            the ending frame of the frame set for loading
+
+        Returns
+        -------
+        source : FrameSource
+            iterable of decoded frames, i.e. numpy arrays of shape (1080, 1920, 3)
+        '''
+
+        return FrameSource(self.get_vid_path(vid_name), start, end)
     
     def get_fps(self, vid_name):
         
@@ -238,11 +481,78 @@ class Result:
         fps : int
         '''
     
-        for form in config.accepted_formats:
-            vid_path = os.path.join(self.vid_dir, vid_name + form) if os.path.isdir(self.vid_dir) else self.vid_dir
-            if os.path.exists(vid_path):
-                return find_fps(vid_path) # the find_fps function in util.video_util
-        raise RuntimeError("Video Not Found Error")
+        return find_fps(self.get_vid_path(vid_name)) # the find_fps function in util.video_util
+
+    def get_video_info(self, vid_name, md5=False):
+
+        '''
+        get the metadata of the video, read once per video file, see util.video_probe
+
+        Parameters
+        ----------
+        vid_name : string
+            video name (with out extension)
+        md5 : bool
+            compute the md5 of the video file if it is not known yet, i.e. for the md5 column of vid_process.csv
+
+        Returns
+        -------
+        info : VideoInfo
+            fps, frame_step, frame_count, width, height, codec and md5
+        '''
+
+        vid_path = self.get_vid_path(vid_name)
+        if md5:
+            get_probe().md5(vid_path)
+        return probe_video(vid_path)
+
+    def get_camera_segments(self, vid_name):
+
+        '''
+        get the camera segments of a video, i.e. the frame ranges in between the start frame, the camera changes and the end frame
+
+        Parameters
+        ----------
+        vid_name : string
+            video name (with out extension)
+
+        Returns
+        -------
+        segments : list of tuple
+            (first frame, last frame) of every camera segment
+        '''
+
+        start, end = self.start_end_frames[vid_name]
+        bounds = [start] + np.array(self.cam_changes.get(vid_name, []), dtype=int).flatten().tolist() + [end]
+        return [(bounds[i], bounds[i+1]) for i in range(0, len(bounds) - 1, 2)]
+
+    def store_masks(self, vid_name, task):
+
+        '''
+        convert the json outputs of a segmentation task for a video following config.mask_storage, the masks are read from the converted files by util.mask_util
+
+        Parameters
+        ----------
+        vid_name : string
+            video name (with out extension)
+        task : int
+            the task number, i.e. config.Task.RAILMASK
+        '''
+
+        mode = config.mask_storage['mode']
+        if mode == 'json':
+            return
+        from util.mask_container import convert_rle_json
+        # the deltas are stored within the camera segments only, a camera change is a new keyframe
+        segments = self.get_camera_segments(vid_name) if mode == 'delta' and vid_name in self.start_end_frames else None
+        with profile_stage('write'):
+            for directory in get_directories(self.result_dir, [task]):
+                for name in os.listdir(directory):
+                    if name.endswith('.json') and name.split(".")[0].split("&")[0] == vid_name:
+                        path = os.path.join(directory, name)
+                        convert_rle_json(path, segments=segments, keyframe_interval=config.mask_storage['keyframe_interval'])
+                        if not config.mask_storage['keep_json']:
+                            os.remove(path)
 
     def make_result_dir(self, result_dir, tasks):
         ''' create directories for the result '''
@@ -259,62 +569,34 @@ class Result:
             return list(set(videos))
        
         else:
-            directories = get_directories(result_dir, [task])
-            differences = set()
-            for directory in directories:
-                if directory.split(os.sep)[-1] != config.directories[config.Task.TRACKING]['ROOT']:
-                    # for tracking taskm if finaly result exists, it is done
-                    if directory.split(os.sep)[-2] == 'Track_Cap' and directory.split(os.sep)[-1] != 'final_result':
-                        continue
-                    file_names = [name.split(".")[0].split("&")[0] for name in os.listdir(directory)]
-                    difference = set.difference(set(vid_names), set(file_names))
-                    differences = differences.union(difference)
-            return list(differences)
+            # the videos with the task done are recorded in the catalogue, for tracking task if finaly result exists, it is done (see util.catalogue.task_directories). A task whose outputs were removed runs again
+            return list(set.difference(set(vid_names), self.catalogue.done_videos(task, vid_names)))
     
-    def convert_to_excel(self):
-        '''convert the result to excel'''
-        if not os.path.exists(os.path.join(self.result_dir, "xlsx_results")):
-            os.mkdir(os.path.join(self.result_dir, "xlsx_results"))
+    def convert_to_excel(self, fmt=None, workers=None):
+
+        '''
+        export the race info and the tracking result of the videos, see util.export
 
+        Parameters
+        ----------
+        fmt : string
+            'xlsx', 'parquet', 'feather' or 'csv.gz', config.export['format'] if None
+        workers : int
+            the number of processes exporting the videos, config.export['workers'] if None
+        '''
+
+        fmt = fmt or config.export['format']
+        jobs = []
         for vid_name in self.vid_names:
 
             # export race info such as start frame, end frame, camera change, distance, etc
             if vid_name not in self.start_end_frames.keys() or vid_name not in self.cam_changes.keys():
                 continue
             start, end = self.start_end_frames[vid_name]
-            scn_max = config.tracking[self.race_info[vid_name]['track']].scn_max
-            data = [self.race_info[vid_name]['track'], "", str(self.race_info[vid_name]['distance']), "", start, end]
-            column = ['track', 'raceNum', 'raceDist', 'raceTime', 'startFrame', 'endFrame']
-            cam_changes = self.cam_changes[vid_name]
-            subrace_data = [start] + np.array(cam_changes).flatten().tolist() + [end]
-            data += [str(sd) for sd in subrace_data]
-            for i in range(int(len(subrace_data)/2)):
-                column += ['subrace' + str(len(cam_changes)-i+1) + '_start', 'subrace' + str(len(cam_changes)-i+1) + '_end']
-            data.append("")
-            column.append("end")
-            df = pd.DataFrame([data], columns=column)
-
-            writer = pd.ExcelWriter(os.path.join(self.result_dir, "xlsx_results", vid_name + ".xlsx"),engine='xlsxwriter')
-            df.to_excel(writer, sheet_name='Race & Video Config', index=False)
-            
-            #export tracking result
-            if not os.path.exists(os.path.join(self.result_dir, config.directories[config.Task.TRACKING]['FINALRESULT'], vid_name + ".csv")):
-                writer.save()
-                continue
-            detected_boxes = import_subsequences_results(os.path.join(self.result_dir, config.directories[config.Task.TRACKING]['FINALRESULT'], vid_name))
-            column = ['FrameNo', 'detectedJockeys'] + [k for j in [['cx'+str(i), 'cy'+str(i)] for i in range(scn_max)] for k in j]
-            data = []
-            for frm in range(len(detected_boxes)):
-                caps = [["",""]]  * scn_max
-                for cap in detected_boxes[frm]:
-                    if cap[2] > scn_max:
-                        continue
-                    caps[cap[2]-1] = cap[:2]
-                data.append([frm+start, len(detected_boxes[frm])] + [i for c in caps for i in c])
-            df_track = pd.DataFrame(data, columns=column)
-            
-            # write to file
-            df_track.to_excel(writer, sheet_name='Jockey Caps', index=False)
-            writer.save()
-            print("Finish writing", vid_name)
-
+            track = self.race_info[vid_name]['track']
+            tracks = os.path.join(self.result_dir, config.directories[config.Task.TRACKING]['FINALRESULT'], vid_name)
+            jobs.append({
+                'vid_name': vid_name, 'config': race_config_table(track, self.race_info[vid_name]['distance'], start, end, self.cam_changes[vid_name]),
+                'tracks': tracks if os.path.exists(tracks + ".csv") else None, 'scn_max': config.tracking[track].scn_max, 'start': start,
+            })
+        return export_videos(jobs, os.path.join(self.result_dir, config.export['directories'][fmt]), fmt, workers)
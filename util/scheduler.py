@@ -0,0 +1,149 @@
+import time
+import types
+import traceback
+import multiprocessing as mp
+import psutil
+import config
+from util.video_util import find_frame_count
+
+
+def estimate_video_rss(horseracingResult, vid_name):
+
+    '''
+    estimate the peak RAM needed for running the tasks on a video
+
+    Parameters
+    ----------
+    horseracingResult : object
+        the result object, the start/end frames are used if the scene classification is done, otherwise the length of the whole video is used
+    vid_name : string
+        video name (with out extension)
+
+    Returns
+    -------
+    rss : float
+        estimated RAM in GB
+    '''
+
+    if vid_name in horseracingResult.start_end_frames:
+        start, end = horseracingResult.start_end_frames[vid_name]
+        frame_count = end - start + 1
+    else:
+        frame_count = find_frame_count(horseracingResult.get_vid_path(vid_name))
+    return config.scheduler['base_rss'] + frame_count * config.scheduler['frame_rss'] / 1024
+
+
+def _process_rss(pid):
+    # RAM of the worker and the processes it started, i.e. the optical flow process, in GB
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+        return sum(p.memory_info().rss for p in processes) / 1024**3
+    except psutil.Error:
+        return 0.
+
+
+def _config_settings():
+    # the settings of the config module, the command line arguments change some of them in the main process
+    return {key: value for key, value in vars(config).items() if not key.startswith('_') and not isinstance(value, (types.ModuleType, types.FunctionType, type))}
+
+
+def _run_video(launch_tasks, horseracingResult, vid_name, tasks, errors, settings):
+    # entry point of the worker process, the error is sent back to the scheduler instead of being printed only
+    try:
+        vars(config).update(settings) # the worker process imports config again, use the settings of the main process
+        print("----------------------- Processing Video: ", vid_name, ' -----------------------')
+        horseracingResult.processing_vid_name = vid_name
+        launch_tasks(horseracingResult, tasks)
+    except BaseException:
+        errors.put((vid_name, traceback.format_exc()))
+        raise
+
+
+class VideoScheduler:
+
+    '''
+    Run the tasks of several videos in parallel, one process per video. A new video is admitted only when its estimated RAM fits in the budget, the failed videos are retried without stopping the batch.
+
+    Parameters
+    ----------
+    launch_tasks : function
+        the function that runs the task list on a video, i.e. main.launch_tasks. It is called as launch_tasks(horseracingResult, tasks) in the worker process
+    workers : int
+        the maximum number of videos processed at the same time
+    max_rss : float
+        the RAM budget in GB shared by all the workers. If None, 80% of the total RAM is used
+    retries : int
+        the number of times a failed video is retried
+    '''
+
+    def __init__(self, launch_tasks, workers, max_rss=None, retries=1):
+        self.launch_tasks = launch_tasks
+        self.workers = workers
+        self.max_rss = max_rss if max_rss is not None else psutil.virtual_memory().total * 0.8 / 1024**3
+        self.retries = retries
+        self.context = mp.get_context("spawn") # torch requires spawn, see main.py
+
+    def run(self, horseracingResult, tasks):
+
+        '''
+        process all the selected videos of the result object
+
+        Parameters
+        ----------
+        horseracingResult : object
+            the result object, a copy is sent to each worker process
+        tasks : list of int
+            the task list
+
+        Returns
+        -------
+        failures : dict
+            key : Video name
+            item: the error message of the last attempt, for the videos that still fail after all the retries
+        '''
+
+        pending = [(vid_name, 0) for vid_name in horseracingResult.selected_vid_names]
+        running = {}  # vid_name: (process, attempt, estimated rss)
+        failures = {}
+        errors = self.context.Queue()
+
+        while pending or running:
+            # check the finished workers
+            for vid_name, (process, attempt, _) in list(running.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                del running[vid_name]
+                if process.exitcode == 0:
+                    failures.pop(vid_name, None)
+                    print("Finish Processing Video: ", vid_name)
+                    continue
+                failures.setdefault(vid_name, f"worker exited with code {process.exitcode}")
+                if attempt < self.retries:
+                    print(f"Video {vid_name} failed (attempt {attempt + 1}), retrying")
+                    pending.append((vid_name, attempt + 1))
+            while not errors.empty():
+                vid_name, error = errors.get()
+                failures[vid_name] = error
+
+            # admit new videos while the RAM budget allows, a video is always admitted when nothing else is running
+            committed = sum(max(rss, _process_rss(process.pid)) for process, _, rss in running.values())
+            while pending and len(running) < self.workers:
+                vid_name, attempt = pending[0]
+                rss = estimate_video_rss(horseracingResult, vid_name)
+                if running and committed + rss > self.max_rss:
+                    break
+                pending.pop(0)
+                process = self.context.Process(target=_run_video, args=(self.launch_tasks, horseracingResult, vid_name, tasks, errors, _config_settings()), name=f"video-{vid_name}")
+                process.start()
+                running[vid_name] = (process, attempt, rss)
+                committed += rss
+
+            if running:
+                time.sleep(config.scheduler['poll_interval'])
+
+        for vid_name, error in failures.items():
+            print(f"----------------------- Failed Video: {vid_name} -----------------------")
+            print(error)
+        return failures
@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import traceback
+import config
+
+
+class JobError(ValueError):
+    ''' a job that cannot be run as written, the message is reported in the failed directory instead of a traceback '''
+
+
+def check_job(job):
+
+    '''
+    check the fields of a job before running it, see WatchFolderService
+
+    Parameters
+    ----------
+    job : dict
+
+    Raises
+    ------
+    JobError
+        if a field is missing or has the wrong type, i.e. a track without distance
+    '''
+
+    def is_int(value):
+        try:
+            int(value)
+            return True
+        except (TypeError, ValueError):
+            return False
+
+    if not isinstance(job, dict) or not isinstance(job.get('video_path'), str):
+        raise JobError("the job has to be a json object with a video_path")
+    tasks = job.get('tasks')
+    if tasks is not None and (not isinstance(tasks, list) or not all(is_int(task) and int(task) in config.dependencies for task in tasks)):
+        raise JobError(f"tasks has to be a list of the tasks {sorted(int(task) for task in config.dependencies)}, got {tasks!r}")
+    if job.get('track'):
+        if job.get('distance') is None:
+            raise JobError("distance is required with track, or leave out track to read the race info from the database")
+        if not is_int(job['distance']):
+            raise JobError(f"distance has to be a number of meters, got {job['distance']!r}")
+    jockeys = job.get('jockeys')
+    if jockeys is not None and (not isinstance(jockeys, list) or not all(is_int(jockey) for jockey in jockeys)):
+        raise JobError(f"jockeys has to be a list of numbers, got {jockeys!r}")
+
+
+class WatchFolderService:
+
+    '''
+    Long-running service processing the jobs dropped into a watch folder one after the other in this process, so the models loaded by the tasks (see util.model_registry) stay loaded from a video to the next.
+
+    A job is either a video file (config.accepted_formats) or a json file {"video_path": ..., "tasks": [...], "track": ..., "distance": ..., "course": ..., "jockeys": [...], "racelabel": ...}
+    where only video_path is required, without track the race info is read from the database like in the internal mode. The json jobs form a queue in the order they were written,
+    they are moved into the done or failed sub-directory of the watch folder once processed. The video files are processed once per run of the service, the result catalogue skips the tasks done already.
+
+    Parameters
+    ----------
+    watch_dir : string
+        the watch folder
+    run_job : function
+        called as run_job(job) with job the dict of the json file, or {"video_path": path} for a video file. It raises JobError for a job that cannot be run, see check_job
+    poll_interval : float
+        seconds between two scans of the watch folder, config.service['poll_interval'] if None
+    settle_time : float
+        seconds a file has to stay unchanged before it is processed, config.service['settle_time'] if None
+    '''
+
+    def __init__(self, watch_dir, run_job, poll_interval=None, settle_time=None):
+        self.watch_dir = watch_dir
+        self.run_job = run_job
+        self.poll_interval = poll_interval if poll_interval is not None else config.service['poll_interval']
+        self.settle_time = settle_time if settle_time is not None else config.service['settle_time']
+        self.seen = set() # (path, size, mtime) of the processed video files
+        self.queued = set() # the videos of the json jobs, not processed as video files
+        self.processed, self.failed = 0, 0
+
+    def scan(self):
+
+        '''
+        find the jobs ready to run, in the order the files were written
+
+        Returns
+        -------
+        jobs : list of tuple
+            (path of the job file, job dict or None if the json file cannot be read)
+        '''
+
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.watch_dir):
+            path = os.path.join(self.watch_dir, name)
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            if now - stat.st_mtime < self.settle_time: # still being written
+                continue
+            entries.append((stat.st_mtime, path, stat.st_size))
+        entries.sort()
+
+        jobs = []
+        for _, path, _ in entries:
+            if path.endswith('.json'):
+                try:
+                    with open(path, 'r') as f:
+                        job = json.load(f)
+                    self.queued.add(os.path.abspath(job['video_path']))
+                except (ValueError, KeyError, TypeError):
+                    job = None
+                jobs.append((path, job))
+        for mtime, path, size in entries:
+            if os.path.splitext(path)[1] not in config.accepted_formats or (path, size, mtime) in self.seen:
+                continue
+            self.seen.add((path, size, mtime))
+            # a video of a json job runs with the settings of the job only
+            if os.path.abspath(path) not in self.queued:
+                jobs.append((path, {'video_path': path}))
+        return jobs
+
+    def _finish(self, path, error=None):
+        # move a json job out of the queue, the error is written next to a failed job
+        if not path.endswith('.json'):
+            return
+        directory = os.path.join(self.watch_dir, 'failed' if error else 'done')
+        os.makedirs(directory, exist_ok=True)
+        os.replace(path, os.path.join(directory, os.path.basename(path)))
+        if error:
+            with open(os.path.join(directory, os.path.basename(path) + '.error.txt'), 'w') as f:
+                f.write(error)
+
+    def run_once(self):
+        ''' run the jobs ready in the watch folder, returns the number of jobs run '''
+        jobs = self.scan()
+        for path, job in jobs:
+            print("----------------------- Service Job: ", path, ' -----------------------')
+            start = time.time()
+            if job is None:
+                self._finish(path, f"cannot read the job file {path}, it has to be a json object with a video_path")
+                self.failed += 1
+                continue
+            try:
+                self.run_job(job)
+            except JobError as e:
+                error = f"invalid job {path}: {e}"
+                print(error)
+                self._finish(path, error)
+                self.failed += 1
+                continue
+            except Exception:
+                # a failed job does not stop the service
+                error = traceback.format_exc()
+                print(error)
+                self._finish(path, error)
+                self.failed += 1
+                continue
+            self._finish(path)
+            self.processed += 1
+            print(f"Finish Service Job: {path} in {time.time() - start:.1f}s")
+        return len(jobs)
+
+    def run(self, once=False):
+
+        '''
+        run the jobs of the watch folder until interrupted (Ctrl-C)
+
+        Parameters
+        ----------
+        once : bool
+            return once the jobs in the watch folder are done instead of waiting for new jobs
+        '''
+
+        print(f"Watching {self.watch_dir} for jobs")
+        try:
+            while True:
+                count = self.run_once()
+                if once and count == 0:
+                    break
+                if count == 0:
+                    time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print("Service stopped")
+        print(f"Service processed {self.processed} jobs, {self.failed} failed")
@@ -0,0 +1,163 @@
+import sys
+import threading
+import numpy as np
+from multiprocessing import shared_memory
+import config
+from util.video_util import FrameSource, decode_parallel
+
+
+class SharedFrames:
+
+    '''
+    Handle to a frame set decoded into shared memory. The handle is small and can be sent to other processes, i.e. the optical flow process, which attach to the frames without copying them.
+
+    Parameters
+    ----------
+    name : string
+        name of the shared memory block
+    shape : tuple of int
+        (number of frames, height, width, 3)
+    key : tuple
+        (vid_path, start, end, size) of the frame set
+    count : int
+        the number of frames actually decoded, can be less than shape[0] if the video ends before the ending frame
+
+    Examples
+    --------
+    >>> handle = horseracingResult.share_frames(vid_name, start_frame, end_frame)
+    >>> frames = handle.attach() # in the child process, a numpy array of shape (count, 1080, 1920, 3)
+    '''
+
+    def __init__(self, name, shape, key, count=None):
+        self.name = name
+        self.shape = tuple(shape)
+        self.key = key
+        self.count = shape[0] if count is None else count
+        self._shm = None
+
+    def __getstate__(self):
+        return {'name': self.name, 'shape': self.shape, 'key': self.key, 'count': self.count}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return self.count
+
+    def attach(self):
+
+        '''
+        map the frames into the current process
+
+        Returns
+        -------
+        frames : numpy array
+            uint8 array of shape (count, height, width, 3), a view of the shared memory
+        '''
+
+        if self._shm is None:
+            # python 3.13+ can leave the cleanup to the owner, older versions register the block with the resource tracker shared with the owner process
+            kwargs = {'track': False} if sys.version_info >= (3, 13) else {}
+            self._shm = shared_memory.SharedMemory(name=self.name, **kwargs)
+        return np.ndarray(self.shape, dtype=np.uint8, buffer=self._shm.buf)[:self.count]
+
+    def as_tensor(self):
+        ''' the frames as a torch tensor sharing the memory of the frames, see attach '''
+        import torch
+        return torch.from_numpy(self.attach())
+
+    def detach(self):
+        ''' unmap the frames from the current process, the arrays returned by attach must not be used afterwards '''
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+
+class SharedFrameStore:
+
+    '''
+    Owner of the shared memory frame sets. A frame set is keyed by (vid_path, start, end, size) and decoded only once, no matter how many processes read it.
+    The store lives in the process that creates it, a copy sent to another process starts empty.
+
+    Parameters
+    ----------
+    decode_workers : int
+        the number of processes decoding a frame set, see util.video_util.decode_parallel
+    '''
+
+    def __init__(self, decode_workers=1):
+        self.decode_workers = decode_workers
+        self._init_state()
+
+    def _init_state(self):
+        self._blocks = {}  # key: (shared memory, handle)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'decode_workers': self.decode_workers}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get(self, vid_path, start, end, size=(config.frame_width, config.frame_height)):
+
+        '''
+        get the handle of a frame set, decode it into shared memory if needed
+
+        Parameters
+        ----------
+        vid_path : string
+            path to the video file
+        start : int
+            the starting frame
+        end : int
+            the ending frame
+        size : tuple of int
+            (width, height) of the frames
+
+        Returns
+        -------
+        handle : SharedFrames
+        '''
+
+        key = (vid_path, start, end, tuple(size))
+        with self._lock:
+            if key in self._blocks:
+                return self._blocks[key][1]
+
+            shape = (end - start + 1, size[1], size[0], 3)
+            shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+            try:
+                if self.decode_workers > 1 and shape[0] >= config.parallel_decode_min_frames:
+                    count = decode_parallel(vid_path, start, end, shm.name, size, self.decode_workers)
+                else:
+                    frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+                    count = 0
+                    with FrameSource(vid_path, start, end, size=size) as source:
+                        for count, frame in enumerate(source, 1):
+                            frames[count - 1] = frame
+                    del frames
+            except BaseException:
+                try:
+                    shm.close()
+                except BufferError: # the frames array is still referenced by the traceback
+                    pass
+                shm.unlink()
+                raise
+            handle = SharedFrames(shm.name, shape, key, count)
+            self._blocks[key] = (shm, handle)
+            return handle
+
+    def clear(self):
+        ''' free all the frame sets. The processes attached to them keep their mapping until they detach '''
+        with self._lock:
+            for shm, handle in self._blocks.values():
+                try:
+                    for close in (handle.detach, shm.close):
+                        try:
+                            close()
+                        except BufferError: # an array of the frames is still in use in this process, the mapping goes away with it
+                            pass
+                finally:
+                    shm.unlink()
+            self._blocks.clear()
@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import config
+
+
+def build_task_graph(tasks):
+
+    '''
+    build the task graph from config.dependencies
+
+    Parameters
+    ----------
+    tasks : list of int
+        the tasks to run, the dependencies of every task must be in the list
+
+    Returns
+    -------
+    graph : dict
+        key : task number
+        item: the set of tasks that must finish before the task starts
+    '''
+
+    tasks = set(tasks)
+    graph = {task: set(t for t in config.dependencies[task] if t != task) for task in tasks}
+    for task, prerequisites in graph.items():
+        missing = prerequisites - tasks
+        if missing:
+            raise ValueError(f"Task {task} depends on tasks {sorted(missing)} which are not in the task list")
+    return graph
+
+
+def topological_order(graph):
+
+    '''
+    sort the tasks so that every task comes after its prerequisites, the smaller task number comes first among the tasks that are ready at the same time
+
+    Parameters
+    ----------
+    graph : dict
+        the task graph from build_task_graph
+
+    Returns
+    -------
+    order : list of int
+    '''
+
+    remaining = {task: set(prerequisites) for task, prerequisites in graph.items()}
+    order = []
+    while remaining:
+        ready = sorted(task for task, prerequisites in remaining.items() if not prerequisites)
+        if not ready:
+            raise ValueError(f"Circular dependency between tasks {sorted(remaining)}")
+        order += ready
+        for task in ready:
+            del remaining[task]
+        for prerequisites in remaining.values():
+            prerequisites.difference_update(ready)
+    return order
+
+
+class TaskGraphExecutor:
+
+    '''
+    Run the tasks of a video following the task graph. A task starts as soon as all the tasks it depends on are done, so the independent tasks, i.e. RAILMASK, RAILPOLEMASK, SEMANTICMASK and DETECTION
+    after SCENECLASSIFY, run at the same time in worker threads. The tasks share the frame store of the result object, so a frame set is decoded only once.
+
+    Parameters
+    ----------
+    run_task : function
+        called as run_task(horseracingResult, task) to run a single task
+    workers : int
+        the maximum number of tasks running at the same time. With 1 worker, the tasks run one by one in topological order on the result object itself
+    '''
+
+    # the attributes that belong to a single task and are not copied back to the result object after the task
+    _task_attributes = ('ontask', 'frames', 'frames_of_video', 'frames_of_task')
+
+    def __init__(self, run_task, workers=1):
+        self.run_task = run_task
+        self.workers = workers
+
+    def run(self, horseracingResult, tasks):
+
+        '''
+        run the tasks on the video horseracingResult.processing_vid_name
+
+        Parameters
+        ----------
+        horseracingResult : object
+            the result object
+        tasks : list of int
+            the task list
+        '''
+
+        graph = build_task_graph(tasks)
+        if self.workers <= 1:
+            for task in topological_order(graph):
+                self.run_task(horseracingResult, task)
+            return
+
+        remaining = {task: set(prerequisites) for task, prerequisites in graph.items()}
+        running = {}  # future: (task, task view, snapshot of the result object when the task started)
+        error = None
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="task") as pool:
+            while remaining or running:
+                # start the tasks with all the prerequisites done, no new task is started after a failure
+                ready = sorted(task for task, prerequisites in remaining.items() if not prerequisites) if error is None else []
+                for task in ready:
+                    del remaining[task]
+                    snapshot = dict(horseracingResult.__dict__)
+                    view = horseracingResult.task_view(task)
+                    running[pool.submit(self.run_task, view, task)] = (task, view, snapshot)
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, view, snapshot = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                        continue
+                    self._merge(horseracingResult, view, snapshot)
+                    for prerequisites in remaining.values():
+                        prerequisites.discard(task)
+
+        if error is not None:
+            raise error
+
+    def _merge(self, horseracingResult, view, snapshot):
+        # copy back the attributes that the task assigned, i.e. the start/end frames set by the scene classification, so the tasks that depend on it can see them
+        for key, value in view.__dict__.items():
+            if key in self._task_attributes:
+                continue
+            if key not in snapshot or snapshot[key] is not value:
+                setattr(horseracingResult, key, value)
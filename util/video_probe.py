@@ -0,0 +1,218 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from collections import namedtuple
+import cv2
+import numpy as np
+import config
+
+
+def file_md5(path, chunk_size=1 << 22):
+
+    '''
+    compute the md5 of a file without reading it into memory at once
+
+    Parameters
+    ----------
+    path : string
+    chunk_size : int
+        the number of bytes read at a time
+
+    Returns
+    -------
+    md5 : string
+        hex digest
+    '''
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class VideoInfo(namedtuple('VideoInfo', ['path', 'size', 'mtime', 'fps', 'frame_rate', 'frame_count', 'width', 'height', 'codec', 'md5'])):
+
+    '''
+    the metadata of a video file, see VideoProbe
+
+    Attributes
+    ----------
+    path : string
+        absolute path of the video file
+    size : int
+        bytes of the file
+    mtime : int
+        modification time of the file in ns
+    fps : int
+        the default fps of the video (container header), rounded, i.e. 30 for a 29.97 fps video
+    frame_rate : float
+        the exact fps of the video, i.e. to convert a frame index into a timestamp
+    frame_count : int
+        the number of frames in the video (container header), can be slightly off for some encoders
+    width, height : int
+        resolution of the video
+    codec : string
+        fourcc of the video stream, i.e. 'avc1'
+    md5 : string
+        md5 of the file, None until VideoProbe.md5 is called for the file
+    '''
+
+    @property
+    def frame_step(self):
+        ''' see util.video_util.get_frame_step '''
+        from util.video_util import get_frame_step
+        return get_frame_step(self.fps)
+
+    @property
+    def actual_fps(self):
+        ''' the fps of the frame set, fps / frame_step '''
+        return int(np.round(self.fps / self.frame_step))
+
+    @property
+    def frames(self):
+        ''' the number of frames in the frame set, frame_count // frame_step '''
+        return self.frame_count // self.frame_step
+
+
+class VideoProbe:
+
+    '''
+    Metadata of the video files (fps, frame count, resolution, codec and md5) read once per file and kept in memory and in a SQLite file, so reading them again costs a stat of the file and a dictionary lookup
+    instead of opening the video. A file is keyed by (absolute path, size, mtime), a modified file is read again. The md5 reads the whole file, it is computed on first use only.
+
+    Parameters
+    ----------
+    path : string
+        the SQLite file, created if not exist. It can be shared by several processes. The metadata are kept in memory only if None
+    '''
+
+    _columns = VideoInfo._fields
+
+    def __init__(self, path=None):
+        self.path = path
+        self._infos = {} # (path, size, mtime): VideoInfo
+        self._lock = threading.Lock()
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('CREATE TABLE IF NOT EXISTS videos (path TEXT, size INTEGER, mtime INTEGER, fps INTEGER, frame_rate REAL, frame_count INTEGER, width INTEGER, height INTEGER, codec TEXT, md5 TEXT, PRIMARY KEY (path, size, mtime))')
+            finally:
+                conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _key(self, vid_path):
+        stat = os.stat(vid_path)
+        return (os.path.abspath(vid_path), stat.st_size, stat.st_mtime_ns)
+
+    def _load(self, key):
+        # the metadata stored by a previous run or another process
+        if self.path is None:
+            return None
+        conn = self._connect()
+        try:
+            row = conn.execute(f"SELECT {', '.join(self._columns)} FROM videos WHERE path = ? AND size = ? AND mtime = ?", key).fetchone()
+        finally:
+            conn.close()
+        return VideoInfo(*row) if row is not None else None
+
+    def _store(self, info):
+        if self.path is None:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(f"INSERT OR REPLACE INTO videos ({', '.join(self._columns)}) VALUES ({', '.join('?' * len(self._columns))})", info)
+        finally:
+            conn.close()
+
+    def _read(self, key):
+        # open the video once for all the header fields
+        vidcap = cv2.VideoCapture(key[0])
+        try:
+            if not vidcap.isOpened():
+                raise IOError(f"Cannot open the video {key[0]}")
+            fourcc = int(vidcap.get(cv2.CAP_PROP_FOURCC))
+            frame_rate = vidcap.get(cv2.CAP_PROP_FPS)
+            return VideoInfo(*key, fps=int(np.round(frame_rate)), frame_rate=frame_rate, frame_count=int(vidcap.get(cv2.CAP_PROP_FRAME_COUNT)),
+                             width=int(vidcap.get(cv2.CAP_PROP_FRAME_WIDTH)), height=int(vidcap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                             codec=''.join(chr((fourcc >> (8 * i)) & 0xff) for i in range(4)).strip('\x00'), md5=None)
+        finally:
+            vidcap.release()
+
+    def probe(self, vid_path):
+
+        '''
+        get the metadata of a video
+
+        Parameters
+        ----------
+        vid_path : string
+            path to the video file
+
+        Returns
+        -------
+        info : VideoInfo
+        '''
+
+        key = self._key(vid_path)
+        info = self._infos.get(key)
+        if info is None:
+            with self._lock:
+                info = self._infos.get(key)
+                if info is None:
+                    info = self._load(key)
+                    if info is None:
+                        info = self._read(key)
+                        self._store(info)
+                    self._infos[key] = info
+        return info
+
+    def md5(self, vid_path):
+
+        '''
+        get the md5 of a video, computed once per file
+
+        Parameters
+        ----------
+        vid_path : string
+            path to the video file
+
+        Returns
+        -------
+        md5 : string
+        '''
+
+        info = self.probe(vid_path)
+        if info.md5 is None:
+            # the file is read outside of the lock, the metadata of the other videos can be read meanwhile
+            info = info._replace(md5=file_md5(info.path))
+            with self._lock:
+                self._infos[info[:3]] = info
+                self._store(info)
+        return info.md5
+
+
+_probe = None
+_probe_lock = threading.Lock()
+
+
+def get_probe():
+    ''' the video probe of the process, stored in config.video_probe['cache'] '''
+    global _probe
+    with _probe_lock:
+        if _probe is None:
+            _probe = VideoProbe(config.video_probe['cache'])
+        return _probe
+
+
+def probe_video(vid_path):
+    ''' the metadata of a video, see VideoProbe.probe '''
+    return get_probe().probe(vid_path)
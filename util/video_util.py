@@ -1,13 +1,174 @@
 import cv2
 import numpy as np
-import psutil
+import queue
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import config
-from .image_util import encode_img
+from .image_util import encode_img, get_codec
+from .memory_governor import get_governor, SpillableFrames
+from .video_probe import probe_video
 
-def load_vid(vid_path, start_frame, end_frame):
+
+def get_frame_step(fps):
+
+    '''
+    get the frame step of a video. If fps is either 50 or 60, read every 2 frames, this applies to HVT and STT races. If the fps is either 25 or 30, read every 1 frame, this applies to Kranji races
+
+    Parameters
+    ----------
+    fps : int
+    	the default fps of the video
+
+    Returns
+    -------
+    frame_step : int
+    '''
+
+    assert(fps in [25, 30, 50, 60])
+    return 2 if fps in [50, 60] else 1
+
+
+class FrameSource:
+
+    '''
+    Stream the frames of a video one by one instead of holding the whole frame set in memory. Frames are decoded by a background thread into a bounded prefetch ring buffer, so the peak memory is
+    prefetch * frame size no matter how long the race is.
+
+    Parameters
+    ----------
+    vid_path : string
+    	path to the video file
+    start_frame : int
+    	the starting frame
+    end_frame : int
+    	the ending frame
+    size : tuple of int
+    	(width, height) that the frames are resized to
+    prefetch : int
+    	the maximum number of decoded frames waiting in the buffer
+
+    Examples
+    --------
+    >>> with FrameSource(vid_path, start_frame, end_frame) as source:
+    ...     for frame_idx, frame in enumerate(source, start_frame):
+    ...         ...
+    '''
+
+    _END = object() # marks the end of the stream in the buffer
+
+    def __init__(self, vid_path, start_frame, end_frame, size=(config.frame_width, config.frame_height), prefetch=config.frame_prefetch):
+        self.vid_path = vid_path
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.size = tuple(size)
+        self.prefetch = max(1, prefetch)
+        self._thread = None
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return self.end_frame - self.start_frame + 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        self.close() # a new iteration restarts the stream from start_frame
+        self._stop.clear()
+        buffer = queue.Queue(maxsize=self.prefetch)
+        self._thread = threading.Thread(target=self._decode, args=(buffer,), daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is self._END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        ''' stop the decoding thread, the frames left in the buffer are dropped '''
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _put(self, buffer, item):
+        # block while the buffer is full, but give up once the consumer has closed the stream
+        while not self._stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _decode(self, buffer):
+        try:
+            for image in self._read():
+                if not self._put(buffer, cv2.resize(image, self.size)):
+                    return
+        except BaseException as e:
+            self._put(buffer, e)
+            return
+        self._put(buffer, self._END)
+
+    def _read(self):
+        info = probe_video(self.vid_path)
+        frame_step = info.frame_step
+        vidcap = cv2.VideoCapture(self.vid_path)
+        try:
+            count = self.start_frame * frame_step
+            if not self._seek(vidcap, count, info.frame_rate):
+                # seeking is not accurate for this video, read from the beginning. The frames before the starting frame are grabbed but not retrieved
+                vidcap.release()
+                vidcap = cv2.VideoCapture(self.vid_path)
+                for _ in range(count):
+                    if not vidcap.grab():
+                        return
+                if not vidcap.grab():
+                    return
+
+            # the frame at count is grabbed, the frames in between two frames of the frame set are skipped with grab only
+            while not self._stop.is_set():
+                success, image = vidcap.retrieve()
+                if not success:
+                    break
+                yield image
+
+                count += frame_step
+                if count > self.end_frame * frame_step:
+                    break
+                if not all(vidcap.grab() for _ in range(frame_step)):
+                    break
+        finally:
+            vidcap.release()
+
+    def _seek(self, vidcap, target, frame_rate):
+        # seek to the frame at target and grab it. The capture seeks to the keyframe before target and decodes up to target. The position is verified against
+        # the frame index and the timestamp of the grabbed frame, with the exact frame rate (i.e. 29.97), return False if it is wrong or if seeking is disabled
+        if not config.seek_decoding or target < config.seek_min_frames:
+            return False
+        vidcap.set(cv2.CAP_PROP_POS_FRAMES, target)
+        if not vidcap.grab():
+            return False
+        index = int(np.round(vidcap.get(cv2.CAP_PROP_POS_FRAMES))) - 1
+        msec = vidcap.get(cv2.CAP_PROP_POS_MSEC)
+        return index == target and abs(msec - target * 1000 / frame_rate) < 500 / frame_rate
+
+
+def load_vid(vid_path, start_frame, end_frame, codec=None):
 
     '''
-    load video into memory
+    load video into memory. Prefer FrameSource for consumers that only need to visit the frames once in order, this function keeps the whole frame set in memory
 
     Parameters
     ----------
@@ -17,62 +178,173 @@ def load_vid(vid_path, start_frame, end_frame):
     	the starting frame
     end_frame : int
     	the ending frame
+    codec : string
+    	the codec of the frames kept in memory, see util.image_util.get_codec. config.frame_codec if None
+
+    Returns
+    -------
+    frames : SpillableFrames
+    	the encoded frames, indexed like a list, see util.memory_governor
     '''
 
     # create data
     print("Loading Video")
 
-    # frames = np.zeros((end_frame-start_frame+1, 1080, 1920, 3), dtype=np.uint8)
-    frames = []
+    info = probe_video(vid_path)
+    print(f"fps: {info.fps}, frame step:{info.frame_step}")
 
-    # Read in the Particular Video
-    vidcap = cv2.VideoCapture(vid_path)
-    fps = int(np.round(vidcap.get(cv2.CAP_PROP_FPS)))
+    # under memory pressure the oldest frames are spilled to disk and the decoding waits for memory, see util.memory_governor
+    governor = get_governor()
+    frames = governor.register(SpillableFrames())
+    with FrameSource(vid_path, start_frame, end_frame) as source:
+        for img in source:
+            frames.append(encode_img(img, codec))
+            governor.throttle()
+
+    print("Video Loaded")
+
+    return frames
 
-    assert(fps in [25, 30, 50, 60])
-    if fps in [50, 60]: # if fps is either 50 or 60, read every 2 frames, this applies to HVT and STT races
-        frame_step = 2
-    else:
-        frame_step = 1 # if the fps is either 25 or 30, read every 1 frame, this applies to Kranji races
 
-    print(f"fps: {fps}, frame step:{frame_step}")
-    success,image = vidcap.read()
+def split_segments(start_frame, end_frame, segments, frame_step):
+
+    '''
+    split the frame set [start_frame, end_frame] into contiguous segments for decoding in parallel. The segment boundaries are aligned to config.keyframe_interval so that every segment starts at a keyframe when the video has a fixed GOP
+
+    Parameters
+    ----------
+    start_frame : int
+    	the starting frame
+    end_frame : int
+    	the ending frame
+    segments : int
+    	the maximum number of segments
+    frame_step : int
+    	see get_frame_step
+
+    Returns
+    -------
+    segments : list of tuple
+    	(segment start frame, segment end frame), both included
+    '''
+
+    align = max(1, -(-config.keyframe_interval // frame_step)) # the number of frames in the frame set between two keyframes
+    length = -(-(end_frame - start_frame + 1) // segments)
+    length = max(align, -(-length // align) * align)
+    boundaries = list(range(-(-start_frame // align) * align, end_frame + 1, length))
+    boundaries = [start_frame] + [b for b in boundaries if b > start_frame] + [end_frame + 1]
+    return [(boundaries[i], boundaries[i+1] - 1) for i in range(len(boundaries) - 1)]
+
+
+def _decode_segment(vid_path, shm_name, shape, offset, start_frame, end_frame, size):
+    # decode a segment in a worker process into the shared output buffer, from row offset. Return the number of decoded frames
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
     count = 0
+    try:
+        with FrameSource(vid_path, start_frame, end_frame, size=size) as source:
+            for count, frame in enumerate(source, 1):
+                frames[offset + count - 1] = frame
+    finally:
+        del frames
+        shm.close()
+    return count
+
+
+def decode_parallel(vid_path, start_frame, end_frame, shm_name, size=(config.frame_width, config.frame_height), workers=None):
+
+    '''
+    decode the frame set in parallel, each segment (see split_segments) is decoded by its own process with its own video capture. The frame indices are the same as FrameSource and load_vid
+
+    Parameters
+    ----------
+    vid_path : string
+    	path to the video file
+    start_frame : int
+    	the starting frame
+    end_frame : int
+    	the ending frame
+    shm_name : string
+    	name of the shared memory block receiving the frames, uint8 array of shape (end_frame - start_frame + 1, height, width, 3)
+    size : tuple of int
+    	(width, height) of the frames
+    workers : int
+    	the number of processes, config.decode_workers if None
 
-    while success:
-        if count > end_frame * frame_step:
+    Returns
+    -------
+    count : int
+    	the number of decoded frames, less than the length of the frame set if the video ends before end_frame
+    '''
+
+    workers = workers or config.decode_workers
+    frame_step = probe_video(vid_path).frame_step
+
+    shape = (end_frame - start_frame + 1, size[1], size[0], 3)
+    segments = split_segments(start_frame, end_frame, workers, frame_step)
+    with ProcessPoolExecutor(max_workers=min(workers, len(segments)), mp_context=mp.get_context("spawn")) as pool:
+        counts = list(pool.map(_decode_segment, *zip(*[(vid_path, shm_name, shape, s - start_frame, s, e, size) for s, e in segments])))
+
+    # the frames are contiguous up to the first segment that ends early
+    count = 0
+    for (s, e), segment_count in zip(segments, counts):
+        count += segment_count
+        if segment_count < e - s + 1:
             break
+    return count
 
-        if count < start_frame * frame_step:
-            success, image = vidcap.read()
-            count += 1
-            continue
-
-        # frames[int((count - start_frame * frame_step)/frame_step), :, :, :] = cv2.resize(image, (1920, 1080)) # resize the image to (1920, 1080)
-        img = cv2.resize(image, (1920, 1080))
-        img_str = encode_img(img)
-        frames.append(img_str)
-   
-        # check the RAM consumption, raise memory error if the remaining memory is lower than 10%
-        if count%500 == 0 and config.debug:
-            mem_remain_percentage = psutil.virtual_memory().available * 100 / psutil.virtual_memory().total
-            print(f"Memory remaining: {mem_remain_percentage}")
-            if mem_remain_percentage < 30:
-                raise MemoryError("Out of RAM")
-
-        for _ in range(frame_step):
-            success,image = vidcap.read()
-        count += frame_step
 
-    print("Video Loaded")
+def _encode_segment(vid_path, start_frame, end_frame, size, codec):
+    # decode a segment in a worker process and encode its frames with the codec, only the encoded frames are sent back
+    encode = get_codec(codec).encode
+    with FrameSource(vid_path, start_frame, end_frame, size=size) as source:
+        return [encode(frame) for frame in source]
+
+
+def load_vid_parallel(vid_path, start_frame, end_frame, codec=None, workers=None):
 
+    '''
+    load video into memory like load_vid, decoding the segments of the frame set in parallel processes (see split_segments). Every process encodes the frames of its segment, so the decoded frame set is never held in memory
+
+    Parameters
+    ----------
+    vid_path : string
+    	the video name
+    start_frame : int
+    	the starting frame
+    end_frame : int
+    	the ending frame
+    codec : string
+    	the codec of the frames kept in memory, see util.image_util.get_codec. config.frame_codec if None
+    workers : int
+    	the number of processes, config.decode_workers if None
+    '''
+
+    print("Loading Video in parallel")
+    size = (config.frame_width, config.frame_height)
+    codec = codec or config.frame_codec # the worker processes do not see the settings changed at runtime
+    workers = workers or config.decode_workers
+    frame_step = probe_video(vid_path).frame_step
+    segments = split_segments(start_frame, end_frame, workers, frame_step)
+
+    governor = get_governor()
+    frames = governor.register(SpillableFrames())
+    with ProcessPoolExecutor(max_workers=min(workers, len(segments)), mp_context=mp.get_context("spawn")) as pool:
+        # the segments come back in order, the frames are contiguous up to the first segment that ends early
+        for (s, e), items in zip(segments, pool.map(_encode_segment, *zip(*[(vid_path, s, e, size, codec) for s, e in segments]))):
+            for item in items:
+                frames.append(item)
+                governor.throttle()
+            if len(items) < e - s + 1:
+                break
+    print("Video Loaded")
     return frames
 
 
 def find_fps(vid_path):
 
     '''
-    get the actual fps. The actual fps == the default fps/frame_step. Please read the doc in load_vid() to understand the frame_step parameter
+    get the actual fps. The actual fps == the default fps/frame_step. Please read the doc in get_frame_step() to understand the frame_step parameter
 
     Parameters
     ----------
@@ -85,9 +357,22 @@ def find_fps(vid_path):
     	the actual fps of the frame set
     '''
 
-    vidcap = cv2.VideoCapture(vid_path)
-    fps = int(np.round(vidcap.get(cv2.CAP_PROP_FPS)))
-    assert(fps in [25, 30, 50, 60])
-    if fps in [50, 60]:
-        return int(np.round(fps/2))
-    return int(np.round(fps))
+    return probe_video(vid_path).actual_fps
+
+
+def find_frame_count(vid_path):
+
+    '''
+    get the number of frames in the frame set, i.e. the number of frames in the video divided by frame_step. The count is read from the container header and can be slightly off for some encoders
+
+    Parameters
+    ----------
+    vid_path : string
+    	path to the video file
+
+    Returns
+    -------
+    frame_count : int
+    '''
+
+    return probe_video(vid_path).frames